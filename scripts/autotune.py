@@ -0,0 +1,155 @@
+# Sizes populate_database's workers, chunks and PostgreSQL session memory from the machine it runs on, instead of assuming 20 GB of free RAM.
+# The same pipeline runs on 16 GB laptops and 256 GB servers. Fixed settings either swap on the first or leave most of the second idle.
+# Two stage kinds get different splits of the memory budget:
+#   python: ncores Python workers with a database session each (parsing descriptors, normalization). Each session gets a small share.
+#   psql:   one big set based statement at a time (finalizing tables, revealed keys, wallet ids). It gets most of the memory and the parallel workers.
+# ChunkSizer adjusts a worker's chunk size while it runs, from the throughput and memory (RSS) it actually sees.
+# Assumes PostgreSQL runs on the same machine. Its shared_buffers are already resident, so they aren't part of the available RAM measured here.
+import os
+import shutil
+from time import perf_counter
+try:
+    import psutil
+except ImportError:  # Falls back to /proc and sysconf. ChunkSizer can't watch memory without either.
+    psutil = None
+
+memory_fraction = 0.8  # Share of the available RAM the pipeline plans to use. The rest is headroom for the OS and page cache.
+python_db_share = 0.25  # Share of the budget python stages leave to the database sessions of their workers
+worker_ram = 1 << 30  # RAM a Python worker needs at the least, to cap ncores on small machines
+bytes_per_python_row = 2048  # Rough Python memory per row a worker holds (tuples, strings, the COPY buffer)
+MB = 1 << 20
+GB = 1 << 30
+
+
+def _clamp(value, low, high):
+    return int(max(low, min(high, value)))
+
+def pgSize(n_bytes):
+    """Bytes as a PostgreSQL memory setting."""
+    return f"{max(1, int(n_bytes) // MB)}MB"
+
+def _meminfo():
+    """(total, available) bytes without psutil."""
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f}
+        return info["MemTotal"], info.get("MemAvailable", info["MemFree"])
+    except (OSError, KeyError, ValueError):
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        return total, total // 2  # No way to tell what's free, assume half
+
+def systemResources(path=None):
+    """
+    Returns {"total_ram", "available_ram", "cores", "free_disk"}. RAM and disk in bytes.
+    free_disk is for the filesystem holding `path` (None if no path), such as the csv directory or the database's data directory.
+    """
+    if psutil is not None:
+        memory = psutil.virtual_memory()
+        total, available = memory.total, memory.available
+        cores = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    else:
+        total, available = _meminfo()
+        cores = os.cpu_count() or 1
+    free_disk = None
+    if path is not None and os.path.exists(path):
+        free_disk = shutil.disk_usage(path).free
+    return {"total_ram": total, "available_ram": available, "cores": cores, "free_disk": free_disk}
+
+def tuneSettings(resources):
+    """
+    Worker counts, chunk sizes and per stage PostgreSQL session settings for `resources` (from systemResources).
+    Returns a dict with ncores, chunk_size_pythonwork, chunk_size_psqlwork, worker_rss_limit, temp_buffers, rewrite_budget and "python"/"psql" session settings.
+    """
+    budget = resources["available_ram"] * memory_fraction
+    cores = resources["cores"]
+    ncores = _clamp(min(cores, budget * (1 - python_db_share) // worker_ram), 1, cores)
+    worker_budget = budget * (1 - python_db_share) / ncores
+    session_budget = budget * python_db_share / ncores
+    gather = max(1, cores // 2)
+    settings = {
+        "ncores": ncores,
+        "chunk_size_pythonwork": _clamp(worker_budget / 4 / bytes_per_python_row, 5000, 500000),  # A quarter, the rest is Python and libraries
+        "chunk_size_psqlwork": _clamp(budget / 64 / 1024, 10000, 1000000),
+        "worker_rss_limit": int(worker_budget),
+        "temp_buffers": pgSize(_clamp(budget / 2, 64 * MB, 16 * GB)),  # Only for the psql stages that build large temp tables
+        # A sort or hash can use work_mem per plan node, so the session budget is spread over a few of them.
+        "python": {
+            "max_parallel_workers": max(1, cores // 2),
+            "max_parallel_workers_per_gather": max(1, cores // 4),
+            "work_mem": pgSize(_clamp(session_budget / 4, 16 * MB, 1 * GB)),
+            "maintenance_work_mem": pgSize(_clamp(session_budget, 64 * MB, 2 * GB)),
+        },
+        # Every parallel worker of a gather gets its own work_mem too.
+        "psql": {
+            "max_parallel_workers": cores,
+            "max_parallel_workers_per_gather": gather,
+            "work_mem": pgSize(_clamp(budget / 4 / (gather + 1), 64 * MB, 4 * GB)),
+            "maintenance_work_mem": pgSize(_clamp(budget / 2, 256 * MB, 16 * GB)),
+        },
+    }
+    # Table rewrites (trimDB) copy at most this much per transaction, so WAL and temp space stay well inside the free disk.
+    free_disk = resources.get("free_disk")
+    settings["rewrite_budget"] = None if free_disk is None else int(free_disk * 0.25)
+    return settings
+
+def applySession(cursor, session):
+    """SETs a "python" or "psql" dict of tuneSettings on a session."""
+    for name, value in session.items():
+        cursor.execute(f"SET {name} = %s;", (str(value),))
+
+def currentRss():
+    """Resident memory of this process in bytes, or None where it can't be read (no psutil and no /proc)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class ChunkSizer:
+    """
+    Picks the next chunk size of a worker loop by hill climbing on rows per second:
+    it keeps growing (or shrinking) the chunk while throughput improves and turns around when it drops.
+    Past `rss_limit` the chunk is halved whatever the throughput, so a worker can't grow itself into swap.
+        sizer = ChunkSizer(25000)
+        while rows := fetch(sizer.size):
+            sizer.start(); work(rows); sizer.record(len(rows))
+    """
+    def __init__(self, initial, minimum=1000, maximum=1000000, rss_limit=None, step=1.5, tolerance=0.05, rss=currentRss):
+        self.size = _clamp(initial, minimum, maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.rss_limit = rss_limit
+        self.step = step
+        self.tolerance = tolerance
+        self._rss = rss
+        self._direction = 1
+        self._last_throughput = None
+        self._started = None
+
+    def start(self):
+        self._started = perf_counter()
+
+    def record(self, rows, seconds=None):
+        """Records a finished chunk of `rows` that took `seconds` (since start() if not given) and returns the next size."""
+        if seconds is None:
+            seconds = perf_counter() - self._started
+        rss = self._rss() if self.rss_limit is not None else None
+        if rss is not None and rss > self.rss_limit:
+            self._resize(self.size / 2)
+            self._direction = -1
+            self._last_throughput = None  # Comparisons with a chunk this much bigger mean nothing
+            return self.size
+        if rows < self.size or seconds <= 0:
+            return self.size  # The last, partial chunk says nothing about the size
+        throughput = rows / seconds
+        if self._last_throughput is not None and throughput < self._last_throughput * (1 - self.tolerance):
+            self._direction = -self._direction
+        if self._last_throughput is None or abs(throughput - self._last_throughput) > self._last_throughput * self.tolerance:
+            self._resize(self.size * self.step if self._direction > 0 else self.size / self.step)
+        self._last_throughput = throughput
+        return self.size
+
+    def _resize(self, size):
+        self.size = _clamp(size, self.minimum, self.maximum)
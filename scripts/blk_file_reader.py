@@ -0,0 +1,163 @@
+# Offline block source. Reads the node's blocks/blk*.dat files directly so a full reindex doesn't need a running RPC server.
+# Files are memory mapped, so only the pages holding headers are touched while indexing and each block is read once, sequentially, while extracting.
+# DEPENDENCY: Run this against a stopped node (or a copy of its blocks directory). A running node may be part way through writing the last file; incomplete records are skipped.
+import os
+import mmap
+from glob import glob
+from struct import unpack_from
+import numpy as np
+from raw_block_parser import sha256d
+
+MAINNET_MAGIC = bytes.fromhex("f9beb4d9")
+_NULL_HASH = bytes(32)
+
+
+def readXorKey(blocks_dir):
+    """
+    Bitcoin Core v28+ obfuscates block files with the 8 byte key in blocks/xor.dat. Older nodes have no key file, which is the same as an all zero key.
+    """
+    path = os.path.join(blocks_dir, "xor.dat")
+    if not os.path.exists(path):
+        return bytes(8)
+    with open(path, "rb") as f:
+        return f.read(8)
+
+def blockWork(bits):
+    """
+    Expected hashes to find a block with the compact target `bits` (header bytes 72 to 76), like Bitcoin Core's GetBlockProof. The best chain is the one with the most of it.
+    """
+    exponent, mantissa = bits >> 24, bits & 0x007fffff
+    target = mantissa << (8 * (exponent - 3)) if exponent > 3 else mantissa >> (8 * (3 - exponent))
+    if target == 0 or bits & 0x00800000:
+        return 0  # Negative or zero target, never valid
+    return (1 << 256) // (target + 1)
+
+class BlkFile:
+    """
+    A memory mapped blk*.dat file. Reads undo the XOR obfuscation, which is keyed on the byte's offset in the file.
+    """
+    def __init__(self, path, xor_key):
+        self.path = path
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._key = np.frombuffer(xor_key, dtype=np.uint8)
+        self._obfuscated = any(xor_key)
+
+    def read(self, offset, size):
+        if not self._obfuscated:
+            return memoryview(self._map)[offset:offset + size]  # zero copy
+        data = np.frombuffer(self._map, dtype=np.uint8, count=size, offset=offset)
+        key = np.resize(np.roll(self._key, -(offset % len(self._key))), size)
+        return memoryview(np.bitwise_xor(data, key).tobytes())
+
+    def records(self, magic=MAINNET_MAGIC):
+        """
+        Yields (offset, size) of every block stored in the file. Core preallocates files with zeros, so the scan stops at the first position without the network magic.
+        """
+        pos = 0
+        while pos + 8 <= self.size:
+            record = self.read(pos, 8)
+            if record[:4] != magic:
+                return
+            size, = unpack_from("<I", record, 4)
+            if pos + 8 + size > self.size:
+                return
+            yield pos + 8, size
+            pos += 8 + size
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+class BlkFileReader:
+    """
+    Indexes every block in a blocks directory by header, then orders the best chain, the one with the most cumulative work, by height using the previous block hashes.
+    Blocks are stored in the order they were downloaded (headers first sync fetches them out of order), and stale blocks are stored too, so file order can't be trusted.
+    """
+    def __init__(self, blocks_dir, magic=MAINNET_MAGIC):
+        self.xor_key = xor_key = readXorKey(blocks_dir)
+        self.files = [BlkFile(path, xor_key) for path in sorted(glob(os.path.join(blocks_dir, "blk[0-9]*.dat")))]
+        locations = {}  # block hash -> (file index, offset, size)
+        parents = {}    # block hash -> previous block hash
+        times = {}
+        works = {}      # block hash -> work of the block alone
+        for i, blk in enumerate(self.files):
+            for offset, size in blk.records(magic):
+                header = blk.read(offset, 80)
+                block_hash = sha256d(header)
+                locations[block_hash] = (i, offset, size)
+                parents[block_hash] = header[4:36].tobytes()
+                times[block_hash], bits = unpack_from("<II", header, 68)
+                works[block_hash] = blockWork(bits)
+        self._locations = locations
+        self.chain = self._bestChain(parents, works)
+        self._times = [times[h] for h in self.chain]
+
+    @staticmethod
+    def _bestChain(parents, works):
+        """
+        Heights and cumulative work come from walking previous hashes back to the genesis block. The tip is the block with the most chain work,
+        so a longer branch of easier blocks loses to a shorter one with more work, as it does for the node. Ties go to the higher block.
+        """
+        heights = {}
+        chain_work = {}
+        for block_hash in parents:
+            path = []
+            h = block_hash
+            while h not in heights and h in parents and parents[h] != _NULL_HASH:
+                path.append(h)
+                h = parents[h]
+            if h in heights:
+                base = heights[h]
+            elif parents.get(h) == _NULL_HASH:
+                base = 0
+                heights[h] = 0
+                chain_work[h] = works[h]
+            else:
+                continue  # Orphan whose ancestors aren't on disk (yet).
+            work = chain_work[h]
+            for depth, node in enumerate(reversed(path), start=1):
+                heights[node] = base + depth
+                work += works[node]
+                chain_work[node] = work
+        if not heights:
+            return []
+        tip = max(heights, key=lambda h: (chain_work[h], heights[h]))
+        chain = [tip]
+        while heights[chain[-1]] > 0:
+            chain.append(parents[chain[-1]])
+        chain.reverse()
+        return chain
+
+    def __len__(self):
+        return len(self.chain)
+
+    def blockHash(self, height):
+        return self.chain[height][::-1].hex()
+
+    def medianTime(self, height):
+        """Median of the block's time and the 10 before it, which is what bitcoind reports as mediantime (GetMedianTimePast takes the upper middle for short windows)."""
+        window = sorted(self._times[max(0, height - 10):height + 1])
+        return window[len(window) // 2]
+
+    def blockLocation(self, height):
+        """(path, offset, size) of a block, so another process can read it with its own BlkFile."""
+        i, offset, size = self._locations[self.chain[height]]
+        return self.files[i].path, offset, size
+
+    def readBlock(self, height):
+        i, offset, size = self._locations[self.chain[height]]
+        return self.files[i].read(offset, size)
+
+    def iterBlocks(self, start_height, end_height):
+        """
+        Yields (height, block) in the {"raw", "mediantime"} form the RPC raw_blocks mode produces.
+        """
+        for height in range(start_height, min(end_height, len(self.chain) - 1) + 1):
+            yield height, {"raw": self.readBlock(height), "mediantime": self.medianTime(height)}
+
+    def close(self):
+        for blk in self.files:
+            blk.close()
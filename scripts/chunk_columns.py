@@ -0,0 +1,479 @@
+# Column buffers for a whole chunk of blocks. Every block is flattened straight into them in one pass, so there is no per block DataFrame and no pd.concat.
+# Profiling showed pandas object creation, not I/O, was most of the extraction time on modern blocks with thousands of transactions.
+# Numeric columns are array.array buffers (typed, amortized growth, handed to NumPy without a copy). Strings stay in lists since they end up as Python objects either way.
+# Output values are kept as integer satoshis and only turned into BTC when a chunk is written out.
+# Decode farm workers (extract_bitcoin_data_beta's decode_workers) hand their pieces of a chunk back as Arrow IPC in shared memory, so nothing is pickled through the pool's pipe.
+# With intern_txids every table also gets integer tx_id columns from txid_interner.TxidInterner, null otherwise.
+# With address_keys outputs and inputs get canonical BYTEA keys (utils/deriveUndefinedAddresses.canonicalKeys) of their address and prevout address, null otherwise.
+import os
+from array import array
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:  # Only needed for the parquet and arrow output formats.
+    pa = pq = feather = None
+
+TRANSACTION_COLUMNS = ["txid", "median_blocktime", "miner_time", "locktime", "tx_id"]
+INPUT_COLUMNS = ["txid", "vin_txid", "vin_vout", "vin_asm", "witness_data", "prevout_value", "prevout_type", "prevout_address", "tx_id", "vin_tx_id", "prevout_key"]
+OUTPUT_COLUMNS = [
+    "txid", "vout_n", "vout_value",
+    "vout_scriptPubKey_desc", "vout_scriptPubKey_address", "vout_scriptPubKey_type", "tx_id", "address_key"
+]
+_NO_VOUT = -1  # vin_vout of a coinbase input, written out as null
+_NO_VALUE = -1  # prevout_value of an input whose prevout isn't known, written out as null
+_NO_ID = -1  # tx_id of an unknown txid (or of every row when txids aren't interned), written out as null
+
+
+class ChunkColumns:
+    """
+    Chunk wide column buffers. Implements the same sink interface as raw_block_parser.BlockRows, so raw blocks decode straight into it too.
+    """
+    def __init__(self):
+        self.tx_txid = []
+        self.tx_median_blocktime = array('q')
+        self.tx_miner_time = array('q')
+        self.tx_locktime = array('q')
+
+        self.in_txid = []
+        self.in_vin_txid = []
+        self.in_vin_vout = array('q')
+        self.in_vin_asm = []
+        self.in_witness_data = []
+        # What each input spends (see prevoutAddress). Null for coinbase inputs and when prevouts aren't resolved.
+        self.in_prevout_value_sats = array('q')
+        self.in_prevout_type = []
+        self.in_prevout_address = []
+
+        self.out_txid = []
+        self.out_vout_n = array('q')
+        self.out_value_sats = array('q')
+        self.out_desc = []
+        self.out_address = []
+        self.out_type = []
+
+        # Interned ids of txid, in_txid, in_vin_txid and out_txid (int64 arrays, _NO_ID for null). None until internTxids is called.
+        self.tx_id = self.in_tx_id = self.in_vin_tx_id = self.out_tx_id = None
+        # Canonical keys (bytes) of out_address and in_prevout_address. None until fillAddressKeys is called.
+        self.out_address_key = self.in_prevout_key = None
+
+    def __len__(self):
+        return len(self.tx_txid)
+
+    def addTransaction(self, txid, median_blocktime, miner_time, locktime):
+        self.tx_txid.append(txid)
+        self.tx_median_blocktime.append(median_blocktime)
+        self.tx_miner_time.append(miner_time)
+        self.tx_locktime.append(locktime)
+
+    def addInput(self, txid, vin_txid, vin_vout, vin_asm, witness_data, prevout_value_sats=None, prevout_type=None, prevout_address=None):
+        self.in_txid.append(txid)
+        self.in_vin_txid.append(vin_txid)
+        self.in_vin_vout.append(_NO_VOUT if vin_vout is None else vin_vout)
+        self.in_vin_asm.append(vin_asm)
+        self.in_witness_data.append(witness_data)
+        self.in_prevout_value_sats.append(_NO_VALUE if prevout_value_sats is None else prevout_value_sats)
+        self.in_prevout_type.append(prevout_type)
+        self.in_prevout_address.append(prevout_address)
+
+    def addOutput(self, txid, vout_n, value_sats, desc, address, kind):
+        self.out_txid.append(txid)
+        self.out_vout_n.append(vout_n)
+        self.out_value_sats.append(value_sats)
+        self.out_desc.append(desc)
+        self.out_address.append(address)
+        self.out_type.append(kind)
+
+    def outpoints(self):
+        """
+        Returns (output keys, output rows, input keys) for utxo_map.UtxoMap. Keys are outpointKey()s, input keys are None for coinbase inputs.
+        Output rows are (value_sats, type, prevoutAddress).
+        """
+        out_keys = [outpointKey(bytes.fromhex(txid), n) for txid, n in zip(self.out_txid, self.out_vout_n)]
+        out_rows = [
+            (value, kind, prevoutAddress(kind, desc, address))
+            for value, kind, desc, address in zip(self.out_value_sats, self.out_type, self.out_desc, self.out_address)
+        ]
+        in_keys = [None if txid is None else outpointKey(bytes.fromhex(txid), n) for txid, n in zip(self.in_vin_txid, self.in_vin_vout)]
+        return out_keys, out_rows, in_keys
+
+    def setPrevouts(self, prevouts):
+        """Fills the prevout columns from one (value_sats, type, address) or None per input."""
+        self.in_prevout_value_sats = array('q', (_NO_VALUE if p is None else p[0] for p in prevouts))
+        self.in_prevout_type = [None if p is None else p[1] for p in prevouts]
+        self.in_prevout_address = [None if p is None else p[2] for p in prevouts]
+
+    def internTxids(self, interner):
+        """
+        Interns the chunk's txids in order (chain order), then looks up the ids every input and output refers to.
+        vin_tx_id is null for coinbase inputs and for txids from before the interner's first chunk.
+        """
+        from txid_interner import txidWords
+        self.tx_id = interner.intern(*txidWords(self.tx_txid))
+        self.in_tx_id = interner.lookup(*txidWords(self.in_txid))
+        self.in_vin_tx_id = interner.lookup(*txidWords(self.in_vin_txid))
+        self.out_tx_id = interner.lookup(*txidWords(self.out_txid))
+
+    def fillAddressKeys(self, canonical_keys):
+        """Fills the key columns with canonical_keys(list of addresses) -> list of bytes. Pay to pubkey outputs are keyed by their public key."""
+        self.out_address_key = canonical_keys([
+            prevoutAddress(kind, desc, address) for kind, desc, address in zip(self.out_type, self.out_desc, self.out_address)
+        ])
+        self.in_prevout_key = canonical_keys(self.in_prevout_address)
+
+    def frames(self):
+        """
+        Builds the chunk's three DataFrames in one go, with the same columns the chunk CSVs have always had, plus the inputs' prevout columns and the tx_id columns.
+        """
+        tx_df = pd.DataFrame({
+            "txid": self.tx_txid,
+            "median_blocktime": np.frombuffer(self.tx_median_blocktime, dtype=np.int64),
+            "miner_time": np.frombuffer(self.tx_miner_time, dtype=np.int64),
+            "locktime": np.frombuffer(self.tx_locktime, dtype=np.int64),
+            "tx_id": _idFrameColumn(self.tx_id, len(self.tx_txid)),
+        }, columns=TRANSACTION_COLUMNS)
+        vin_vout = np.frombuffer(self.in_vin_vout, dtype=np.int64)
+        prevout_value = np.frombuffer(self.in_prevout_value_sats, dtype=np.int64)
+        vin_df = pd.DataFrame({
+            "txid": self.in_txid,
+            "vin_txid": self.in_vin_txid,
+            "vin_vout": pd.arrays.IntegerArray(vin_vout.copy(), vin_vout == _NO_VOUT),
+            "vin_asm": self.in_vin_asm,
+            "witness_data": self.in_witness_data,
+            "prevout_value": np.where(prevout_value == _NO_VALUE, np.nan, prevout_value / 1e8),
+            "prevout_type": self.in_prevout_type,
+            "prevout_address": self.in_prevout_address,
+            "tx_id": _idFrameColumn(self.in_tx_id, len(self.in_txid)),
+            "vin_tx_id": _idFrameColumn(self.in_vin_tx_id, len(self.in_txid)),
+            "prevout_key": _byteaFrameColumn(self.in_prevout_key, len(self.in_txid)),
+        }, columns=INPUT_COLUMNS)
+        vout_df = pd.DataFrame({
+            "txid": self.out_txid,
+            "vout_n": np.frombuffer(self.out_vout_n, dtype=np.int64),
+            "vout_value": np.frombuffer(self.out_value_sats, dtype=np.int64) / 1e8,  # the RPC reports BTC
+            "vout_scriptPubKey_desc": self.out_desc,
+            "vout_scriptPubKey_address": self.out_address,
+            "vout_scriptPubKey_type": self.out_type,
+            "tx_id": _idFrameColumn(self.out_tx_id, len(self.out_txid)),
+            "address_key": _byteaFrameColumn(self.out_address_key, len(self.out_txid)),
+        }, columns=OUTPUT_COLUMNS)
+        return tx_df, vin_df, vout_df
+
+    def arrowTables(self, chunk_start, chunk_end):
+        """
+        Builds the chunk's three Arrow tables. This is a smaller, typed layout than the CSVs:
+            txids are 32 byte fixed binary (same byte order as the hex the RPC shows),
+            script types are dictionary encoded,
+            values are int64 satoshis,
+            and the chunk's height range is stored in the schema metadata.
+        Input rows also carry their prevout (value in satoshis, type, address), null where it isn't resolved.
+        tx_id columns are int32, null where txids aren't interned. Key columns are binary, null where not filled.
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required for the parquet and arrow output formats.")
+        metadata = {"chunk_start": str(chunk_start), "chunk_end": str(chunk_end)}
+        transactions = pa.table({
+            "txid": _txidArray(self.tx_txid),
+            "median_blocktime": pa.array(np.frombuffer(self.tx_median_blocktime, dtype=np.int64)),
+            "miner_time": pa.array(np.frombuffer(self.tx_miner_time, dtype=np.int64)),
+            "locktime": pa.array(np.frombuffer(self.tx_locktime, dtype=np.int64)),
+            "tx_id": _idArray(self.tx_id, len(self.tx_txid)),
+        }, metadata=metadata)
+        vin_vout = np.frombuffer(self.in_vin_vout, dtype=np.int64)
+        prevout_value = np.frombuffer(self.in_prevout_value_sats, dtype=np.int64)
+        inputs = pa.table({
+            "txid": _txidArray(self.in_txid),
+            "vin_txid": _txidArray(self.in_vin_txid),
+            "vin_vout": pa.array(vin_vout, mask=vin_vout == _NO_VOUT),
+            "vin_asm": pa.array(self.in_vin_asm, type=pa.string()),
+            "witness_data": pa.array(self.in_witness_data, type=pa.string()),
+            "prevout_value": pa.array(prevout_value, mask=prevout_value == _NO_VALUE),
+            "prevout_type": pa.array(self.in_prevout_type, type=pa.string()).dictionary_encode(),
+            "prevout_address": pa.array(self.in_prevout_address, type=pa.string()),
+            "tx_id": _idArray(self.in_tx_id, len(self.in_txid)),
+            "vin_tx_id": _idArray(self.in_vin_tx_id, len(self.in_txid)),
+            "prevout_key": _keyArray(self.in_prevout_key, len(self.in_txid)),
+        }, metadata=metadata)
+        outputs = pa.table({
+            "txid": _txidArray(self.out_txid),
+            "vout_n": pa.array(np.frombuffer(self.out_vout_n, dtype=np.int64)),
+            "vout_value": pa.array(np.frombuffer(self.out_value_sats, dtype=np.int64)),
+            "vout_scriptPubKey_desc": pa.array(self.out_desc, type=pa.string()),
+            "vout_scriptPubKey_address": pa.array(self.out_address, type=pa.string()),
+            "vout_scriptPubKey_type": pa.array(self.out_type, type=pa.string()).dictionary_encode(),
+            "tx_id": _idArray(self.out_tx_id, len(self.out_txid)),
+            "address_key": _keyArray(self.out_address_key, len(self.out_txid)),
+        }, metadata=metadata)
+        return transactions, inputs, outputs
+
+
+class ArrowChunk:
+    """
+    A chunk assembled from decode farm pieces, each a (transactions, inputs, outputs) triple in the arrowTables layout.
+    Parquet and arrow output concatenate the pieces without going through Python objects. CSV and postgres output convert back to ChunkColumns.
+    """
+    def __init__(self):
+        self.pieces = []
+
+    def __len__(self):
+        return sum(piece[0].num_rows for piece in self.pieces)
+
+    def append(self, tables):
+        self.pieces.append(tables)
+
+    def arrowTables(self, chunk_start, chunk_end):
+        metadata = {"chunk_start": str(chunk_start), "chunk_end": str(chunk_end)}
+        # Every piece dictionary encoded its script types on its own. IPC files need one dictionary per column.
+        return tuple(
+            pa.concat_tables(tables).unify_dictionaries().replace_schema_metadata(metadata)
+            for tables in zip(*self.pieces)
+        )
+
+    def toColumns(self):
+        columns = ChunkColumns()
+        ids = {"tx_id": [], "in_tx_id": [], "in_vin_tx_id": [], "out_tx_id": []}
+        for transactions, inputs, outputs in self.pieces:
+            ids["tx_id"].append(transactions["tx_id"])
+            ids["in_tx_id"].append(inputs["tx_id"])
+            ids["in_vin_tx_id"].append(inputs["vin_tx_id"])
+            ids["out_tx_id"].append(outputs["tx_id"])
+            columns.tx_txid += _hexList(transactions["txid"])
+            columns.tx_median_blocktime.frombytes(_int64Bytes(transactions["median_blocktime"]))
+            columns.tx_miner_time.frombytes(_int64Bytes(transactions["miner_time"]))
+            columns.tx_locktime.frombytes(_int64Bytes(transactions["locktime"]))
+
+            columns.in_txid += _hexList(inputs["txid"])
+            columns.in_vin_txid += _hexList(inputs["vin_txid"])
+            columns.in_vin_vout.frombytes(_int64Bytes(inputs["vin_vout"].fill_null(_NO_VOUT)))
+            columns.in_vin_asm += inputs["vin_asm"].to_pylist()
+            columns.in_witness_data += inputs["witness_data"].to_pylist()
+            columns.in_prevout_value_sats.frombytes(_int64Bytes(inputs["prevout_value"].fill_null(_NO_VALUE)))
+            columns.in_prevout_type += inputs["prevout_type"].to_pylist()
+            columns.in_prevout_address += inputs["prevout_address"].to_pylist()
+
+            columns.out_txid += _hexList(outputs["txid"])
+            columns.out_vout_n.frombytes(_int64Bytes(outputs["vout_n"]))
+            columns.out_value_sats.frombytes(_int64Bytes(outputs["vout_value"]))
+            columns.out_desc += outputs["vout_scriptPubKey_desc"].to_pylist()
+            columns.out_address += outputs["vout_scriptPubKey_address"].to_pylist()
+            columns.out_type += outputs["vout_scriptPubKey_type"].to_pylist()
+        if any(outputs["address_key"].null_count < outputs.num_rows for _, _, outputs in self.pieces):
+            columns.out_address_key = [key for _, _, outputs in self.pieces for key in outputs["address_key"].to_pylist()]
+            columns.in_prevout_key = [key for _, inputs, _ in self.pieces for key in inputs["prevout_key"].to_pylist()]
+        if any(column.null_count < len(column) for column in ids["tx_id"]):
+            for name, pieces in ids.items():
+                setattr(columns, name, np.concatenate([column.fill_null(_NO_ID).to_numpy().astype(np.int64) for column in pieces]))
+        return columns
+
+    def frames(self):
+        return self.toColumns().frames()
+
+    def outpoints(self):
+        out_keys, out_rows, in_keys = [], [], []
+        for _, inputs, outputs in self.pieces:
+            out_txids = outputs["txid"].to_pylist()
+            out_keys += [outpointKey(txid, n) for txid, n in zip(out_txids, outputs["vout_n"].to_pylist())]
+            out_rows += [
+                (value, kind, prevoutAddress(kind, desc, address))
+                for value, kind, desc, address in zip(
+                    outputs["vout_value"].to_pylist(), outputs["vout_scriptPubKey_type"].to_pylist(),
+                    outputs["vout_scriptPubKey_desc"].to_pylist(), outputs["vout_scriptPubKey_address"].to_pylist())
+            ]
+            in_keys += [None if txid is None else outpointKey(txid, n) for txid, n in zip(inputs["vin_txid"].to_pylist(), inputs["vin_vout"].to_pylist())]
+        return out_keys, out_rows, in_keys
+
+    def internTxids(self, interner):
+        """Same as ChunkColumns.internTxids, piece by piece, reading the txids straight out of the fixed binary columns."""
+        for i, (transactions, inputs, outputs) in enumerate(self.pieces):
+            tx_id = interner.intern(*_arrowTxidWords(transactions["txid"]))
+            transactions = _setColumn(transactions, "tx_id", _idArray(tx_id, len(tx_id)))
+            inputs = _setColumn(inputs, "tx_id", _idArray(interner.lookup(*_arrowTxidWords(inputs["txid"])), inputs.num_rows))
+            inputs = _setColumn(inputs, "vin_tx_id", _idArray(interner.lookup(*_arrowTxidWords(inputs["vin_txid"])), inputs.num_rows))
+            outputs = _setColumn(outputs, "tx_id", _idArray(interner.lookup(*_arrowTxidWords(outputs["txid"])), outputs.num_rows))
+            self.pieces[i] = (transactions, inputs, outputs)
+
+    def fillAddressKeys(self, canonical_keys):
+        for i, (transactions, inputs, outputs) in enumerate(self.pieces):
+            addresses = [
+                prevoutAddress(kind, desc, address) for kind, desc, address in zip(
+                    outputs["vout_scriptPubKey_type"].to_pylist(), outputs["vout_scriptPubKey_desc"].to_pylist(),
+                    outputs["vout_scriptPubKey_address"].to_pylist())
+            ]
+            outputs = _setColumn(outputs, "address_key", _keyArray(canonical_keys(addresses), outputs.num_rows))
+            inputs = _setColumn(inputs, "prevout_key", _keyArray(canonical_keys(inputs["prevout_address"].to_pylist()), inputs.num_rows))
+            self.pieces[i] = (transactions, inputs, outputs)
+
+    def setPrevouts(self, prevouts):
+        start = 0
+        for i, (transactions, inputs, outputs) in enumerate(self.pieces):
+            piece = prevouts[start:start + inputs.num_rows]
+            start += inputs.num_rows
+            columns = {
+                "prevout_value": pa.array([None if p is None else p[0] for p in piece], type=pa.int64()),
+                "prevout_type": pa.array([None if p is None else p[1] for p in piece], type=pa.string()).dictionary_encode(),
+                "prevout_address": pa.array([None if p is None else p[2] for p in piece], type=pa.string()),
+            }
+            for name, column in columns.items():
+                inputs = _setColumn(inputs, name, column)
+            self.pieces[i] = (transactions, inputs, outputs)
+
+
+def outpointKey(txid, vout):
+    """36 byte outpoint: the txid in the byte order the RPC shows it, then the output index big endian (so a tx's outputs sort together)."""
+    return txid + vout.to_bytes(4, "big")
+
+def prevoutAddress(kind, desc, address):
+    """
+    What an input's prevout_address holds: the output's address, or for pay to pubkey outputs (which have none) the public key, the same value parsePubkeyDescriptors puts in outputs.address.
+    """
+    if kind == "pubkey" and desc is not None and desc.startswith("pk("):
+        return desc[3:desc.index(")")]
+    return address
+
+def _hexList(txids):
+    return [None if t is None else t.hex() for t in txids.to_pylist()]
+
+def _int64Bytes(column):
+    return np.ascontiguousarray(column.to_numpy(), dtype=np.int64).tobytes()
+
+def _setColumn(table, name, column):
+    return table.set_column(table.schema.get_field_index(name), name, column)
+
+def _idFrameColumn(ids, n):
+    if ids is None:
+        return pd.array([None] * n, dtype="Int64")
+    return pd.arrays.IntegerArray(ids.copy(), ids == _NO_ID)
+
+def _idArray(ids, n):
+    if ids is None:
+        return pa.nulls(n, type=pa.int32())
+    return pa.array(ids.astype(np.int32), mask=ids == _NO_ID)
+
+def _byteaFrameColumn(keys, n):
+    """Keys in PostgreSQL's hex bytea format, which COPY reads straight from the CSVs."""
+    if keys is None:
+        return [None] * n
+    return [None if key is None else "\\x" + key.hex() for key in keys]
+
+def _keyArray(keys, n):
+    if keys is None:
+        return pa.nulls(n, type=pa.binary())
+    return pa.array(keys, type=pa.binary())
+
+def _arrowTxidWords(column):
+    """A fixed_size_binary(32) txid column as the (n, 4) uint64 array and validity mask txid_interner takes, without going through hex."""
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    data = np.frombuffer(array.buffers()[1], dtype=np.uint8)[array.offset * 32:(array.offset + len(array)) * 32]
+    valid = np.ones(len(array), dtype=bool) if array.null_count == 0 else array.is_valid().to_numpy(zero_copy_only=False)
+    return np.ascontiguousarray(data).view(np.uint64).reshape(-1, 4), valid
+
+def tablesToSharedMemory(tables):
+    """
+    Writes tables as consecutive Arrow IPC streams into a new shared memory block. Returns (block name, stream sizes) for tablesFromSharedMemory.
+    The reader unlinks the block. It is taken off this process's resource tracker so it isn't also unlinked (with a warning) when the worker exits.
+    """
+    streams = []
+    for table in tables:
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        streams.append(sink.getvalue())
+    sizes = [stream.size for stream in streams]
+    shm = SharedMemory(create=True, size=max(1, sum(sizes)))
+    try:
+        offset = 0
+        for stream in streams:
+            shm.buf[offset:offset + stream.size] = memoryview(stream).cast("B")
+            offset += stream.size
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    if os.name == "posix":  # Only POSIX shared memory is tracked
+        resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, sizes
+
+def tablesFromSharedMemory(name, sizes):
+    """Reads back the tables written by tablesToSharedMemory with one copy out of the block, then frees the block."""
+    shm = SharedMemory(name=name)
+    try:
+        view = shm.buf[:sum(sizes)]
+        data = pa.py_buffer(bytes(view))
+        view.release()
+    finally:
+        shm.close()
+        shm.unlink()
+    tables = []
+    offset = 0
+    for size in sizes:
+        tables.append(pa.ipc.open_stream(data.slice(offset, size)).read_all())
+        offset += size
+    return tuple(tables)
+
+def _txidArray(hex_txids):
+    """
+    Hex txids (None for coinbase inputs) to a fixed_size_binary(32) array, converted in one bytes.fromhex call.
+    """
+    valid = np.fromiter((t is not None for t in hex_txids), dtype=bool, count=len(hex_txids))
+    data = bytes.fromhex("".join(t if t is not None else "00" * 32 for t in hex_txids))
+    validity = None if valid.all() else pa.py_buffer(np.packbits(valid, bitorder="little"))
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(32), len(hex_txids), [validity, pa.py_buffer(data)])
+
+def writeArrowChunk(tables, paths, output_format):
+    """
+    Writes (transactions, inputs, outputs) tables. Parquet is zstd compressed for size. Arrow IPC files are left uncompressed so readers can memory map them without copying.
+    """
+    for table, path in zip(tables, paths):
+        if output_format == "parquet":
+            pq.write_table(table, path, compression="zstd")
+        else:
+            feather.write_feather(table, path, compression="uncompressed")
+
+def readArrowChunk(path):
+    """
+    Reads one chunk file written by writeArrowChunk. Arrow files are memory mapped (zero copy), parquet files are read through a memory map.
+    Returns the table and its (chunk_start, chunk_end) height range.
+    """
+    if path.endswith(".parquet"):
+        table = pq.read_table(path, memory_map=True)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    metadata = table.schema.metadata or {}
+    height_range = (int(metadata[b"chunk_start"]), int(metadata[b"chunk_end"])) if b"chunk_start" in metadata else None
+    return table, height_range
+
+
+def flattenBlock(block, sink):
+    """
+    Walks a verbosity 2 block's transactions once and appends every transaction, input and output to `sink`.
+    Coinbase inputs get None for vin_txid, vin_vout and vin_asm.
+    Verbosity 3 blocks also carry every input's prevout, which fills the prevout columns without a UTXO map.
+    """
+    median_blocktime = block.get("mediantime")
+    miner_time = block.get("time")
+    add_tx, add_in, add_out = sink.addTransaction, sink.addInput, sink.addOutput
+    for tx in block["tx"]:
+        txid = tx["txid"]
+        add_tx(txid, median_blocktime, miner_time, tx.get("locktime"))
+        for vin in tx["vin"]:
+            # Witness data is stored as a comma separated string. Only the last item is the pubkey for single key scripts, but all of it is kept in case the protocol changes.
+            witness = vin.get("txinwitness")
+            witness_data = ", ".join(witness) if witness is not None else None
+            if "coinbase" in vin:
+                add_in(txid, None, None, None, witness_data)
+            elif "prevout" in vin:
+                prevout = vin["prevout"]
+                spk = prevout["scriptPubKey"]
+                add_in(txid, vin["txid"], vin["vout"], vin["scriptSig"]["asm"], witness_data,
+                       round(prevout["value"] * 1e8), spk.get("type"), prevoutAddress(spk.get("type"), spk.get("desc"), spk.get("address")))
+            else:
+                add_in(txid, vin["txid"], vin["vout"], vin["scriptSig"]["asm"], witness_data)
+        for vout in tx["vout"]:
+            spk = vout["scriptPubKey"]
+            add_out(txid, vout["n"], round(vout["value"] * 1e8), spk.get("desc"), spk.get("address"), spk.get("type"))
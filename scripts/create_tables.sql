@@ -11,6 +11,7 @@ CREATE TABLE outputs (
     vout_value REAL,
     descriptor TEXT NULL,
     address TEXT NULL,
+    address_key BYTEA NULL, -- Canonical key of the address: a type tag byte then the hash160 or witness program. 21 bytes for most outputs.
     descriptor_type BOOLEAN NULL, -- 1 if needs parsing, 2 if needs reveal, NULL if neither. This results in significant size compression + speedup.
     wallet_id INT NULL,
     PRIMARY KEY (txid, vout_n)
@@ -25,11 +26,23 @@ CREATE TABLE inputs (
 );
 
 CREATE TABLE normalized_hashes (
-    hash TEXT NOT NULL,
-    wallet_id INT NOT NULL,
+    hash BYTEA NOT NULL, -- Canonical key, same form as outputs.address_key.
+    root_hash BYTEA NOT NULL -- Canonical key of the uncompressed public key it derives from.
+);
+
+CREATE TABLE wallets (
+    wallet_id INT PRIMARY KEY, -- Dense, from 1. cscUnionFind indexes arrays with it.
+    root_hash BYTEA NOT NULL UNIQUE
+);
+
+CREATE TABLE key_wallets (
+    address_key BYTEA PRIMARY KEY, -- Every canonical key found in outputs.
+    wallet_id INT NOT NULL
 );
 
 CREATE TABLE cs_clusters (
     wallet_id INT NOT NULL,
     cluster_id INT NOT NULL,    
+    PRIMARY KEY (wallet_id)
 );
+CREATE INDEX cs_clusters_cluster_id_idx ON cs_clusters(cluster_id);
@@ -1,10 +1,22 @@
 ############## WRITTEN BY NOAH TOVER ############################
 import requests
 from time import time, sleep
-import pandas as pd
 import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+from functools import partial
+from raw_block_parser import parseRawBlock, sha256d
+from chunk_columns import ChunkColumns, ArrowChunk, flattenBlock, writeArrowChunk, tablesToSharedMemory, tablesFromSharedMemory
+from blk_file_reader import BlkFileReader, BlkFile
+from pg_copy import PostgresChunkWriter
+from extraction_manifest import ExtractionManifest, atomicPath, publishFiles
+from utxo_map import UtxoMap
 # Developers Note #
 # Witness data is stored as a comma separated string. 
+# Blocks are flattened into chunk wide column buffers (chunk_columns.py) rather than a DataFrame per block.
 
 ### Arguments ###
 chunksize = 800  # I've found experimentally that chunk sizes of 800 make the fastest copies into the database. 
@@ -13,13 +25,78 @@ rpc_password = 'bblpassword'
 rpc_url = 'http://127.0.0.1:8332/'
 headers = {'content-type': 'text/plain;'}
 progress_n = 100000  # Prints progress every progess_n blocks
+fetch_workers = 8  # Blocks requested from bitcoind at once. bitcoind only serves rpcthreads (default 4) requests at a time, so raise rpcthreads and rpcworkqueue in bitcoin.conf to match.
+block_batch_size = 10  # getblock calls sent per POST. Early blocks are tiny, so per request overhead dominates without batching. Modern blocks are MBs of JSON each, so don't set this too high.
+raw_blocks = False  # Fetch serialized blocks (getblock verbosity 0) and decode them with raw_block_parser instead of making bitcoind build verbosity 2 JSON.
+blocks_dir = None  # Path to the node's blocks directory (e.g. r"C:\Users\you\AppData\Roaming\Bitcoin\blocks"). If set, blocks are read straight from blk*.dat and the RPC isn't used. Stop the node first.
+resolve_prevouts = False  # Adds the value, type and address of the output each input spends (prevout_* columns), which populate_database uses instead of joining inputs to outputs. JSON mode asks for getblock verbosity 3 (Bitcoin Core 23+). Raw and blk*.dat modes keep a UTXO map (needs lmdb) and should start from height 0.
+intern_txids = False  # Gives every txid a dense integer id in chain order (txid_interner.py, needs numba) and adds tx_id/vin_tx_id columns. Start from height 0, vin_tx_id is null for txids the interner hasn't seen.
+address_keys = True  # Adds canonical BYTEA keys of every output's address (address_key) and input's prevout address (prevout_key), which populate_database normalizes and clusters on. Needs numba. Without them run migrate_canonical_keys.py after loading.
+decode_workers = 0  # Processes that fetch and decode blocks. 0 decodes in this process, which keeps one core busy. Needs pyarrow. Leave a core or two for bitcoind and the writer.
+decode_batch_size = 50  # Blocks fetched and decoded per decode worker task.
+max_attempts = 10  # RPC retries before giving up
+backoff_base = 0.5  # Seconds slept after the first failed attempt, doubled on every retry after that.
+backoff_max = 30
+
+output_format = "csv"  # "csv", "parquet" (zstd compressed) or "arrow" (uncompressed Arrow IPC, memory mappable). The binary formats need pyarrow and store txids as 32 bytes and values as satoshis.
+# "postgres" skips the files and streams every chunk into populate_database's staging tables with binary COPY. Run copy_csvs_to_postgre afterwards (or alongside) to finalize them.
+
+# Only used with output_format = "postgres". Same settings as DB_CONFIG in populate_database.py.
+db_config = {
+    "dbname": "postgres",
+    "user": "NTOVER",
+    "password": "bblpassword",
+    "host": "localhost",
+    "port": "5432"
+}
+pg_connections = 4  # Chunks COPYed into PostgreSQL at once.
+pg_queued_chunks = 2  # Finished chunks allowed to wait for a connection before extraction blocks. Every waiting chunk is held in memory.
 
 # Directory to store CSV output
 csv_output_dir = r"D:\csv_dir"
 
 os.makedirs(csv_output_dir, exist_ok=True)  # Create the directory if it doesn't exist
 
-session = requests.Session()
+# UTXO map for resolve_prevouts in raw and blk*.dat modes. Takes ~10 GB on mainnet (it holds every unspent output's address).
+utxo_map_dir = os.path.join(csv_output_dir, "utxo_map")
+utxo_undo_chunks = 10  # Newest chunks the UTXO map can roll back for a resume or reorg. In postgres mode keep it above pg_queued_chunks + pg_connections.
+# txid -> id table for intern_txids. ~45 GB on mainnet, memory mapped.
+txid_index_dir = os.path.join(csv_output_dir, "txid_index")
+
+# Each fetch thread gets its own session (requests.Session isn't thread safe), so every thread holds one keep-alive connection to bitcoind.
+_thread_state = threading.local()
+
+def get_session():
+    session = getattr(_thread_state, "session", None)
+    if session is None:
+        session = requests.Session()
+        _thread_state.session = session
+    return session
+
+def post_rpc(payload):
+    """
+    POSTs a JSON-RPC payload (a single call or a batch array) and returns the decoded response.
+    """
+    # Sometimes the RPC gets overloaded by rate limits. Repeated attempts with a growing sleep solve that without setting the sleep too high for the common case.
+    for attempt in range(1, max_attempts + 1):
+        try:
+            r = get_session().post(
+                rpc_url,
+                headers=headers,
+                json=payload,
+                auth=(rpc_user, rpc_password)
+            )
+            r.raise_for_status()
+            return r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # This covers ConnectionError, HTTPError, Timeout, etc. and a garbled JSON body.
+            print(f"RPC request error on attempt {attempt}: {e}")
+            if attempt == max_attempts:
+                print(f"Failed {max_attempts} times. Exiting.")
+                raise
+            delay = min(backoff_max, backoff_base * 2 ** (attempt - 1))
+            print(f"Sleeping for {delay} seconds, then retrying...")
+            sleep(delay)
 
 def rpc_request(method, params=[]):
     payload = {
@@ -28,171 +105,329 @@ def rpc_request(method, params=[]):
         "method": method,
         "params": params
     }
-    max_attempts = 10
-    attempt = 1
-    # Sometimes the RPC gets overloaded by rate limits. Repeated attempts can help to solve that without setting the sleep too high. 
-    try:
-        r = session.post(
-            rpc_url,
-            headers=headers,
-            json=payload,
-            auth=(rpc_user, rpc_password)
-        )
-        r.raise_for_status()
-        return r.json()
-    except requests.exceptions.RequestException as e:
-        # This covers ConnectionError, HTTPError, Timeout, etc.
-        print(f"RPC request error on attempt {attempt}: {e}")
-        if attempt < max_attempts:
-            print("Sleeping for 3 seconds, then retrying...")
-            sleep(3)
-            attempt += 1
-        else:
-            print("Failed 10 times. Exiting.")
-            raise  
-    except Exception as e:
-        # Catch any other exceptions
-        print(f"Unexpected error on attempt {attempt}: {e}")
-        if attempt < max_attempts:
-            print("Sleeping for 3 seconds, then retrying...")
-            sleep(3)
-            attempt += 1
-        else:
-            print("Failed 3 times. Exiting.")
-            raise
+    return post_rpc(payload)
 
+def rpc_batch_request(calls):
+    """
+    Sends a list of (method, params) calls as one JSON-RPC batch and returns their results in the same order.
+    bitcoind answers a batch with HTTP 200 even if single calls fail, so those errors are raised here.
+    """
+    if not calls:
+        return []
+    payload = [
+        {"jsonrpc": "1.0", "id": i, "method": method, "params": params}
+        for i, (method, params) in enumerate(calls)
+    ]
+    responses = sorted(post_rpc(payload), key=lambda r: r["id"])  # The JSON-RPC spec lets the server answer a batch in any order.
+    for response in responses:
+        if response.get("error"):
+            method, params = calls[response["id"]]
+            raise RuntimeError(f"RPC {method} {params} failed: {response['error']}")
+    return [response["result"] for response in responses]
 
-# TODO: Merge these two functions into a deeper module.
-def get_vout(block):
+def fetchBlockBatch(blockhashes):
     """
-    From a block JSON, parses the vout information into a DataFrame.
+    Gets the blocks for a list of hashes in one POST. Runs on the fetch threads.
+    In raw_blocks mode each block is {"raw": bytes, "mediantime": int}. The serialized block has no median time, so its header is fetched in the same batch.
     """
-    df = pd.json_normalize(block["tx"], record_path="vout", meta=["txid"], errors="ignore")
-    
-    df = df.rename(columns={
-        "n": "vout_n",
-        "value": "vout_value",
-        "scriptPubKey.desc": "vout_scriptPubKey_desc",
-        "scriptPubKey.address": "vout_scriptPubKey_address",
-        "scriptPubKey.type": "vout_scriptPubKey_type"
-    })
-    
-    columns = [
-        "txid", "vout_n", "vout_value", 
-        "vout_scriptPubKey_desc", "vout_scriptPubKey_address", "vout_scriptPubKey_type"
+    if not raw_blocks:
+        verbosity = 3 if resolve_prevouts else 2
+        return rpc_batch_request([("getblock", [blockhash, verbosity]) for blockhash in blockhashes])
+    calls = []
+    for blockhash in blockhashes:
+        calls.append(("getblock", [blockhash, 0]))
+        calls.append(("getblockheader", [blockhash, True]))
+    results = rpc_batch_request(calls)
+    return [
+        {"raw": bytes.fromhex(raw_hex), "mediantime": header["mediantime"]}
+        for raw_hex, header in zip(results[0::2], results[1::2])
     ]
-    df = df.reindex(columns=columns, fill_value=None)
-    
-    return df
 
-def get_vin(block):
+def blockBatches(heights, batch_size=block_batch_size):
     """
-    Gets vin information from a block and stores it in a DataFrame.
+    Resolves heights to hashes chunksize at a time with one batched getblockhash, then splits them into getblock batches.
     """
-    df = pd.json_normalize(
-        block.get("tx", []),
-        record_path="vin",
-        meta=["txid"],
-        errors="ignore",
-        record_prefix="vin_"
-    )
-    
-    # Rename nested columns
-    rename_map = {
-        "vin_scriptSig.asm": "vin_asm",
-        "vin_txinwitness": "witness_data"
-    }
-    df = df.rename(columns=rename_map)
-    
-    columns = ["txid", "vin_txid", "vin_vout", "vin_asm", "witness_data"]
-    df = df.reindex(columns=columns, fill_value=None)
-    
-    # Convert witness_data from list to a single comma-separated string. Please note that only the 1st item in witness data is the pubkey, but this portion of the code should be robust to changes in the Bitcoin protocol so it gets all.
-    df["witness_data"] = df["witness_data"].apply(
-        lambda x: ", ".join(x) if isinstance(x, list) else None
-    )
-       
-    return df
-
-def get_transactions(block):
-    """
-    Parses the transaction-level data for the block and returns a DataFrame
-    with columns:
-        txid, median_blocktime, miner_time, locktime
-    """
-    rows = []
-    for tx in block['tx']:
-        txid = tx["txid"]
-        # approximate times
-        median_blocktime = block.get("mediantime")
-        miner_time = block.get("time")
-        locktime = tx.get("locktime", None)
-        rows.append({
-            "txid": txid,
-            "median_blocktime": median_blocktime,
-            "miner_time": miner_time,
-            "locktime": locktime
-        })
-    return pd.DataFrame(rows)
-
-def createBlockchainCsv(start_height, end_height, chunk_size=chunksize):
+    heights = iter(heights)
+    while True:
+        group = list(islice(heights, chunksize))
+        if not group:
+            return
+        blockhashes = rpc_batch_request([("getblockhash", [h]) for h in group])
+        for i in range(0, len(group), batch_size):
+            yield group[i:i + batch_size], blockhashes[i:i + batch_size]
+
+def fetchBlocks(heights, workers=fetch_workers, batch_size=block_batch_size):
     """
-    Reads blocks from `start_height` until the chain tip, chunk by chunk,
-    and writes three CSVs per chunk:
-       transactions_chunk_X.csv
-       inputs_chunk_X.csv
-       outputs_chunk_X.csv
+    Yields (height, block) in height order while keeping up to 2 * `workers` getblock batches requested ahead.
+    The extra queued requests make sure a thread never waits on the consumer to hand it more work.
     """
+    batches = blockBatches(heights, batch_size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque((hs, pool.submit(fetchBlockBatch, bh)) for hs, bh in islice(batches, 2 * workers))
+        while pending:
+            batch_heights, future = pending.popleft()
+            blocks = future.result()
+            for hs, bh in islice(batches, 1):
+                pending.append((hs, pool.submit(fetchBlockBatch, bh)))
+            yield from zip(batch_heights, blocks)
+
+
+def writeChunk(chunk_counter, chunk_start, chunk_end, columns):
+    """
+    Writes a chunk's column buffers to the three chunk files in `output_format` and returns their {file name: sha256}.
+    Files are written under a temporary name and renamed into place, so a crash never leaves a partial chunk file.
+    """
+    if output_format not in ("csv", "parquet", "arrow"):
+        raise ValueError(f"Unknown output_format {output_format!r}")
+    tx_path = os.path.join(csv_output_dir, f"transactions_chunk_{chunk_counter}.{output_format}")
+    in_path = os.path.join(csv_output_dir, f"inputs_chunk_{chunk_counter}.{output_format}")
+    out_path = os.path.join(csv_output_dir, f"outputs_chunk_{chunk_counter}.{output_format}")
+    paths = (tx_path, in_path, out_path)
+
+    if output_format == "csv":
+        chunk_transactions_df, chunk_inputs_df, chunk_outputs_df = columns.frames()
+        chunk_transactions_df.to_csv(atomicPath(tx_path), index=False)
+        chunk_inputs_df.to_csv(atomicPath(in_path), index=False)
+        chunk_outputs_df.to_csv(atomicPath(out_path), index=False)
+    else:
+        writeArrowChunk(columns.arrowTables(chunk_start, chunk_end), [atomicPath(path) for path in paths], output_format)
+    files = publishFiles(paths)
     
-    chunk_counter = 1
-    
+    print(f"Saved {output_format} files for chunk #{chunk_counter} (blocks {chunk_start} to {chunk_end}).")
+    return files
+
+def blockHashOf(block, raw):
+    if raw:
+        return sha256d(block["raw"][:80])[::-1].hex()
+    return block["hash"]
+
+def decodeBlock(block, raw, columns):
+    if raw:
+        parseRawBlock(block["raw"], block["mediantime"], columns)
+    else:
+        flattenBlock(block, columns)
+
+def decodedChunks(blocks, start_height, end_height, chunk_size, raw):
+    """
+    Groups an ordered stream of (height, block) into chunks of `chunk_size` blocks and decodes them in this process.
+    `raw` says whether the blocks are serialized {"raw", "mediantime"} blocks or verbosity 2 JSON.
+    Yields (chunk_start, chunk_end, columns, start_hash, end_hash) per chunk.
+    """
     for chunk_start in range(start_height, end_height + 1, chunk_size):
         chunk_end = min(chunk_start + chunk_size - 1, end_height)
         
-        # Create empty dataframes that will hold the entire chunk's data
-        chunk_transactions = []
-        chunk_inputs = []
-        chunk_outputs = []
+        # Buffers that hold the entire chunk's data. Every block is flattened straight into them.
+        columns = ChunkColumns()
         
-        for height in range(chunk_start, chunk_end + 1):
-            blockhash = rpc_request("getblockhash", [height])['result']
-            block = rpc_request("getblock", [blockhash, 2])['result']
-
-            # Collect transactions data
-            tx_df = get_transactions(block)
-            chunk_transactions.append(tx_df)
-
-            # Collect vout (outputs) and vin (inputs)
-            vout_df = get_vout(block)
-            vin_df = get_vin(block)
-
-            chunk_outputs.append(vout_df)
-            chunk_inputs.append(vin_df)
+        for height, block in islice(blocks, chunk_end - chunk_start + 1):
+            decodeBlock(block, raw, columns)
+            if height == chunk_start:
+                start_hash = blockHashOf(block, raw)
+            end_hash = blockHashOf(block, raw)
             
             if height % progress_n == 0:
                 print(f"Processed block height: {height}", "at time:", time())
         
-        chunk_transactions_df = pd.concat(chunk_transactions, ignore_index=True)
-        chunk_inputs_df = pd.concat(chunk_inputs, ignore_index=True)
-        chunk_outputs_df = pd.concat(chunk_outputs, ignore_index=True)
+        yield chunk_start, chunk_end, columns, start_hash, end_hash
 
-        tx_csv_path = os.path.join(csv_output_dir, f"transactions_chunk_{chunk_counter}.csv")
-        in_csv_path = os.path.join(csv_output_dir, f"inputs_chunk_{chunk_counter}.csv")
-        out_csv_path = os.path.join(csv_output_dir, f"outputs_chunk_{chunk_counter}.csv")
-        
-        chunk_transactions_df.to_csv(tx_csv_path, index=False)
-        chunk_inputs_df.to_csv(in_csv_path, index=False)
-        chunk_outputs_df.to_csv(out_csv_path, index=False)
-        
-        print(f"Saved CSVs for chunk #{chunk_counter} (blocks {chunk_start} to {chunk_end}).")
-        
-        chunk_counter += 1
+
+# Decode farm. JSON parsing and flattening are CPU bound and hold the GIL, so with decode_workers > 0 they run in a process pool instead.
+# Each task covers up to decode_batch_size blocks of one chunk. The worker fetches them itself (RPC or blk*.dat), decodes them and hands the Arrow tables back in shared memory.
+# The parent only concatenates the pieces in task order and writes the chunk.
+_worker_blk_files = {}  # blk*.dat files a decode worker has open
+
+def _workerBlkFile(path, xor_key):
+    blk = _worker_blk_files.get(path)
+    if blk is None:
+        blk = _worker_blk_files[path] = BlkFile(path, xor_key)
+    return blk
+
+def _initDecodeWorker():
+    # A forked worker inherits the parent's session, and with it the parent's keep-alive socket to bitcoind.
+    _thread_state.session = None
+
+def decodeTask(task):
+    """
+    Runs in a decode worker. `task` is (heights, None) to fetch the blocks from the RPC, or (heights, (xor_key, [(path, offset, size, mediantime)])) to read them from blk*.dat.
+    Returns (shared memory name, stream sizes, block hashes).
+    """
+    heights, blk_blocks = task
+    if blk_blocks is None:
+        blockhashes = rpc_batch_request([("getblockhash", [h]) for h in heights])
+        blocks = []
+        for i in range(0, len(blockhashes), block_batch_size):
+            blocks += fetchBlockBatch(blockhashes[i:i + block_batch_size])
+        raw = raw_blocks
+    else:
+        xor_key, locations = blk_blocks
+        # Only the files this task needs stay open. A worker sees every blk file eventually, more than the open file limit.
+        for path in set(_worker_blk_files) - {location[0] for location in locations}:
+            _worker_blk_files.pop(path).close()
+        blocks = [
+            {"raw": _workerBlkFile(path, xor_key).read(offset, size), "mediantime": mediantime}
+            for path, offset, size, mediantime in locations
+        ]
+        raw = True
+    columns = ChunkColumns()
+    for block in blocks:
+        decodeBlock(block, raw, columns)
+    name, sizes = tablesToSharedMemory(columns.arrowTables(heights[0], heights[-1]))
+    return name, sizes, [blockHashOf(block, raw) for block in blocks]
+
+def decodeTasks(start_height, end_height, chunk_size, reader=None):
+    """Splits the range into decode tasks that never cross a chunk boundary. `reader` is a BlkFileReader, or None for the RPC."""
+    for chunk_start in range(start_height, end_height + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, end_height)
+        for task_start in range(chunk_start, chunk_end + 1, decode_batch_size):
+            heights = range(task_start, min(task_start + decode_batch_size - 1, chunk_end) + 1)
+            if reader is None:
+                yield heights, None
+            else:
+                yield heights, (reader.xor_key, [reader.blockLocation(h) + (reader.medianTime(h),) for h in heights])
+
+def farmedChunks(tasks, start_height, end_height, chunk_size, workers=decode_workers):
+    """
+    Same chunks as decodedChunks, decoded by `workers` processes. Up to 2 * `workers` tasks are in flight and results are consumed in task order.
+    """
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initDecodeWorker) as pool:
+        pending = deque((heights, pool.submit(decodeTask, (heights, blk))) for heights, blk in islice(tasks, 2 * workers))
+        try:
+            for chunk_start in range(start_height, end_height + 1, chunk_size):
+                chunk_end = min(chunk_start + chunk_size - 1, end_height)
+                chunk = ArrowChunk()
+                hashes = []
+                while len(hashes) < chunk_end - chunk_start + 1:
+                    heights, future = pending.popleft()
+                    name, sizes, block_hashes = future.result()
+                    for next_heights, blk in islice(tasks, 1):
+                        pending.append((next_heights, pool.submit(decodeTask, (next_heights, blk))))
+                    chunk.append(tablesFromSharedMemory(name, sizes))
+                    hashes += block_hashes
+                    if any(height % progress_n == 0 for height in heights):
+                        print(f"Processed block height: {heights[-1]}", "at time:", time())
+                yield chunk_start, chunk_end, chunk, hashes[0], hashes[-1]
+        finally:
+            # Free the shared memory of tasks that finished after an error.
+            for _, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    name, sizes, _ = future.result()
+                    tablesFromSharedMemory(name, sizes)
+
+def writeChunks(chunks, manifest, utxo_map=None, interner=None, canonical_keys=None):
+    """
+    Writes every chunk from decodedChunks or farmedChunks and records it in `manifest`. Every chunk gets a new number from the manifest.
+    With a `utxo_map` the inputs' prevouts are resolved first, in chain order. Likewise an `interner` fills the tx_id columns and `canonical_keys` the key columns.
+    """
+    if output_format == "postgres":
+        writer = PostgresChunkWriter(db_config, pg_connections, pg_queued_chunks, manifest.dropped)
+        try:
+            _writeChunks(chunks, manifest, utxo_map, interner, canonical_keys, writer)
+        finally:
+            writer.close()
+    else:
+        _writeChunks(chunks, manifest, utxo_map, interner, canonical_keys)
+
+def _writeChunks(chunks, manifest, utxo_map, interner, canonical_keys, writer=None):
+    for chunk_start, chunk_end, columns, start_hash, end_hash in chunks:
+        chunk_counter = manifest.nextChunk()
+        if utxo_map is not None:
+            missing = utxo_map.applyChunk(chunk_start, chunk_end, columns)
+            if missing:
+                print(f"{missing} inputs in blocks {chunk_start} to {chunk_end} spend outputs the UTXO map hasn't seen (extraction didn't start at height 0).")
+        if interner is not None:
+            # Saved before the chunk is written. Interning is idempotent, so a chunk redone after a crash or reorg gets its old ids back.
+            columns.internTxids(interner)
+            interner.flush()
+        if canonical_keys is not None:
+            columns.fillAddressKeys(canonical_keys)  # After the UTXO map, which fills the prevout addresses.
+        if writer is not None:
+            if isinstance(columns, ArrowChunk):
+                columns = columns.toColumns()
+            # The chunk only goes into the manifest once its COPY has committed.
+            # Blocks here while the database is pg_queued_chunks chunks behind.
+            writer.submit(chunk_counter, columns, partial(manifest.record, chunk_counter, chunk_start, chunk_end, start_hash, end_hash, output_format, {}))
+            print(f"Queued chunk #{chunk_counter} (blocks {chunk_start} to {chunk_end}) for COPY.")
+        else:
+            files = writeChunk(chunk_counter, chunk_start, chunk_end, columns)
+            manifest.record(chunk_counter, chunk_start, chunk_end, start_hash, end_hash, output_format, files)
+
+def createBlockchainCsv(start_height, end_height, manifest, utxo_map=None, interner=None, canonical_keys=None, chunk_size=chunksize):
+    """
+    Reads blocks from `start_height` until the chain tip, chunk by chunk,
+    and writes three CSVs per chunk:
+       transactions_chunk_X.csv
+       inputs_chunk_X.csv
+       outputs_chunk_X.csv
+    """
+    if decode_workers:
+        chunks = farmedChunks(decodeTasks(start_height, end_height, chunk_size), start_height, end_height, chunk_size)
+    else:
+        # One fetch pipeline for the whole range so it doesn't drain at every chunk boundary.
+        blocks = fetchBlocks(range(start_height, end_height + 1))
+        chunks = decodedChunks(blocks, start_height, end_height, chunk_size, raw_blocks)
+    writeChunks(chunks, manifest, utxo_map, interner, canonical_keys)
+
+def createBlockchainCsvFromBlkFiles(reader, start_height, end_height, manifest, utxo_map=None, interner=None, canonical_keys=None, chunk_size=chunksize):
+    """
+    Same output as createBlockchainCsv, but reads the node's blk*.dat files directly (through a BlkFileReader) instead of asking the RPC.
+    """
+    end_height = min(end_height, len(reader) - 1)
+    if decode_workers:
+        chunks = farmedChunks(decodeTasks(start_height, end_height, chunk_size, reader), start_height, end_height, chunk_size)
+    else:
+        chunks = decodedChunks(reader.iterBlocks(start_height, end_height), start_height, end_height, chunk_size, True)
+    writeChunks(chunks, manifest, utxo_map, interner, canonical_keys)
 
 def main():
-    start_height = int(input("Enter the starting block height: "))
-    end_height = int(input("Enter the ending block height: "))
-    createBlockchainCsv(start_height, end_height)
     signal_path = os.path.join(csv_output_dir, "done.signal")
+    if os.path.exists(signal_path):
+        os.remove(signal_path)  # Left over from an earlier run that finished. The loader must keep waiting for this one.
+    reader = None
+    if blocks_dir:
+        reader = BlkFileReader(blocks_dir)
+        print(f"Indexed {len(reader)} blocks from {blocks_dir}.")
+        block_hash = lambda height: reader.blockHash(height) if height < len(reader) else None
+    else:
+        block_hash = lambda height: rpc_request("getblockhash", [height])["result"]
+    # Verbosity 3 JSON already has the prevouts. Serialized blocks need the UTXO map.
+    utxo_map = UtxoMap(utxo_map_dir, utxo_undo_chunks) if resolve_prevouts and (blocks_dir or raw_blocks) else None
+    interner = None
+    if intern_txids:
+        from txid_interner import TxidInterner  # Imported here so numba is only needed with intern_txids.
+        interner = TxidInterner(txid_index_dir)
+    canonical_keys = None
+    if address_keys:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+        try:
+            from deriveUndefinedAddresses import canonicalKeys as canonical_keys
+        except ImportError as error:
+            if error.name != "numba":
+                raise
+            raise ImportError("address_keys = True needs numba. Install it, or set address_keys = False and run migrate_canonical_keys.py after loading.") from error
+    try:
+        # The manifest knows where an interrupted run stopped, so the starting height is only asked for on a fresh output directory.
+        manifest = ExtractionManifest(csv_output_dir)
+        start_height = manifest.validate(block_hash)
+        if start_height is None:
+            start_height = int(input("Enter the starting block height: "))
+        else:
+            print(f"Resuming from block height {start_height} (chunk #{manifest.last_chunk + 1}).")
+        if utxo_map is not None and (manifest.chunks or utxo_map.height() != -1):
+            # Undoes chunks the map applied but the manifest dropped (a crash before recording them, or a reorg).
+            utxo_map.rollback(start_height - 1)
+        end_height = int(input("Enter the ending block height: "))
+        if reader is not None:
+            createBlockchainCsvFromBlkFiles(reader, start_height, end_height, manifest, utxo_map, interner, canonical_keys)
+        else:
+            createBlockchainCsv(start_height, end_height, manifest, utxo_map, interner, canonical_keys)
+    finally:
+        if reader is not None:
+            reader.close()
+        if utxo_map is not None:
+            utxo_map.close()
+        if interner is not None:
+            interner.close()
     # This writes a file to the path to signal that this script has finished downloading csvs. The function "copy_csvs_to_postgre" relies on this to know when to stop waiting for that file to be filled.
     # Felt this was the most elegant way to signal any other dependencies while minimizing complexity.
     with open(signal_path, "w") as f:
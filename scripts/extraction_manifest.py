@@ -0,0 +1,145 @@
+# Records every finished chunk of extract_bitcoin_data_beta.py so an interrupted run resumes by itself instead of the operator noting down heights.
+# A chunk only counts as finished once it is in the manifest, and its files are renamed into place before that. A crash therefore leaves either a whole chunk or nothing the manifest knows about.
+# Each entry keeps the chunk's first and last block hash, so a restart can tell when the node has reorganized blocks the manifest already covers.
+# Chunk numbers are never handed out twice. A redone chunk gets a new number and the old one is listed as dropped, so loaders delete its rows instead of taking the redone chunk for one they already have.
+import os
+import json
+import hashlib
+import threading
+
+MANIFEST_NAME = "manifest.json"
+
+
+def atomicPath(path):
+    """Temporary name a file is written under before os.replace moves it to `path`. The loader only picks up names ending in the output format, so it never sees a half written file."""
+    return path + ".tmp"
+
+def fileSha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def droppedChunks(output_dir):
+    """
+    The dropped chunk numbers of the manifest in output_dir, read without opening an ExtractionManifest (which cleans up the extractor's temporary files).
+    A loader running next to the extractor deletes these chunks' rows.
+    """
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(path, "r") as f:
+            return set(json.load(f).get("dropped", []))
+    except FileNotFoundError:
+        return set()
+
+def publishFiles(paths):
+    """
+    Moves the files written at atomicPath(path) into place and returns {file name: sha256}. The checksums are taken before the rename, while nothing else can be reading them.
+    """
+    checksums = {}
+    for path in paths:
+        tmp_path = atomicPath(path)
+        checksums[os.path.basename(path)] = fileSha256(tmp_path)
+        os.replace(tmp_path, path)
+    return checksums
+
+class ExtractionManifest:
+    """
+    manifest.json in the output directory: a list of finished chunks, each
+        {"chunk", "start", "end", "start_hash", "end_hash", "output_format", "files": {name: sha256}}
+    plus "last_chunk", the highest chunk number handed out, and "dropped", the numbers of chunks whose data must not be (or no longer be) loaded.
+    The whole file is rewritten through a temporary file and os.replace for every chunk, so it is never half written.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()  # output_format = "postgres" records chunks from the COPY threads
+        self.chunks = []
+        self.dropped = []
+        self.last_chunk = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.chunks = data["chunks"]
+            self.dropped = data.get("dropped", [])
+            self.last_chunk = data.get("last_chunk", 0)
+        self.chunks.sort(key=lambda c: c["start"])
+        self.last_chunk = max([self.last_chunk] + [c["chunk"] for c in self.chunks])
+        for name in os.listdir(output_dir):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(output_dir, name))  # Written by a run that crashed before renaming it.
+
+    def _save(self):
+        tmp_path = atomicPath(self.path)
+        with open(tmp_path, "w") as f:
+            json.dump({"chunks": self.chunks, "last_chunk": self.last_chunk, "dropped": self.dropped}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def record(self, chunk, start, end, start_hash, end_hash, output_format, files):
+        with self._lock:
+            self.chunks = [c for c in self.chunks if c["chunk"] != chunk]
+            self.chunks.append({
+                "chunk": chunk, "start": start, "end": end,
+                "start_hash": start_hash, "end_hash": end_hash,
+                "output_format": output_format, "files": files,
+            })
+            self.chunks.sort(key=lambda c: c["start"])
+            self.last_chunk = max(self.last_chunk, chunk)
+            self._save()
+
+    def _drop(self, chunks, reason):
+        for c in chunks:
+            print(f"Redoing blocks {c['start']} to {c['end']} of chunk #{c['chunk']}: {reason}.")
+            for name in c["files"]:
+                path = os.path.join(self.output_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+        dropped = {c["chunk"] for c in chunks}
+        self.chunks = [c for c in self.chunks if c["chunk"] not in dropped]
+        self.dropped = sorted(set(self.dropped) | dropped)
+
+    def validate(self, block_hash):
+        """
+        Prepares the manifest for resuming and returns the height to continue from (None if there is nothing to resume).
+            Chunks after a gap are dropped. They were finished out of order (COPY threads) after an earlier chunk was lost.
+            The newest remaining chunk must still have its files, with matching checksums, unless they were consumed by the loader.
+            Chunks whose end hash is no longer the node's block at that height were reorganized and are dropped, newest first, until one matches.
+            Chunk numbers handed out but never recorded (a crash before the chunk was finished) are dropped too. A COPY may have committed them.
+        Dropped chunks are listed in `dropped` for the loaders. Their blocks are redone under new chunk numbers.
+        `block_hash(height)` returns the node's current hash at a height.
+        """
+        with self._lock:
+            for i in range(1, len(self.chunks)):
+                if self.chunks[i]["start"] != self.chunks[i - 1]["end"] + 1:
+                    self._drop(self.chunks[i:], "a chunk before it is missing")
+                    break
+            if self.chunks:
+                last = self.chunks[-1]
+                for name, checksum in last["files"].items():
+                    path = os.path.join(self.output_dir, name)
+                    if os.path.exists(path) and fileSha256(path) != checksum:
+                        self._drop([last], f"{name} doesn't match its checksum")
+                        break
+            reorged = []
+            while self.chunks and block_hash(self.chunks[-1]["end"]) != self.chunks[-1]["end_hash"]:
+                reorged.append(self.chunks.pop())
+            if reorged:
+                self.chunks.extend(reorged)
+                self._drop(reorged, "its blocks were reorganized")
+            recorded = {c["chunk"] for c in self.chunks}
+            self.dropped = sorted(set(self.dropped) | (set(range(1, self.last_chunk + 1)) - recorded))
+            self._save()
+            return self.chunks[-1]["end"] + 1 if self.chunks else None
+
+    def nextChunk(self):
+        """
+        Hands out a new chunk number and saves it before anything is written under it, so no number is ever used twice,
+        not even one a crashed or reorged run already wrote or loaded.
+        """
+        with self._lock:
+            self.last_chunk += 1
+            self._save()
+            return self.last_chunk
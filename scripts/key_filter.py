@@ -0,0 +1,101 @@
+# Bloom filter over canonical keys (utils/deriveUndefinedAddresses.canonicalKeys), used to skip normalized hashes that never appear on chain.
+# Most of what fillNormalizedHashes derives is never used: an uncompressed era key has no P2WPKH outputs, a compressed key rarely has uncompressed ones.
+# A Bloom filter has no false negatives, so every derived key that does appear in outputs is still inserted and clustering doesn't change. False positives only cost a row.
+# It is a directory, like txid_interner:
+#   bits.u64:  the bit array, memory mapped, so parallel workers share one copy through the page cache.
+#   meta.json: its number of hash functions and of keys added, so a filter over a table that has grown since can be told apart.
+# Canonical keys are a tag byte and a hash160 or a 32 byte witness program, already uniform, so their bytes are the hashes (double hashing, h1 + i * h2).
+import os
+import json
+import numpy as np
+from numba import njit
+
+_TAG_MIX = np.uint64(0x9E3779B97F4A7C15)  # Separates keys of different types with the same hash
+
+
+@njit(cache=True)
+def _addMany(bits, h1, h2, n_hashes):
+    n_bits = np.uint64(bits.size * 64)
+    for i in range(h1.size):
+        h = h1[i]
+        for _ in range(n_hashes):
+            bit = h % n_bits
+            bits[bit >> np.uint64(6)] |= np.uint64(1) << (bit & np.uint64(63))
+            h += h2[i]
+
+@njit(cache=True)
+def _containsMany(bits, h1, h2, n_hashes, out):
+    n_bits = np.uint64(bits.size * 64)
+    for i in range(h1.size):
+        h = h1[i]
+        found = True
+        for _ in range(n_hashes):
+            bit = h % n_bits
+            if not (bits[bit >> np.uint64(6)] >> (bit & np.uint64(63))) & np.uint64(1):
+                found = False
+                break
+            h += h2[i]
+        out[i] = found
+
+
+def keyHashes(keys):
+    """The two hashes of a list of canonical keys (bytes, at least 17 long) as uint64 arrays."""
+    data = np.frombuffer(b"".join([key[:17] for key in keys]), dtype=np.uint8).reshape(len(keys), 17)
+    words = np.ascontiguousarray(data[:, 1:]).view(np.uint64)
+    h1 = words[:, 0] ^ (data[:, 0].astype(np.uint64) * _TAG_MIX)
+    h2 = words[:, 1] | np.uint64(1)  # Odd, so the probes don't repeat
+    return h1, h2
+
+class KeyFilter:
+    def __init__(self, path, n_keys=None, bits_per_key=10):
+        """
+        Opens the filter at `path`, or creates an empty one sized for `n_keys` if there isn't one.
+        10 bits per key with 7 hash functions is ~1% false positives.
+        """
+        self.path = path
+        self._meta_path = os.path.join(path, "meta.json")
+        self._bits_path = os.path.join(path, "bits.u64")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.n_hashes = meta["n_hashes"]
+            self.n_keys = meta.get("n_keys")  # None for filters saved before it was recorded
+            self.bits = np.memmap(self._bits_path, dtype=np.uint64, mode="r")
+            self.complete = True
+        else:
+            if n_keys is None:
+                raise FileNotFoundError(f"No key filter at {path}.")
+            os.makedirs(path, exist_ok=True)
+            self.n_hashes = max(1, round(bits_per_key * 0.693))  # ln 2 * bits per key minimizes false positives
+            n_words = max(1, (int(n_keys) * bits_per_key + 63) // 64)
+            with open(self._bits_path, "wb") as f:
+                f.truncate(n_words * 8)
+            self.bits = np.memmap(self._bits_path, dtype=np.uint64, mode="r+")
+            self.n_keys = 0
+            self.complete = False
+
+    def add(self, keys):
+        if self.complete:
+            raise ValueError("KeyFilter was already saved.")
+        if keys:
+            _addMany(self.bits, *keyHashes(keys), self.n_hashes)
+            self.n_keys += len(keys)
+
+    def contains(self, keys):
+        """Boolean array, True for keys that may have been added. None is never contained."""
+        out = np.zeros(len(keys), dtype=bool)
+        present = [i for i, key in enumerate(keys) if key is not None]
+        if present:
+            found = np.empty(len(present), dtype=bool)
+            _containsMany(self.bits, *keyHashes([keys[i] for i in present]), self.n_hashes, found)
+            out[present] = found
+        return out
+
+    def save(self):
+        """Writes the bits and then meta.json, which marks the filter as complete. A filter interrupted before this is rebuilt from scratch."""
+        self.bits.flush()
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"n_hashes": self.n_hashes, "n_keys": self.n_keys}, f)
+        os.replace(tmp_path, self._meta_path)
+        self.complete = True
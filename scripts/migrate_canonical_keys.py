@@ -0,0 +1,96 @@
+# One shot conversion of a database loaded before canonical keys (or extracted with address_keys = False) to the canonical key layout:
+#   outputs.address_key and inputs.prevout_key are added and filled,
+#   normalized_hashes (hash TEXT, root_hash TEXT) becomes (hash BYTEA, root_hash BYTEA).
+# Every distinct address string is converted once, in Python, into canonical_key_map. Everything else is set based SQL joining against it.
+# Run it after copy_csvs_to_postgre has finalized the staging tables. If it is interrupted, run it again, it starts over.
+import os
+import sys
+from pg_copy import copyRows
+from populate_database import connect_db
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from deriveUndefinedAddresses import canonicalKeys
+
+batch_size = 1000000  # Distinct addresses converted per COPY
+# Pay to pubkey outputs whose descriptor hasn't been parsed by parsePubkeyDescriptors yet have no address. Their key comes from the descriptor.
+OUTPUT_ADDRESS = "COALESCE(o.address, substring(o.descriptor from '^pk\\(([0-9a-fA-F]+)\\)'))"
+
+
+def columnType(cursor, table, column):
+    cursor.execute("SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s;", (table, column))
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+def buildKeyMap(conn, sources):
+    """Fills canonical_key_map (address TEXT, key BYTEA) with the canonical key of every distinct string the `sources` queries return."""
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS canonical_key_map;")
+        cursor.execute("CREATE UNLOGGED TABLE canonical_key_map (address TEXT, key BYTEA);")
+    conn.commit()
+    converted = 0
+    with conn.cursor(name="distinct_addresses") as reader, conn.cursor() as writer:
+        reader.itersize = batch_size
+        reader.execute(" UNION ".join(sources) + ";")
+        while True:
+            addresses = [address for (address,) in reader.fetchmany(batch_size)]
+            if not addresses:
+                break
+            rows = [(address, key) for address, key in zip(addresses, canonicalKeys(addresses)) if key is not None]
+            copyRows(writer, "canonical_key_map", [("address", "TEXT"), ("key", "BYTEA")], rows)
+            converted += len(addresses)
+            print(f"Converted {converted} distinct addresses.")
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE UNIQUE INDEX ON canonical_key_map (address);")
+        cursor.execute("ANALYZE canonical_key_map;")
+    conn.commit()
+
+def migrateCanonicalKeys():
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('outputs_staging') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            raise RuntimeError("The staging tables haven't been finalized. Finish copy_csvs_to_postgre first.")
+        cursor.execute("SET work_mem = '500MB';")
+        text_hashes = columnType(cursor, "normalized_hashes", "hash") == "text"
+        has_prevouts = columnType(cursor, "inputs", "prevout_address") is not None
+
+    sources = [f"SELECT {OUTPUT_ADDRESS} FROM outputs o WHERE {OUTPUT_ADDRESS} IS NOT NULL"]
+    if has_prevouts:
+        sources.append("SELECT prevout_address FROM inputs WHERE prevout_address IS NOT NULL")
+    if text_hashes:
+        sources += ["SELECT hash FROM normalized_hashes", "SELECT root_hash FROM normalized_hashes"]
+    buildKeyMap(conn, sources)
+
+    with conn.cursor() as cursor:
+        print("Filling outputs.address_key...")
+        cursor.execute("ALTER TABLE outputs ADD COLUMN IF NOT EXISTS address_key BYTEA;")
+        cursor.execute(f"UPDATE outputs o SET address_key = m.key FROM canonical_key_map m WHERE m.address = {OUTPUT_ADDRESS};")
+        if has_prevouts:
+            print("Filling inputs.prevout_key...")
+            cursor.execute("ALTER TABLE inputs ADD COLUMN IF NOT EXISTS prevout_key BYTEA;")
+            cursor.execute("UPDATE inputs i SET prevout_key = m.key FROM canonical_key_map m WHERE m.address = i.prevout_address;")
+        if text_hashes:
+            # Rows whose hash has no canonical key (outpoint placeholders and the like) are dropped.
+            print("Converting normalized_hashes...")
+            cursor.execute("""
+                CREATE TABLE normalized_hashes_keys AS
+                SELECT DISTINCT h.key AS hash, r.key AS root_hash
+                FROM   normalized_hashes nh
+                JOIN   canonical_key_map h ON h.address = nh.hash
+                JOIN   canonical_key_map r ON r.address = nh.root_hash;
+            """)
+            cursor.execute("DROP TABLE normalized_hashes;")
+            cursor.execute("ALTER TABLE normalized_hashes_keys RENAME TO normalized_hashes;")
+            cursor.execute("CREATE INDEX normalized_hashes_hash_idx ON normalized_hashes (hash);")
+        cursor.execute("DROP TABLE canonical_key_map;")
+    conn.commit()
+    conn.autocommit = True  # VACUUM can't run inside a transaction
+    with conn.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE outputs;")
+        if has_prevouts:
+            cursor.execute("VACUUM ANALYZE inputs;")
+    conn.close()
+    print("Migrated to canonical keys.")
+
+
+if __name__ == "__main__":
+    migrateCanonicalKeys()
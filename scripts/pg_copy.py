@@ -0,0 +1,515 @@
+# Shared by extract_bitcoin_data_beta.py and populate_database.py: the staging tables chunks are loaded into, and a PostgreSQL binary COPY encoder.
+# With output_format = "postgres" the extractor streams its chunk buffers straight into the staging tables, so no CSV is written and read back.
+# Binary COPY rows are built with NumPy a slice of rows at a time, which keeps both the Python per field overhead and the memory of a multi GB chunk down.
+# bulkUpdate uses the same COPY to replace row by row UPDATEs with one UPDATE ... FROM a temporary table.
+# Parquet and arrow chunk files are encoded from their Arrow buffers (arrowCopyFields), so loading them doesn't build a Python object per value either.
+# copyIntsOut goes the other way, from a query straight into an int32 file NumPy can memory map. copyIntsIn loads such arrays back.
+import io
+import os
+import struct
+import queue
+import threading
+import numpy as np
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:  # The extractor only needs psycopg2 for output_format = "postgres".
+    psycopg2 = ThreadedConnectionPool = None
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # Only needed to load parquet and arrow chunks.
+    pa = pc = None
+
+# Columns each chunk is copied into, in chunk column order. The extractor's vout_scriptPubKey_* columns become descriptor, address and descriptor_type.
+STAGING_TABLES = {
+    "transactions": "txid TEXT, median_blocktime BIGINT, miner_time BIGINT, locktime BIGINT, tx_id INT",
+    "inputs": "txid TEXT, vin_txid TEXT, vin_vout INT, vin_asm TEXT, witness_data TEXT, prevout_value REAL, prevout_type TEXT, prevout_address TEXT, tx_id INT, vin_tx_id INT, prevout_key BYTEA",
+    "outputs": "txid TEXT, vout_n INT, vout_value REAL, descriptor TEXT, address TEXT, descriptor_type TEXT, tx_id INT, address_key BYTEA",
+}
+# Indexes are built once after everything is loaded. Maintaining them during COPY is most of the cost of a bulk load.
+DEFERRED_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS transactions_txid_idx ON transactions (txid);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS outputs_txid_vout_idx ON outputs (txid, vout_n);",
+    "CREATE INDEX IF NOT EXISTS inputs_vin_idx ON inputs (vin_txid, vin_vout);",
+]
+
+_HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack(">h", -1)
+_BINARY_TYPES = {"int8": ">i8", "int4": ">i4", "float4": ">f4"}
+_SQL_KINDS = {"TEXT": "text", "BYTEA": "bytea", "BIGINT": "int8", "INT": "int4", "REAL": "float4"}  # SQL types copyRows can encode
+rows_per_slice = 16384  # Rows encoded per NumPy pass. Bounds the scatter index arrays to a few hundred MB on witness heavy blocks.
+copy_out_block = 1 << 24  # Bytes of COPY data converted per NumPy pass in copyIntsOut and copyIntsIn
+
+
+def stagingColumns(table):
+    """Names of a staging table's chunk columns, in order."""
+    return [column.split()[0] for column in STAGING_TABLES[table].split(", ")]
+
+def createStagingTables(cursor):
+    """
+    UNLOGGED staging tables skip the WAL, which roughly halves the write volume of the load. They are emptied if the server crashes, so they only become the real tables in populate_database's finalizeStagingTables.
+    loaded_chunks records which chunks are already in, so a restarted load doesn't copy anything twice.
+    Every staging row also gets the number of its chunk, from the staging.chunk setting beginChunk makes, so forgetChunks can take a chunk out again.
+    """
+    for table, columns in STAGING_TABLES.items():
+        cursor.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {table}_staging ({columns});")
+        cursor.execute(f"ALTER TABLE {table}_staging ADD COLUMN IF NOT EXISTS chunk INT DEFAULT NULLIF(current_setting('staging.chunk', true), '')::int;")
+    cursor.execute("CREATE TABLE IF NOT EXISTS loaded_chunks (chunk INT PRIMARY KEY);")
+
+def beginChunk(cursor, chunk):
+    """
+    Claims `chunk` in loaded_chunks for the current transaction and tags the rows COPYed after it with the chunk number.
+    Returns False if the chunk is already loaded. COPY into the staging tables with stagingColumns, so the chunk column gets its default.
+    """
+    cursor.execute("INSERT INTO loaded_chunks (chunk) VALUES (%s) ON CONFLICT DO NOTHING;", (chunk,))
+    if cursor.rowcount != 1:
+        return False
+    cursor.execute("SELECT set_config('staging.chunk', %s, true);", (str(chunk),))
+    return True
+
+def forgetChunks(cursor, chunks):
+    """
+    Deletes the rows of chunks the extraction manifest dropped (reorganized, corrupt or never recorded) from the staging tables and loaded_chunks.
+    Their blocks come again under new chunk numbers. Returns the dropped chunks that were loaded but aren't in staging anymore:
+    finalizeStagingTables already moved them into the real tables, where they can't be told apart.
+    """
+    cursor.execute("SELECT chunk FROM loaded_chunks WHERE chunk = ANY(%s);", (sorted(chunks),))
+    loaded = sorted(chunk for (chunk,) in cursor.fetchall())
+    if not loaded:
+        return []
+    staged = set()
+    for table in STAGING_TABLES:
+        cursor.execute(f"WITH deleted AS (DELETE FROM {table}_staging WHERE chunk = ANY(%s) RETURNING chunk) SELECT DISTINCT chunk FROM deleted;", (loaded,))
+        staged.update(chunk for (chunk,) in cursor.fetchall())
+    cursor.execute("DELETE FROM loaded_chunks WHERE chunk = ANY(%s);", (loaded,))
+    return [chunk for chunk in loaded if chunk not in staged]
+
+def _put(out, positions, values):
+    """Writes one fixed width big endian value per row at the given byte positions."""
+    width = values.dtype.itemsize
+    out[positions[:, None] + np.arange(width)] = values.view(np.uint8).reshape(-1, width)
+
+def _fieldPieces(kind, values, start, stop):
+    """
+    Returns (field length, data length, data bytes) for rows [start, stop) of one column. A field length of -1 is NULL.
+    Text columns are lists of str/None, bytea columns lists of bytes/None, or either one as Arrow style (offsets, data, null mask) arrays.
+    Numeric columns are (array, null mask or None).
+    """
+    if (kind == "text" or kind == "bytea") and isinstance(values, tuple):
+        offsets, data, nulls = values
+        data_len = offsets[start + 1:stop + 1] - offsets[start:stop]
+        blob = data[offsets[start]:offsets[stop]]
+        nulls = nulls[start:stop]
+        if nulls.any():
+            blob = blob[np.repeat(~nulls, data_len)]  # Arrow doesn't promise null values are empty
+            data_len = np.where(nulls, 0, data_len)
+        return np.where(nulls, -1, data_len), data_len, blob
+    if kind == "text" or kind == "bytea":
+        encode = str.encode if kind == "text" else bytes
+        encoded = [encode(v) if v is not None else b"" for v in values[start:stop]]
+        data_len = np.fromiter(map(len, encoded), dtype=np.int64, count=stop - start)
+        nulls = np.fromiter((v is None for v in values[start:stop]), dtype=bool, count=stop - start)
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return np.where(nulls, -1, data_len), data_len, blob
+    array, nulls = values
+    array = array[start:stop]
+    width = np.dtype(_BINARY_TYPES[kind]).itemsize
+    if nulls is None:
+        blob = array.astype(_BINARY_TYPES[kind]).view(np.uint8)
+        return np.full(stop - start, width), np.full(stop - start, width), blob
+    nulls = nulls[start:stop]
+    blob = array[~nulls].astype(_BINARY_TYPES[kind]).view(np.uint8)
+    data_len = np.where(nulls, 0, width)
+    return np.where(nulls, -1, width), data_len, blob
+
+def encodeBinaryRows(fields, start, stop):
+    """
+    Encodes rows [start, stop) in PostgreSQL's binary COPY tuple format: an int16 field count, then an int32 length and the data for every field.
+    `fields` is a list of (kind, values) with kind in "int8", "int4", "float4", "text" or "bytea". See _fieldPieces for the values.
+    """
+    n = stop - start
+    pieces = [_fieldPieces(kind, values, start, stop) for kind, values in fields]
+    row_len = 2 + sum(4 + data_len for _, data_len, _ in pieces)
+    row_start = np.zeros(n, dtype=np.int64)
+    np.cumsum(row_len[:-1], out=row_start[1:])
+    out = np.empty(int(row_len.sum()), dtype=np.uint8)
+    _put(out, row_start, np.full(n, len(fields), dtype=">i2"))
+    pos = row_start + 2
+    for field_len, data_len, blob in pieces:
+        _put(out, pos, field_len.astype(">i4"))
+        pos = pos + 4
+        if blob.size:
+            has = data_len > 0
+            lens = data_len[has]
+            blob_start = np.zeros(lens.size, dtype=np.int64)
+            np.cumsum(lens[:-1], out=blob_start[1:])
+            # Byte k of the blob belongs to some row r and goes to pos[r] + (k - blob_start[r]).
+            out[np.repeat(pos[has] - blob_start, lens) + np.arange(blob.size)] = blob
+        pos = pos + data_len
+    return out
+
+def binaryCopyChunks(fields, n_rows):
+    """Yields a whole binary COPY stream (header, tuples, trailer) in pieces of rows_per_slice rows."""
+    yield _PGCOPY_HEADER
+    for start in range(0, n_rows, rows_per_slice):
+        yield encodeBinaryRows(fields, start, min(start + rows_per_slice, n_rows)).tobytes()
+    yield _PGCOPY_TRAILER
+
+class _StreamReader(io.RawIOBase):
+    """File like wrapper over a generator of bytes, so copy_expert can stream a COPY without the whole payload in memory."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b""
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+def chunkCopyFields(columns):
+    """
+    Maps a chunk_columns.ChunkColumns to the binary COPY fields of the three staging tables, as {table: (fields, n_rows)}.
+    """
+    def ids(values, n):
+        if values is None:
+            return np.zeros(n, dtype=np.int64), np.ones(n, dtype=bool)
+        return values, values < 0
+    def keys(values, n):
+        return [None] * n if values is None else values
+    vin_vout = np.frombuffer(columns.in_vin_vout, dtype=np.int64)
+    prevout_value = np.frombuffer(columns.in_prevout_value_sats, dtype=np.int64)
+    return {
+        "transactions": ([
+            ("text", columns.tx_txid),
+            ("int8", (np.frombuffer(columns.tx_median_blocktime, dtype=np.int64), None)),
+            ("int8", (np.frombuffer(columns.tx_miner_time, dtype=np.int64), None)),
+            ("int8", (np.frombuffer(columns.tx_locktime, dtype=np.int64), None)),
+            ("int4", ids(columns.tx_id, len(columns.tx_txid))),
+        ], len(columns.tx_txid)),
+        "inputs": ([
+            ("text", columns.in_txid),
+            ("text", columns.in_vin_txid),
+            ("int4", (vin_vout, vin_vout < 0)),
+            ("text", columns.in_vin_asm),
+            ("text", columns.in_witness_data),
+            ("float4", (prevout_value / 1e8, prevout_value < 0)),
+            ("text", columns.in_prevout_type),
+            ("text", columns.in_prevout_address),
+            ("int4", ids(columns.in_tx_id, len(columns.in_txid))),
+            ("int4", ids(columns.in_vin_tx_id, len(columns.in_txid))),
+            ("bytea", keys(columns.in_prevout_key, len(columns.in_txid))),
+        ], len(columns.in_txid)),
+        "outputs": ([
+            ("text", columns.out_txid),
+            ("int4", (np.frombuffer(columns.out_vout_n, dtype=np.int64), None)),
+            ("float4", (np.frombuffer(columns.out_value_sats, dtype=np.int64) / 1e8, None)),
+            ("text", columns.out_desc),
+            ("text", columns.out_address),
+            ("text", columns.out_type),
+            ("int4", ids(columns.out_tx_id, len(columns.out_txid))),
+            ("bytea", keys(columns.out_address_key, len(columns.out_txid))),
+        ], len(columns.out_txid)),
+    }
+
+def _arrowNulls(array):
+    if array.null_count == 0:
+        return np.zeros(len(array), dtype=bool)
+    return array.is_null().to_numpy(zero_copy_only=False)
+
+def _arrowNumbers(column, scale=None):
+    """A numeric Arrow column as (array, null mask or None). `scale` divides it (satoshis to BTC)."""
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    if pa.types.is_null(array.type):
+        return np.zeros(len(array), dtype=np.int64), np.ones(len(array), dtype=bool)
+    nulls = _arrowNulls(array) if array.null_count else None
+    values = (pc.fill_null(array, 0) if nulls is not None else array).to_numpy(zero_copy_only=False)
+    return (values / scale if scale else values), nulls
+
+def _arrowBytes(column):
+    """
+    A string, binary or dictionary encoded Arrow column as (offsets, data, null mask) over its own buffers, without a Python object per value.
+    32 byte txids become the 64 hex digits the text columns hold.
+    """
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    n = len(array)
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if pa.types.is_null(array.type):
+        return np.zeros(n + 1, dtype=np.int64), np.empty(0, dtype=np.uint8), np.ones(n, dtype=bool)
+    nulls = _arrowNulls(array)
+    if pa.types.is_fixed_size_binary(array.type):
+        width = array.type.byte_width
+        raw = np.frombuffer(array.buffers()[1], dtype=np.uint8)[array.offset * width:(array.offset + n) * width].reshape(n, width)
+        digits = np.empty((n, 2 * width), dtype=np.uint8)
+        digits[:, 0::2] = _HEX_DIGITS[raw >> 4]
+        digits[:, 1::2] = _HEX_DIGITS[raw & 15]
+        return np.arange(n + 1, dtype=np.int64) * (2 * width), digits.reshape(-1), nulls
+    if array.type not in (pa.string(), pa.binary(), pa.large_string(), pa.large_binary()):
+        array = array.cast(pa.large_string() if pa.types.is_string(array.type) else pa.large_binary())
+    offset_type = np.int64 if array.type in (pa.large_string(), pa.large_binary()) else np.int32
+    _, offset_buffer, data_buffer = array.buffers()
+    offsets = np.frombuffer(offset_buffer, dtype=offset_type)[array.offset:array.offset + n + 1].astype(np.int64)
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.empty(0, dtype=np.uint8)
+    return offsets, data, nulls
+
+def arrowCopyFields(table, chunk):
+    """
+    Maps one chunk_columns.readArrowChunk table of the staging table `table` to its binary COPY fields, as (fields, n_rows) like chunkCopyFields.
+    Txids go back to hex text, dictionary encoded script types are decoded and satoshis become the REAL BTC values the CSVs have.
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required to load parquet and arrow chunks.")
+    column = chunk.column
+    if table == "transactions":
+        fields = [
+            ("text", _arrowBytes(column("txid"))),
+            ("int8", _arrowNumbers(column("median_blocktime"))),
+            ("int8", _arrowNumbers(column("miner_time"))),
+            ("int8", _arrowNumbers(column("locktime"))),
+            ("int4", _arrowNumbers(column("tx_id"))),
+        ]
+    elif table == "inputs":
+        fields = [
+            ("text", _arrowBytes(column("txid"))),
+            ("text", _arrowBytes(column("vin_txid"))),
+            ("int4", _arrowNumbers(column("vin_vout"))),
+            ("text", _arrowBytes(column("vin_asm"))),
+            ("text", _arrowBytes(column("witness_data"))),
+            ("float4", _arrowNumbers(column("prevout_value"), 1e8)),
+            ("text", _arrowBytes(column("prevout_type"))),
+            ("text", _arrowBytes(column("prevout_address"))),
+            ("int4", _arrowNumbers(column("tx_id"))),
+            ("int4", _arrowNumbers(column("vin_tx_id"))),
+            ("bytea", _arrowBytes(column("prevout_key"))),
+        ]
+    else:
+        fields = [
+            ("text", _arrowBytes(column("txid"))),
+            ("int4", _arrowNumbers(column("vout_n"))),
+            ("float4", _arrowNumbers(column("vout_value"), 1e8)),
+            ("text", _arrowBytes(column("vout_scriptPubKey_desc"))),
+            ("text", _arrowBytes(column("vout_scriptPubKey_address"))),
+            ("text", _arrowBytes(column("vout_scriptPubKey_type"))),
+            ("int4", _arrowNumbers(column("tx_id"))),
+            ("bytea", _arrowBytes(column("address_key"))),
+        ]
+    return fields, chunk.num_rows
+
+def copyStagingFields(cursor, table, fields, n_rows):
+    """Binary COPYs chunkCopyFields' or arrowCopyFields' fields into {table}_staging. Call beginChunk first so the rows get their chunk number."""
+    stream = io.BufferedReader(_StreamReader(binaryCopyChunks(fields, n_rows)), buffer_size=1 << 20)
+    cursor.copy_expert(f"COPY {table}_staging ({', '.join(stagingColumns(table))}) FROM STDIN WITH (FORMAT binary);", stream)
+
+def copyRows(cursor, table, columns, rows):
+    """
+    Binary COPYs a list of row tuples into `table`. `columns` is a list of (name, SQL type) in row order, with types in _SQL_KINDS. None is NULL.
+    """
+    fields = []
+    for i, (_, sql_type) in enumerate(columns):
+        kind = _SQL_KINDS[sql_type]
+        values = [row[i] for row in rows]
+        if kind not in ("text", "bytea"):
+            nulls = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+            array = np.array([0 if v is None else v for v in values], dtype=np.float64 if kind == "float4" else np.int64)
+            values = (array, nulls if nulls.any() else None)
+        fields.append((kind, values))
+    names = ", ".join(name for name, _ in columns)
+    stream = io.BufferedReader(_StreamReader(binaryCopyChunks(fields, len(rows))), buffer_size=1 << 20)
+    cursor.copy_expert(f"COPY {table} ({names}) FROM STDIN WITH (FORMAT binary);", stream)
+
+def applyUpdate(cursor, table, source, key_columns, assignments):
+    """
+    Applies a whole table of changes with one UPDATE ... FROM, matching `source` (aliased s) to `table` on `key_columns`.
+    `assignments` maps each column to set to an SQL expression over s. Returns the number of rows updated.
+    """
+    set_clause = ", ".join(f"{column} = {expression}" for column, expression in assignments.items())
+    where_clause = " AND ".join(f"t.{column} = s.{column}" for column in key_columns)
+    cursor.execute(f"UPDATE {table} t SET {set_clause} FROM {source} s WHERE {where_clause};")
+    return cursor.rowcount
+
+def _stageRows(cursor, source, columns, rows):
+    """COPYs rows into the temporary table `source`, created on first use and emptied on every call."""
+    definition = ", ".join(f"{name} {sql_type}" for name, sql_type in columns)
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {source} ({definition}) ON COMMIT DELETE ROWS;")
+    cursor.execute(f"TRUNCATE {source};")
+    copyRows(cursor, source, columns, rows)
+    cursor.execute(f"ANALYZE {source};")  # Temp tables have no statistics otherwise and the planner guesses badly.
+
+def bulkUpdate(cursor, table, columns, rows, key_columns):
+    """
+    Set based replacement for executemany("UPDATE ... WHERE key = %s"): the rows are COPYed into a temporary table and applied with one UPDATE ... FROM.
+    `columns` is a list of (name, SQL type) in row order. Columns not in `key_columns` are set from the matching row.
+    Runs inside the caller's transaction, so it can be committed together with whatever locked the rows. Returns the number of rows updated.
+    """
+    source = f"{table}_bulk_update"
+    _stageRows(cursor, source, columns, rows)
+    assignments = {name: f"s.{name}" for name, _ in columns if name not in key_columns}
+    return applyUpdate(cursor, table, source, key_columns, assignments)
+
+def bulkInsert(cursor, table, columns, rows):
+    """
+    Same idea as bulkUpdate for execute_values("INSERT ... ON CONFLICT DO NOTHING"): COPY into a temporary table, then one INSERT ... SELECT. Returns the number of rows inserted.
+    """
+    source = f"{table}_bulk_insert"
+    _stageRows(cursor, source, columns, rows)
+    names = ", ".join(name for name, _ in columns)
+    cursor.execute(f"INSERT INTO {table} ({names}) SELECT {names} FROM {source} ON CONFLICT DO NOTHING;")
+    return cursor.rowcount
+
+def _intRowDtype(n_columns):
+    """A binary COPY tuple of n_columns non null INTs as a NumPy record."""
+    return np.dtype([("n_fields", ">i2")] + [(f"{name}{i}", ">i4") for i in range(n_columns) for name in ("length", "value")])
+
+def copyIntsIn(cursor, table, names, values):
+    """
+    Binary COPYs an (n, len(names)) integer array into the INT columns `names` of `table`. The inverse of copyIntsOut.
+    Each block of rows is one NumPy record array, so there is no work per row or field.
+    """
+    values = np.asarray(values)
+    if values.size and (values.min() < -2 ** 31 or values.max() >= 2 ** 31):
+        raise ValueError("copyIntsIn values don't fit in INT.")
+    row_dtype = _intRowDtype(len(names))
+    step = max(1, copy_out_block // row_dtype.itemsize)
+
+    def chunks():
+        yield _PGCOPY_HEADER
+        for start in range(0, len(values), step):
+            block = values[start:start + step]
+            records = np.empty(len(block), dtype=row_dtype)
+            records["n_fields"] = len(names)
+            for i in range(len(names)):
+                records[f"length{i}"] = 4
+                records[f"value{i}"] = block[:, i]
+            yield records.tobytes()
+        yield _PGCOPY_TRAILER
+    stream = io.BufferedReader(_StreamReader(chunks()), buffer_size=1 << 20)
+    cursor.copy_expert(f"COPY {table} ({', '.join(names)}) FROM STDIN WITH (FORMAT binary);", stream)
+
+def copyIntsOut(cursor, query, n_columns, path):
+    """
+    Binary COPYs the result of `query`, `n_columns` non null INT columns, into a raw int32 file at `path`, row after row. Returns the number of rows.
+    Read it back with np.memmap(path, dtype=np.int32).reshape(-1, n_columns).
+    The COPY goes into a pipe and a thread converts whole blocks of it with NumPy, so there is no Python work per row and the result is never all in memory.
+    """
+    row_dtype = _intRowDtype(n_columns)
+    read_fd, write_fd = os.pipe()
+    rows = [0]
+    errors = []
+
+    def convert():
+        try:
+            with os.fdopen(read_fd, "rb") as stream, open(path, "wb") as out:
+                if stream.read(len(_PGCOPY_HEADER)) != _PGCOPY_HEADER:
+                    raise ValueError("Unexpected binary COPY header.")
+                pending = b""
+                while True:
+                    block = stream.read(copy_out_block)
+                    if not block:
+                        break
+                    data = pending + block
+                    n = len(data) // row_dtype.itemsize
+                    records = np.frombuffer(data, dtype=row_dtype, count=n)
+                    pending = data[n * row_dtype.itemsize:]
+                    # The trailer is shorter than a row, so it is always left in pending.
+                    if (records["n_fields"] != n_columns).any() or any((records[f"length{i}"] != 4).any() for i in range(n_columns)):
+                        raise ValueError("copyIntsOut only takes queries of non null INT columns.")
+                    np.stack([records[f"value{i}"] for i in range(n_columns)], axis=1).astype("<i4").tofile(out)
+                    rows[0] += n
+                if pending != _PGCOPY_TRAILER:
+                    raise ValueError("Binary COPY didn't end on a row boundary. copyIntsOut only takes queries of non null INT columns.")
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=convert, daemon=True)
+    thread.start()
+    try:
+        with os.fdopen(write_fd, "wb", buffering=copy_out_block) as stream:
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary);", stream)
+    except BrokenPipeError:
+        pass  # The converter stopped early. Its error is raised below.
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return rows[0]
+
+class PostgresChunkWriter:
+    """
+    Streams chunks into the staging tables over a pool of connections, one COPY transaction per chunk.
+    The queue in front of the connections is bounded, so submit() blocks and extraction slows down whenever the database falls behind.
+    """
+    def __init__(self, db_config, connections=4, max_queued_chunks=4, dropped_chunks=()):
+        """`dropped_chunks` (the manifest's) are taken out of the staging tables before anything is copied."""
+        if psycopg2 is None:
+            raise ImportError("psycopg2 is required for output_format = 'postgres'.")
+        self._pool = ThreadedConnectionPool(1, connections, **db_config)
+        conn = self._pool.getconn()
+        with conn.cursor() as cursor:
+            createStagingTables(cursor)
+            for chunk in forgetChunks(cursor, dropped_chunks):
+                print(f"Chunk #{chunk} was dropped after its tables were finalized. The database still holds its old version.")
+        conn.commit()
+        self._pool.putconn(conn)
+        self._queue = queue.Queue(maxsize=max_queued_chunks)
+        self._errors = []
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(connections)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            chunk, columns, on_done = item
+            try:
+                self._copyChunk(chunk, columns)
+                if on_done is not None:
+                    on_done()
+            except Exception as e:
+                print(f"COPY of chunk #{chunk} failed: {e}")
+                self._errors.append(e)
+
+    def _copyChunk(self, chunk, columns):
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                if beginChunk(cursor, chunk):
+                    for table, (fields, n_rows) in chunkCopyFields(columns).items():
+                        copyStagingFields(cursor, table, fields, n_rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn)
+
+    def submit(self, chunk, columns, on_done=None):
+        """
+        Queues a chunk. Blocks while max_queued_chunks chunks are already waiting.
+        `on_done` is called from a COPY thread once the chunk has committed.
+        """
+        if self._errors:
+            raise self._errors[0]
+        self._queue.put((chunk, columns, on_done))
+
+    def close(self):
+        """Waits for every queued chunk to be copied."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._pool.closeall()
+        if self._errors:
+            raise self._errors[0]
@@ -1,11 +1,20 @@
 ##############################################
 import os
+import sys
+import shutil
 import psycopg2
 import bitcoinlib
 import re
-from time import sleep
+import numpy as np
+from time import sleep, perf_counter
 from multiprocessing import Pool
-from psycopg2.extras import execute_values
+from pg_copy import STAGING_TABLES, DEFERRED_INDEXES, createStagingTables, stagingColumns, beginChunk, forgetChunks, arrowCopyFields, copyStagingFields, applyUpdate, bulkUpdate, bulkInsert, copyIntsOut, copyIntsIn
+from key_filter import KeyFilter
+from autotune import systemResources, tuneSettings, applySession, ChunkSizer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from deriveUndefinedAddresses import deriveKeyBatch
+from cscUnionFind import UnionFindState
+from extraction_manifest import droppedChunks
 ############################################
 # Configure settings
 DB_CONFIG = {
@@ -18,10 +27,29 @@ DB_CONFIG = {
 
 CSV_DIR = r"D:\csv_dir"
 delete_copied = True
+log_loaded_tables = True # SET LOGGED once the load is finished. It writes every table to the WAL once more, but unlogged tables are emptied if the server crashes.
 signal_path = os.path.join(CSV_DIR, "done.signal") # This file is produced by extract_bitcoin_data when it finishes downloading csvs.
+autotune = True # Replaces the sizes below with ones for this machine's RAM, cores and disk (autotune.py). They are sized for 20 GB of free RAM.
 chunk_size_psqlwork = 65000
-chunk_size_pythonwork = 25000
+chunk_size_pythonwork = 25000 # Starting size. parsePubkeyDescriptors' workers adjust it as they go.
 ncores = 8
+worker_rss_limit = None # Memory a Python worker may grow to before it shrinks its chunks
+temp_buffers = "11GB"
+rewrite_budget = None # Most bytes trimDB copies per transaction. Autotune sets it from the free disk, None leaves it to trim_batch_pages.
+trim_batch_pages = 1 << 19 # 8 kB pages trimDB copies per transaction (4 GB). A crash loses at most one batch.
+tuned_settings = None # What applyAutotune set, handed to the workers of workerPool
+SESSION_SETTINGS = {
+    "python": {"max_parallel_workers": 4, "max_parallel_workers_per_gather": 2, "maintenance_work_mem": "500MB", "work_mem": "128MB"},
+    "psql": {"max_parallel_workers": 8, "max_parallel_workers_per_gather": 4, "maintenance_work_mem": "1GB", "work_mem": "256MB"},
+}
+normalization_buckets = 4096 # Hash buckets fillNormalizedHashes' pubkeys are split into. Each one is a checkpoint, so smaller buckets lose less work to a crash.
+prune_normalized_hashes = True # Only insert derived hashes that appear in outputs, checked against a Bloom filter of outputs.address_key. Clustering is unchanged and normalized_hashes is a fraction of the size.
+key_filter_dir = os.path.join(CSV_DIR, "key_filter")
+key_filter_bits_per_key = 10 # ~1% of derived hashes that never appear on chain get through. The filter takes this many bits per output.
+spend_edges_path = os.path.join(CSV_DIR, "spend_edges.i32") # exportSpendEdges' (spending transaction, wallet_id) pairs for utils/cscUnionFind
+union_find_dir = os.path.join(CSV_DIR, "union_find") # commonSpendCluster's union find state (utils/cscUnionFind.UnionFindState), kept between runs
+incremental_clustering = True # Only cluster the transactions since the last run and update the cs_clusters rows that changed. Needs interned txids.
+union_find_chunk_rows = 1 << 24 # Spend edges the union find reads at a time (128 MB)
 ############################################
 # Dependencies..
 def deriveUndefinedAddresses(pubkey, assume_multisig_owned = True, n_childkeys = 2):
@@ -105,37 +133,185 @@ def parseDesc(descriptor: str):
     matches = key_pattern.findall(descriptor)
     return [key for (_, key) in matches]
 
+def applyAutotune():
+    '''
+    Sizes ncores, the chunk sizes and the SESSION_SETTINGS for the memory, cores and disk this machine has free right now. Call it before starting any pool, and start pools with workerPool().
+    '''
+    global tuned_settings
+    resources = systemResources(CSV_DIR)
+    settings = tuneSettings(resources)
+    tuned_settings = settings
+    applyTunedSettings(settings)
+    print(f"Tuned for {resources['available_ram'] / 2**30:.1f} GB of free RAM and {resources['cores']} cores: "
+          f"{ncores} workers, chunks of {chunk_size_pythonwork} rows, work_mem {settings['psql']['work_mem']} for SQL stages.")
+
+def applyTunedSettings(settings):
+    '''
+    Sets tuneSettings' `settings` as this module's sizes. Also the initializer of workerPool's workers: spawned workers (Windows) import the module again
+    and would otherwise have its defaults, not the tuned sizes and session settings of the parent.
+    '''
+    global ncores, chunk_size_pythonwork, chunk_size_psqlwork, worker_rss_limit, temp_buffers, rewrite_budget
+    if settings is None:
+        return
+    ncores = settings["ncores"]
+    chunk_size_pythonwork = settings["chunk_size_pythonwork"]
+    chunk_size_psqlwork = settings["chunk_size_psqlwork"]
+    worker_rss_limit = settings["worker_rss_limit"]
+    temp_buffers = settings["temp_buffers"]
+    rewrite_budget = settings["rewrite_budget"]
+    SESSION_SETTINGS["python"] = settings["python"]
+    SESSION_SETTINGS["psql"] = settings["psql"]
+
+def workerPool():
+    """A Pool of ncores workers that use the same settings as this process, tuned or not."""
+    return Pool(ncores, initializer = applyTunedSettings, initargs = (tuned_settings,))
+
 def tuneDB_for_python_processing(cursor, conn):
     '''
     Gives the postgresql server less memory and cpu to prioritize in python processing.
     '''
-    cursor.execute("SET max_parallel_workers = 4;") 
-    cursor.execute("SET max_parallel_workers_per_gather = 2;")
-    cursor.execute("SET maintenance_work_mem = '500MB';")
-    cursor.execute("SET work_mem = '128MB'; ")
+    applySession(cursor, SESSION_SETTINGS["python"])
     conn.commit()
 def tuneDB_for_psql_processing(cursor, conn):
-    cursor.execute("SET max_parallel_workers = 8;") 
-    cursor.execute("SET max_parallel_workers_per_gather = 4;")
-    cursor.execute("SET maintenance_work_mem = '1GB';")
-    cursor.execute("SET work_mem = '256MB'; ")
+    applySession(cursor, SESSION_SETTINGS["psql"])
     conn.commit()
 
 
 # -*- coding: utf-8 -*-
-def copy_csvs_to_postgre():
-    print("skipping :P")
+_worker_conn = None
+
+def chunkPaths(chunk, chunk_format = "csv"):
+    return {table: os.path.join(CSV_DIR, f"{table}_chunk_{chunk}.{chunk_format}") for table in STAGING_TABLES}
+
+def readyChunks(extraction_done, dropped = ()):
+    """
+    (chunk number, output format) of every chunk whose files are finished, in any of the extractor's file formats (csv, parquet or arrow).
+    The extractor writes chunks in order, so a chunk is finished once a later chunk has started or done.signal exists.
+    Numbers can be skipped (the manifest's dropped chunks), so any later chunk counts, not just the next one.
+    """
+    chunks = {}
+    for name in os.listdir(CSV_DIR):
+        match = re.fullmatch(r"transactions_chunk_(\d+)\.(csv|parquet|arrow)", name)
+        if match:
+            chunks[int(match.group(1))] = match.group(2)
+    ready = []
+    last = max(chunks, default = 0)
+    for chunk in sorted(set(chunks) - set(dropped)):
+        finished = extraction_done or chunk < last
+        if finished and all(os.path.exists(path) for path in chunkPaths(chunk, chunks[chunk]).values()):
+            ready.append((chunk, chunks[chunk]))
+    return ready
+
+def copyChunk(chunk, chunk_format = "csv"):
+    """
+    COPYs one chunk's three files into the staging tables in a single transaction, together with its loaded_chunks row. Parallel friendly, each worker process keeps its own connection.
+    CSVs are COPYed as they are. Parquet and arrow files are read with chunk_columns.readArrowChunk (arrow files memory mapped) and binary COPYed from their Arrow buffers.
+    """
+    global _worker_conn
+    if _worker_conn is None:
+        _worker_conn = connect_db()
+    conn = _worker_conn
+    paths = chunkPaths(chunk, chunk_format)
+    with conn.cursor() as cursor:
+        if beginChunk(cursor, chunk):
+            for table, path in paths.items():
+                if chunk_format == "csv":
+                    with open(path, "r", encoding="utf-8") as f:
+                        cursor.copy_expert(f"COPY {table}_staging ({', '.join(stagingColumns(table))}) FROM STDIN WITH (FORMAT csv, HEADER true);", f)
+                else:
+                    from chunk_columns import readArrowChunk  # Imported here so pyarrow is only needed for parquet and arrow chunks.
+                    arrow_table, _ = readArrowChunk(path)
+                    copyStagingFields(cursor, table, *arrowCopyFields(table, arrow_table))
+                    del arrow_table  # Unmaps the file, so it can be deleted below.
+    conn.commit()
+    if delete_copied:
+        for path in paths.values():
+            os.remove(path)
+    return chunk
+
+def finalizeStagingTables(cursor, conn):
+    """
+    Turns the staging tables into the real tables and builds the indexes that were deferred during the load.
+    """
+    tuneDB_for_psql_processing(cursor, conn)
+    for table in STAGING_TABLES:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+        if cursor.fetchone()[0]:
+            # Appending to an earlier load. Only the columns the table still has: trimDB drops some, and later stages add some.
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s;", (table,))
+            existing = {column for (column,) in cursor.fetchall()}
+            columns = ", ".join(column for column in stagingColumns(table) if column in existing)
+            cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_staging;")
+            cursor.execute(f"DROP TABLE {table}_staging;")
+        else:
+            cursor.execute(f"ALTER TABLE {table}_staging DROP COLUMN chunk;")
+            if log_loaded_tables:
+                cursor.execute(f"ALTER TABLE {table}_staging SET LOGGED;")
+            cursor.execute(f"ALTER TABLE {table}_staging RENAME TO {table};")
+        conn.commit()
+    for statement in DEFERRED_INDEXES:
+        cursor.execute(statement)
+        conn.commit()
+    cursor.execute("ANALYZE;")
+    conn.commit()
+
+def copy_csvs_to_postgre(poll_seconds = 5):
+    """
+    Loads chunk files (csv, parquet or arrow) while extract_bitcoin_data_beta is still writing them. Finished chunks are copied by ncores workers in parallel.
+    Stops once done.signal exists and every chunk has been loaded, then finalizes the tables.
+    Chunks the extractor's manifest drops (reorganized or corrupt, redone under new numbers) are deleted from the staging tables again.
+    When the extractor ran with output_format = "postgres" there are no CSVs, the chunks are already in the staging tables and this only finalizes them.
+    """
+    conn = connect_db()
+    cursor = conn.cursor()
+    createStagingTables(cursor)
+    conn.commit()
+    submitted = set()
+    forgotten = set()
+    in_flight = {}
+    with workerPool() as pool:
+        while True:
+            # Checked before listing the directory, so chunks written just before the signal are never missed.
+            extraction_done = os.path.exists(signal_path)
+            dropped = droppedChunks(CSV_DIR)
+            # A dropped chunk still being copied is forgotten once its COPY has committed.
+            forget = dropped - forgotten - set(in_flight)
+            if forget:
+                for chunk in forgetChunks(cursor, forget):
+                    print(f"Chunk #{chunk} was dropped after its tables were finalized. The database still holds its old version.")
+                conn.commit()
+                forgotten |= forget
+            for chunk, chunk_format in readyChunks(extraction_done, dropped):
+                if chunk not in submitted:
+                    submitted.add(chunk)
+                    in_flight[chunk] = pool.apply_async(copyChunk, (chunk, chunk_format))
+            for chunk, result in list(in_flight.items()):
+                if result.ready():
+                    result.get()  # re-raises a worker's error
+                    del in_flight[chunk]
+            if extraction_done and not in_flight and not droppedChunks(CSV_DIR) - forgotten:
+                break
+            sleep(poll_seconds)
+    print(f"Copied {len(submitted)} chunks into the staging tables. Building tables and indexes...")
+    finalizeStagingTables(cursor, conn)
+    cursor.close()
+    conn.close()
+    print("Finished loading CSVs into the database.")
 
 
         
-def parsePubkeyDescriptors(chunk_size, commit_every = 1):
+def parsePubkeyDescriptors(chunk_size, commit_every = 1, rss_limit = None):
     '''
     Gets chunks of pubkey descriptors with null addresses and parses the public key into that address field. Parallel friendly.
+    chunk_size is where the worker starts. It then sizes its chunks for throughput, and smaller again if its memory passes rss_limit.
     '''
     conn   = connect_db()         # one connection per worker
     cursor    = conn.cursor()
+    tuneDB_for_python_processing(cursor, conn)
     counter  = 0                    # for commit batching
+    sizer = ChunkSizer(chunk_size, rss_limit = rss_limit)
     while True:
+        sizer.start()
         # 1) Grab the next slice of work, locking rows so no other worker sees them
         cursor.execute(
             """
@@ -149,7 +325,7 @@ def parsePubkeyDescriptors(chunk_size, commit_every = 1):
             )
             SELECT txid, vout_n, descriptor FROM cte;
             """,
-            (chunk_size,)
+            (sizer.size,)
         )
         rows = cursor.fetchall()
         if not rows:
@@ -160,36 +336,40 @@ def parsePubkeyDescriptors(chunk_size, commit_every = 1):
         for txid, vout_n, descriptor in rows:
             try:
                 pubkey = parseDesc(descriptor)[0]   # parseDesc returns a list for multisig support, as of now this only parses pubkeys though so only getting pubkey.
-                updates.append((pubkey, txid, vout_n))
+                updates.append((txid, vout_n, pubkey))
             except Exception as e:
                 print(f"[worker {os.getpid()}] parse error for {txid}:{vout_n} – {e}")
 
-        # 3) Bulk‑update the slice
+        # 3) Bulk‑update the slice: one COPY and one UPDATE ... FROM instead of a statement per row
         if updates:
-            cursor.executemany(
-                """
-                UPDATE outputs
-                   SET address = %s
-                 WHERE txid   = %s
-                   AND vout_n = %s;
-                """,
-                updates,
-            )
+            bulkUpdate(cursor, "outputs", [("txid", "TEXT"), ("vout_n", "INT"), ("address", "TEXT")], updates, ["txid", "vout_n"])
 
         counter += 1
         if counter % commit_every == 0:
             conn.commit()     
             print("Parsed descriptor chunk commit to database")
+        sizer.record(len(rows))
 
     conn.commit()             # final flush
     cursor.close()
     conn.close()
+def prevoutsResolved(cursor, column = "prevout_type"):
+    """
+    True if extract_bitcoin_data_beta filled in the inputs' prevout_* columns (resolve_prevouts, and address_keys for prevout_key). Then each input row already says what it spends and the stages below scan inputs instead of joining them to outputs.
+    Only the first non coinbase inputs are checked, so keep resolve_prevouts the same for a whole extraction. The same goes for intern_txids and the tx_id column.
+    """
+    cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'inputs' AND column_name = %s;", (column,))
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute(f"SELECT bool_or({column} IS NOT NULL) FROM (SELECT {column} FROM inputs WHERE vin_txid IS NOT NULL LIMIT 1000) s;")
+    return bool(cursor.fetchone()[0])
+
 def findRevealedPkeys():
     conn = connect_db()
     with conn.cursor() as cursor:
         print("Starting to look for revealed public keys...")
-        cursor.execute("SET work_mem = '500MB';")
-        cursor.execute("SET temp_buffers = '11GB';")
+        tuneDB_for_psql_processing(cursor, conn)
+        cursor.execute("SET temp_buffers = %s;", (temp_buffers,))
         cursor.execute("SET parallel_setup_cost = 0;")        
         cursor.execute("SET parallel_tuple_cost = 0;")
         
@@ -201,260 +381,553 @@ def findRevealedPkeys():
               AND pg_catalog.pg_function_is_visible(oid)
         );
     """)
-    function_exists = cursor.fetchone()[0]
+        function_exists = cursor.fetchone()[0]
     
-    if not function_exists:
-        cursor.execute("""
-            CREATE OR REPLACE FUNCTION public.get_revealed_key(witness_data text, vin_asm text)
-            RETURNS text
-            LANGUAGE plpgsql
-            IMMUTABLE PARALLEL SAFE
-            AS $function$
-            BEGIN
-              IF witness_data IS NOT NULL THEN
-                RETURN trim(
-                         reverse(
-                           split_part(
-                             reverse(witness_data),
-                             ',',
-                             1
-                           )
-                         )
-                       );
-              ELSE
-                RETURN trim(
-                         reverse(
-                           split_part(
-                             reverse(vin_asm),
-                             ' ',
-                             1
-                           )
-                         )
-                       );
-              END IF;
-            END;
-            $function$;
-        """)
-        conn.commit()
-        print("Function created.")
+        if not function_exists:
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION public.get_revealed_key(witness_data text, vin_asm text)
+                RETURNS text
+                LANGUAGE plpgsql
+                IMMUTABLE PARALLEL SAFE
+                AS $function$
+                BEGIN
+                  IF witness_data IS NOT NULL THEN
+                    RETURN trim(
+                             reverse(
+                               split_part(
+                                 reverse(witness_data),
+                                 ',',
+                                 1
+                               )
+                             )
+                           );
+                  ELSE
+                    RETURN trim(
+                             reverse(
+                               split_part(
+                                 reverse(vin_asm),
+                                 ' ',
+                                 1
+                               )
+                             )
+                           );
+                  END IF;
+                END;
+                $function$;
+            """)
+            conn.commit()
+            print("Function created.")
 
-        cursor.execute("""
-                       
-        BEGIN;
-        
-        
-        
+        if prevoutsResolved(cursor):
+            # Every input knows the type of what it spends: a sequential scan of inputs.
+            spends_of_pubkeyhash = """
+            FROM inputs i
+            WHERE i.prevout_type = 'pubkeyhash'
+              AND (i.witness_data IS NOT NULL OR i.vin_asm IS NOT NULL);
+            """
+        else:
+            spends_of_pubkeyhash = """
+            FROM inputs i
+            JOIN outputs o
+              ON o.txid = i.vin_txid
+             AND o.vout_n = i.vin_vout
+            WHERE o.descriptor_type = 'pubkeyhash'
+              AND (i.witness_data IS NOT NULL OR i.vin_asm IS NOT NULL);
+            """
+        cursor.execute(f"""
         CREATE TEMP TABLE revealed_keys ON COMMIT DROP AS
         SELECT
           i.vin_txid   AS txid,
           i.vin_vout   AS vout_n,
           get_revealed_key(i.witness_data, i.vin_asm) AS revealed_key
-        FROM inputs i
-        JOIN outputs o
-          ON o.txid = i.vin_txid
-         AND o.vout_n = i.vin_vout
-        WHERE o.descriptor_type = 'pubkeyhash'
-          AND (i.witness_data IS NOT NULL OR i.vin_asm IS NOT NULL);
-        
-        CREATE INDEX ON revealed_keys (txid, vout_n);
-        ANALYZE revealed_keys;
-        
-        -- 2.4: Single UPDATE
-        UPDATE outputs o
-        SET
-          address         = r.revealed_key,
-          descriptor_type = 'pubkey'
-        FROM revealed_keys r
-        WHERE o.txid   = r.txid
-          AND o.vout_n = r.vout_n;
-        
-        COMMIT;
-
-                       """)
-        print("Found and replaced all revealed public keys.")
+        {spends_of_pubkeyhash}
+        """)
+        cursor.execute("CREATE INDEX ON revealed_keys (txid, vout_n);")
+        cursor.execute("ANALYZE revealed_keys;")
+        # Single UPDATE
+        updated = applyUpdate(cursor, "outputs", "revealed_keys", ["txid", "vout_n"], {"address": "s.revealed_key", "descriptor_type": "'pubkey'"})
+        conn.commit()
+        print(f"Found and replaced {updated} revealed public keys.")
+        conn.autocommit = True  # VACUUM can't run inside a transaction
         cursor.execute("VACUUM ANALYZE;")
-    conn.commit()
-    
-def fillNormalizedHashes(chunk_size, commit_every = 10):
+    conn.close()
     
+def createNormalizedHashes(cursor):
+    """
+    normalized_hashes maps canonical keys (see utils/deriveUndefinedAddresses.canonicalKeys) to the canonical key of their root, the uncompressed public key.
+    Databases from before canonical keys have TEXT hashes and need scripts/migrate_canonical_keys.py first.
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS normalized_hashes (hash BYTEA NOT NULL, root_hash BYTEA NOT NULL);")
+    cursor.execute("SELECT data_type FROM information_schema.columns WHERE table_name = 'normalized_hashes' AND column_name = 'hash';")
+    if cursor.fetchone()[0] != "bytea":
+        raise RuntimeError("normalized_hashes still has TEXT hashes. Run scripts/migrate_canonical_keys.py first.")
+
+def buildKeyFilter(batch_size = 1000000):
+    """
+    Builds key_filter.KeyFilter over every outputs.address_key for fillNormalizedHashes' pruning. Inputs only spend outputs, so outputs holds every key.
+    A finished filter is reused as long as it covers as many keys as outputs has: findRevealedPkeys and parsePubkeyDescriptors change addresses but never address_key.
+    Once blocks were appended it is rebuilt, and scheduleNormalization reschedules the pubkeys pruned against the old one.
+    """
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM outputs WHERE address_key IS NOT NULL;")
+        n_keys = cursor.fetchone()[0]
+    if os.path.exists(os.path.join(key_filter_dir, "meta.json")):
+        built_keys = KeyFilter(key_filter_dir).n_keys
+        if built_keys == n_keys:
+            print("Key filter already built.")
+            conn.close()
+            return
+        print(f"The key filter covers {built_keys} output keys, outputs has {n_keys} now. Rebuilding it.")
+        shutil.rmtree(key_filter_dir)
+    key_filter = KeyFilter(key_filter_dir, n_keys, key_filter_bits_per_key)
+    added = 0
+    with conn.cursor(name="address_keys") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute("SELECT address_key FROM outputs WHERE address_key IS NOT NULL;")
+        while True:
+            keys = [bytes(key) for (key,) in cursor.fetchmany(batch_size)]
+            if not keys:
+                break
+            key_filter.add(keys)
+            added += len(keys)
+    key_filter.save()
+    conn.close()
+    print(f"Built the key filter over {added} output keys.")
+
+def scheduleNormalization(n_buckets = normalization_buckets):
+    """
+    Plans the work of fillNormalizedHashes once, instead of every worker re-running an anti-join and sort over all pubkeys for every slice.
+    Every distinct pubkey without normalized hashes goes into pubkey_work with a hash bucket, and pubkey_buckets records which buckets are done.
+    If a schedule already exists it is kept, so rerunning after a crash only redoes unfinished buckets.
+    normalization_filter records the size of the key filter the hashes were pruned against. Once it changes (buildKeyFilter rebuilt it over appended outputs, or pruning was turned off)
+    a derived key pruned before may be in outputs now, so the schedule is remade and also takes every pubkey whose root is missing any of its three rows.
+    """
+    filter_keys = KeyFilter(key_filter_dir).n_keys if prune_normalized_hashes else None
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        createNormalizedHashes(cursor)
+        cursor.execute("CREATE TABLE IF NOT EXISTS normalization_filter (n_keys BIGINT);")
+        cursor.execute("SELECT n_keys FROM normalization_filter;")
+        pruned_against = cursor.fetchone()
+        rescan = pruned_against is not None and pruned_against[0] != filter_keys
+        if rescan:
+            print("Outputs changed since normalized_hashes was pruned. Rescheduling the pubkeys with pruned rows.")
+            cursor.execute("DROP TABLE IF EXISTS pubkey_work, pubkey_buckets;")
+        cursor.execute("SELECT to_regclass('pubkey_buckets') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT count(*) FILTER (WHERE NOT done), count(*) FROM pubkey_buckets;")
+            left, total = cursor.fetchone()
+            print(f"Resuming normalization, {left} of {total} pubkey buckets left.")
+        else:
+            # A complete root has its compressed, P2WPKH and uncompressed key. finishNormalization removes the rows derived twice.
+            pruned = """
+                  OR   o.address_key IN (SELECT nh.hash FROM normalized_hashes nh WHERE nh.root_hash IN (
+                           SELECT root_hash FROM normalized_hashes GROUP BY root_hash HAVING count(DISTINCT hash) < 3))""" if rescan else ""
+            # hashtext spreads pubkeys evenly over the buckets. The mask keeps it non negative.
+            cursor.execute(f"""
+                CREATE UNLOGGED TABLE pubkey_work AS
+                SELECT DISTINCT o.address AS pubkey, (hashtext(o.address) & 2147483647) %% %s AS bucket
+                FROM   outputs o
+                WHERE  o.descriptor_type = 'pubkey'
+                  AND  o.address IS NOT NULL
+                  AND  (NOT EXISTS (SELECT 1 FROM normalized_hashes nh WHERE nh.hash = o.address_key){pruned});
+            """, (n_buckets,))
+            print(f"Scheduled {cursor.rowcount} distinct pubkeys for normalization.")
+            cursor.execute("CREATE INDEX ON pubkey_work (bucket);")
+            cursor.execute("CREATE TABLE pubkey_buckets (bucket INT PRIMARY KEY, done BOOLEAN NOT NULL DEFAULT false);")
+            cursor.execute("INSERT INTO pubkey_buckets (bucket) SELECT generate_series(0, %s - 1);", (n_buckets,))
+            cursor.execute("DELETE FROM normalization_filter;")
+            if filter_keys is not None:
+                cursor.execute("INSERT INTO normalization_filter (n_keys) VALUES (%s);", (filter_keys,))
+    conn.commit()
+    conn.close()
+
+def fillNormalizedHashes(worker, n_workers):
     """
     This function fills in the normalized hashes table by mapping the lowest level hash to any hashes which can be derived from it. Parallel friendly.
-    DEPENDENCY: deriveUndefinedAddresses()
+    Worker `worker` of `n_workers` takes every n_workers'th bucket of scheduleNormalization's pubkey_work, so workers never touch the same pubkeys and need no row locks.
+    A bucket's hashes and its done flag are committed together, which makes every bucket a checkpoint.
+    With prune_normalized_hashes, derived hashes that fail buildKeyFilter's filter never appear in outputs and aren't inserted.
+    DEPENDENCY: utils/deriveUndefinedAddresses.deriveKeyBatch(), scheduleNormalization(), buildKeyFilter() if pruning
     """
+    key_filter = KeyFilter(key_filter_dir) if prune_normalized_hashes else None
     conn = connect_db()
     conn.autocommit = False
-    cursor = conn.cursor()
-    counter = 0
-    # Order for standardized chunks.
-    sql = """
-        SELECT address
-        FROM   outputs
-        WHERE  descriptor_type = 'pubkey'
-          AND  NOT EXISTS (
-                  SELECT 1
-                  FROM   normalized_hashes nh
-                  WHERE  nh.hash = outputs.address )
-        ORDER  BY address
-        FOR UPDATE SKIP LOCKED
-        LIMIT  %s;
-        """         
-    while True:
-        with conn.cursor() as cursor:
-            cursor.execute(sql, (chunk_size, ))
-            rows = cursor.fetchall()
-            if not rows:
-                conn.commit()
-                cursor.close()
-                conn.close()
-                print("Normalization completed for a worker")
-                return
+    with conn.cursor() as cursor:
+        tuneDB_for_python_processing(cursor, conn)
+        cursor.execute("SELECT bucket FROM pubkey_buckets WHERE NOT done AND bucket %% %s = %s ORDER BY bucket;", (n_workers, worker))
+        buckets = [bucket for (bucket,) in cursor.fetchall()]
+        for bucket in buckets:
+            cursor.execute("SELECT pubkey FROM pubkey_work WHERE bucket = %s;", (bucket,))
+            pubkeys = [pubkey for (pubkey,) in cursor.fetchall()]
+            # Same hashes as deriveUndefinedAddresses, for the whole bucket at once, as canonical keys. A key and its P2PKH address share a canonical key, so five forms become three.
+            derived = deriveKeyBatch(pubkeys)
+            for i in np.flatnonzero(~derived["valid"]):
+                print(f"[{os.getpid()}] Error on {pubkeys[i]}: not a public key")
             hash_rows = []
-            for (pubkey,) in rows:
-                try:
-                    addrs = deriveUndefinedAddresses(
-                        pubkey, assume_multisig_owned=True
-                    )
-                    root = addrs[0] # The root hash will just be a hash of all the other hashes. In the future this should probably just be a pubkey though for clarity.
-                    
-                    hash_rows.extend((h, root) for h in addrs[1:])
-                    hash_rows.append((root, root)) # This is just to keep downstream dependencies working - the root hash used to be a composite hash but this made no sense.
-
-                except Exception as e:
-                    print(f"[{os.getpid()}] Error on {pubkey}: {e}")
-                    
-            execute_values(
-                cursor,
-                """
-                INSERT INTO normalized_hashes (hash, root_hash)
-                VALUES %s
-                ON CONFLICT DO NOTHING;
-                """,
-                hash_rows,
-            )
-            counter += 1
-            if counter % commit_every == 0:
-                print("Batch commited")
-                conn.commit()                 # release locks in batches
+            for root, compressed, p2wpkh in zip(derived["uncompressed"], derived["compressed"], derived["p2wpkh"]):
+                if root is not None:
+                    # The root hash is the uncompressed pubkey. It maps to itself to keep downstream dependencies working. Pruning drops that row too if the uncompressed key never appears on chain, the key's other rows still name the root.
+                    hash_rows += [(compressed, root), (p2wpkh, root), (root, root)]
+            if key_filter is not None:
+                on_chain = key_filter.contains([hash for hash, _ in hash_rows])
+                hash_rows = [row for row, keep in zip(hash_rows, on_chain) if keep]
+            # A key's compressed and uncompressed forms land in different buckets and derive the same rows. finishNormalization removes the duplicates.
+            bulkInsert(cursor, "normalized_hashes", [("hash", "BYTEA"), ("root_hash", "BYTEA")], hash_rows)
+            cursor.execute("UPDATE pubkey_buckets SET done = true WHERE bucket = %s;", (bucket,))
+            conn.commit()
+        print(f"Normalization completed for worker {worker} ({len(buckets)} buckets)")
+    conn.close()
 
-def trimDB():
-    '''
-    This makes the database smaller after populate_database is ran in full by reducing redundant information. 
-    DEPENDENCY: Multisigs and all other types besides pubkey ignored as root_hash candidates.
-    '''
+def finishNormalization():
+    """Drops scheduleNormalization's work tables once every bucket is done, then deduplicates and indexes normalized_hashes."""
     conn = connect_db()
-    cursor = conn.cursor()
-    try:
-        # Set descriptor and descriptor_type to NULL in outputs where descriptor_type = 'pubkey'
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM pubkey_buckets WHERE NOT done;")
+        left = cursor.fetchone()[0]
+        if left:
+            print(f"{left} pubkey buckets are not normalized yet, keeping the schedule to resume from.")
+        else:
+            cursor.execute("DROP TABLE pubkey_work, pubkey_buckets;")
+            cursor.execute("CREATE TABLE normalized_hashes_distinct AS SELECT DISTINCT hash, root_hash FROM normalized_hashes;")
+            cursor.execute("DROP TABLE normalized_hashes;")
+            cursor.execute("ALTER TABLE normalized_hashes_distinct RENAME TO normalized_hashes;")
+            cursor.execute("CREATE INDEX normalized_hashes_hash_idx ON normalized_hashes (hash);")
+    conn.commit()
+    conn.close()
+
+def assignWalletIds():
+    """
+    Numbers every wallet with a dense INT and writes it to outputs.wallet_id, which is what utils/cscUnionFind indexes its arrays with.
+    A wallet is a root hash: the normalized root of an output's address_key, or the key itself if it has none (script hashes, keys never revealed).
+      wallets (wallet_id, root_hash) numbers the roots from 1. Rerunning after more blocks were loaded keeps the old ids and numbers new roots after them.
+      key_wallets (address_key, wallet_id) maps every canonical key on chain to its wallet.
+      wallet_remaps (old_wallet_id, new_wallet_id) collects the keys that moved to another wallet since the last run, because normalization found their root.
+      commonSpendCluster carries the old wallets' clusters over and empties it.
+    Outputs without a key (bare multisig, nonstandard) get no wallet. Every transaction spending one is a one off node, so it only drops that output from the clusters.
+    DEPENDENCY: finishNormalization()
+    """
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        tuneDB_for_psql_processing(cursor, conn)
+        cursor.execute("DROP TABLE IF EXISTS key_roots, key_wallets_before;")
+        cursor.execute("ALTER TABLE IF EXISTS key_wallets RENAME TO key_wallets_before;")
         cursor.execute("""
-            UPDATE outputs
-            SET descriptor = NULL
-            WHERE descriptor_type = 'pubkey';
+            CREATE UNLOGGED TABLE key_roots AS
+            SELECT k.address_key, COALESCE(nh.root_hash, k.address_key) AS root_hash
+            FROM  (SELECT DISTINCT address_key FROM outputs WHERE address_key IS NOT NULL) k
+            LEFT JOIN normalized_hashes nh ON nh.hash = k.address_key;
         """)
-        
-        # Redundant because descriptors can be parsed for 
+        cursor.execute("SELECT to_regclass('wallets') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                INSERT INTO wallets (wallet_id, root_hash)
+                SELECT (SELECT COALESCE(max(wallet_id), 0) FROM wallets) + row_number() OVER (), r.root_hash
+                FROM  (SELECT DISTINCT root_hash FROM key_roots) r
+                WHERE NOT EXISTS (SELECT 1 FROM wallets w WHERE w.root_hash = r.root_hash);
+            """)
+            new_wallets = cursor.rowcount
+        else:
+            # row_number() without an ORDER BY numbers the roots without sorting them. The indexes are built after the insert.
+            cursor.execute("""
+                CREATE TABLE wallets AS
+                SELECT (row_number() OVER ())::int AS wallet_id, root_hash
+                FROM  (SELECT DISTINCT root_hash FROM key_roots) r;
+            """)
+            new_wallets = cursor.rowcount
+            cursor.execute("ALTER TABLE wallets ADD PRIMARY KEY (wallet_id);")
+            cursor.execute("CREATE UNIQUE INDEX wallets_root_hash_idx ON wallets (root_hash);")
+        print(f"Numbered {new_wallets} new wallets.")
         cursor.execute("""
-                       ALTER TABLE transactions
-                       DROP COLUMN descriptor_type;
-                       """)
-
-        # Set witness_data and vin_asm to NULL in inputs where the referenced output has descriptor_type = 'pubkey'
+            CREATE TABLE key_wallets AS
+            SELECT k.address_key, w.wallet_id
+            FROM   key_roots k
+            JOIN   wallets w ON w.root_hash = k.root_hash;
+        """)
+        cursor.execute("DROP TABLE key_roots;")
+        cursor.execute("ALTER TABLE key_wallets ADD PRIMARY KEY (address_key);")
+        cursor.execute("ANALYZE key_wallets;")
+        cursor.execute("CREATE TABLE IF NOT EXISTS wallet_remaps (old_wallet_id INT NOT NULL, new_wallet_id INT NOT NULL);")
+        cursor.execute("SELECT to_regclass('key_wallets_before') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                INSERT INTO wallet_remaps (old_wallet_id, new_wallet_id)
+                SELECT DISTINCT b.wallet_id, k.wallet_id
+                FROM   key_wallets_before b
+                JOIN   key_wallets k ON k.address_key = b.address_key
+                WHERE  b.wallet_id <> k.wallet_id;
+            """)
+            print(f"{cursor.rowcount} wallets lost keys to another wallet.")
+            cursor.execute("DROP TABLE key_wallets_before;")
+        cursor.execute("ALTER TABLE outputs ADD COLUMN IF NOT EXISTS wallet_id INT;")
+        # One set based UPDATE. Rows that already have the right id (a rerun) aren't rewritten.
         cursor.execute("""
-            UPDATE inputs
-            SET witness_data = NULL,
-                vin_asm = NULL
-            WHERE (vin_txid, vin_vout) IN (
-                SELECT txid, vout_n
-                FROM outputs
-                WHERE descriptor_type IS NULL  -- Because we just nulled 'pubkey'
-            );
+            UPDATE outputs o
+            SET    wallet_id = k.wallet_id
+            FROM   key_wallets k
+            WHERE  o.address_key = k.address_key
+              AND  o.wallet_id IS DISTINCT FROM k.wallet_id;
         """)
+        print(f"Set wallet_id on {cursor.rowcount} outputs.")
+    conn.commit()
+    conn.close()
 
-        cursor.execute("VACUUM FULL ANALYZE;")
+def exportSpendEdges(path = spend_edges_path, after_tx = None):
+    """
+    Writes the common spend edge list, one (spending transaction, wallet_id) int32 pair per input, to `path` for utils/cscUnionFind. Read it with loadSpendEdges().
+    Spending transactions are the dense inputs.tx_id ids if the extraction interned txids, otherwise dense ranks of the txids (a sort of inputs).
+    With interned txids, after_tx leaves out the transactions up to that tx_id.
+    Inputs spending an output without a wallet are left out. Returns the number of edges.
+    The edges are ordered by spending transaction, which cscUnionFind's sorted pass needs to skip its tx_first table. A parallel plan would interleave them otherwise.
+    DEPENDENCY: assignWalletIds()
+    """
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        tuneDB_for_psql_processing(cursor, conn)
+        if prevoutsResolved(cursor, "tx_id"):
+            spender, condition = "i.tx_id", "AND i.tx_id IS NOT NULL" if after_tx is None else f"AND i.tx_id > {int(after_tx)}"
+        else:
+            spender, condition = "(dense_rank() OVER (ORDER BY i.txid) - 1)::int", ""
+        if prevoutsResolved(cursor, "prevout_key"):
+            # The inputs carry the spent output's key, so outputs isn't joined at all.
+            spent = "JOIN key_wallets w ON w.address_key = i.prevout_key"
+        else:
+            spent = "JOIN outputs w ON w.txid = i.vin_txid AND w.vout_n = i.vin_vout"
+        print("Exporting the common spend edge list...")
+        edges = copyIntsOut(cursor, f"SELECT {spender}, w.wallet_id FROM inputs i {spent} WHERE w.wallet_id IS NOT NULL {condition} ORDER BY 1", 2, path)
+        print(f"Exported {edges} spend edges to {path}.")
+    conn.commit()
+    conn.close()
+    return edges
 
-        conn.commit()
-        print("Database trimmed successfully.")
+def loadSpendEdges(path = spend_edges_path):
+    """exportSpendEdges' edge list as a read only (n, 2) int32 memmap, the array cscUnionFind takes."""
+    if os.path.getsize(path) == 0:
+        return np.empty((0, 2), dtype=np.int32)  # An empty file can't be memory mapped
+    return np.memmap(path, dtype=np.int32, mode="r").reshape(-1, 2)
 
-    except Exception as e:
-        conn.rollback()
-        print(f"Error occurred: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+def trimTable(conn, table, source, expressions = None, dropped = (), batch_pages = None, prepare = ()):
+    """
+    Rewrites `table` as a compacted copy, {table}_trimmed, then swaps it in.
+    `source` is the FROM clause and aliases the table as s. Columns in `dropped` are left out. Columns in `expressions` get that SQL expression instead of their value.
+    {first} and {last} in `source` are the ctid bounds of the page range being copied, so a joined table keyed by the table's ctid is read for that range only.
+    The statements in `prepare` run once, in the transaction that starts the trim, e.g. to build such a table.
+    The copy is filled one ctid page range of the table at a time (TID range scans, no index needed). Every range commits together with its progress in trim_progress, so an interrupted trim carries on where it stopped.
+    The table's indexes are rebuilt on the copy, then the old table is dropped and the copy renamed in one transaction, which also marks the table swapped in trim_progress. A rerun skips a swapped table.
+    PRIMARY KEY and UNIQUE constraints are put back onto their rebuilt indexes with ADD CONSTRAINT ... USING INDEX, so appending loads still have their ON CONFLICT targets.
+    """
+    expressions = expressions or {}
+    trimmed = f"{table}_trimmed"
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS trim_progress (table_name TEXT PRIMARY KEY, next_page BIGINT NOT NULL, pages BIGINT NOT NULL, swapped BOOLEAN NOT NULL DEFAULT false);")
+        cursor.execute("SELECT next_page, pages, swapped FROM trim_progress WHERE table_name = %s;", (table,))
+        progress = cursor.fetchone()
+        if progress is not None and progress[2]:
+            print(f"{table} is already trimmed.")
+            return
+        if progress is None:
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position;", (table,))
+            select = ", ".join(f"{expressions.get(column, 's.' + column)} AS {column}" for (column,) in cursor.fetchall() if column not in dropped)
+            cursor.execute("SELECT relpersistence = 'u', pg_relation_size(oid) / current_setting('block_size')::bigint FROM pg_class WHERE oid = %s::regclass;", (table,))
+            unlogged, pages = cursor.fetchone()
+            cursor.execute(f"DROP TABLE IF EXISTS {trimmed};")
+            for statement in prepare:
+                cursor.execute(statement)
+            empty = source.format(first = "'(0,0)'::tid", last = "'(0,0)'::tid")
+            # Same persistence as the table it replaces.
+            cursor.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {trimmed} AS SELECT {select} FROM {empty} WITH NO DATA;")
+            cursor.execute("INSERT INTO trim_progress (table_name, next_page, pages) VALUES (%s, 0, %s);", (table, pages))
+            conn.commit()
+            next_page = 0
+        else:
+            next_page, pages, _ = progress
+            print(f"Resuming the trim of {table} at page {next_page} of {pages}.")
+        # The copy's columns are the plan, so a resumed trim selects exactly what the first run did.
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position;", (trimmed,))
+        select = ", ".join(f"{expressions.get(column, 's.' + column)}" for (column,) in cursor.fetchall())
+        if batch_pages is None:
+            batch_pages = trim_batch_pages if rewrite_budget is None else max(1, min(trim_batch_pages, rewrite_budget // 8192))
+        while next_page < pages:
+            end = min(pages, next_page + batch_pages)
+            first, last = f"'({next_page},0)'::tid", f"'({end},0)'::tid"
+            cursor.execute(f"INSERT INTO {trimmed} SELECT {select} FROM {source.format(first = first, last = last)} WHERE s.ctid >= {first} AND s.ctid < {last};")
+            cursor.execute("UPDATE trim_progress SET next_page = %s WHERE table_name = %s;", (end, table))
+            conn.commit()
+            next_page = end
+            print(f"Trimmed {table}: {end} of {pages} pages.")
+
+        cursor.execute("SELECT schemaname, indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s;", (table,))
+        indexes = cursor.fetchall()
+        # indexdef of a constraint's index is a plain CREATE UNIQUE INDEX, the constraint itself has to be added again.
+        cursor.execute("SELECT c.conname, CASE c.contype WHEN 'p' THEN 'PRIMARY KEY' ELSE 'UNIQUE' END, i.relname FROM pg_constraint c JOIN pg_class i ON i.oid = c.conindid WHERE c.conrelid = %s::regclass AND c.contype IN ('p', 'u');", (table,))
+        constraints = cursor.fetchall()
+        for schema, name, definition in indexes:
+            definition = definition.replace(f" INDEX {name} ON {schema}.{table} ", f" INDEX IF NOT EXISTS {name}_trimmed ON {schema}.{trimmed} ", 1)
+            cursor.execute(definition)
+            conn.commit()
+        cursor.execute(f"DROP TABLE {table};")
+        cursor.execute(f"ALTER TABLE {trimmed} RENAME TO {table};")
+        for _, name, _ in indexes:
+            cursor.execute(f"ALTER INDEX {name}_trimmed RENAME TO {name};")
+        for name, kind, index in constraints:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {kind} USING INDEX {index};")
+        # Kept until trimDB finishes, so a crash in a later table doesn't trim this one again.
+        cursor.execute("UPDATE trim_progress SET swapped = true WHERE table_name = %s;", (table,))
+        conn.commit()
+    print(f"Swapped in the trimmed {table}.")
 
-def commonSpendCluster():
+def trimDB():
+    '''
+    This makes the database smaller after populate_database is ran in full by reducing redundant information:
+      descriptors of pubkey outputs, whose address already holds the key,
+      unlocking scripts of inputs that spend pubkey outputs, whose key findRevealedPkeys already put in outputs.address,
+      inputs.prevout_type and prevout_address, which are outputs' and were only kept to speed up the stages above. prevout_key stays for the clustering.
+    Tables are rewritten by trimTable instead of UPDATEd and VACUUM FULLed, so the only extra disk is the compacted copy, no lock is held for long and a crash loses one page range.
+    Rerunning it after a crash skips the tables already swapped in and resumes the one it was trimming.
+    DEPENDENCY: Multisigs and all other types besides pubkey ignored as root_hash candidates.
+    '''
     conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SET temp_buffers = '10GB';") 
-    cursor.execute("SET parallel_setup_cost = 0;")        
-    cursor.execute("SET parallel_tuple_cost = 0;")
-    sql = """
-    
-    DROP TABLE IF EXISTS tmp_input_nodes;
-    CREATE UNLOGGED TABLE tmp_input_nodes AS
-    SELECT DISTINCT
-           i.vin_txid AS spent_txid,
-           COALESCE(nh.root_hash, o.address, i.vin_txid || ':' || i.vin_vout) AS node_hash
-    FROM inputs i
-    JOIN outputs o ON o.txid = i.vin_txid AND o.vout_n = i.vin_vout
-    LEFT JOIN normalized_hashes nh ON nh.hash = o.address
-    WHERE i.vin_txid IS NOT NULL;
-    
-    CREATE INDEX ON tmp_input_nodes(node_hash);
-    ANALYZE tmp_input_nodes;
-    
-    INSERT INTO normalized_hashes(hash, root_hash)
-    SELECT ni.node_hash, ni.node_hash
-    FROM tmp_input_nodes ni
-    LEFT JOIN normalized_hashes nh ON nh.hash = ni.node_hash AND nh.root_hash = ni.node_hash
-    WHERE nh.hash IS NULL
-    ON CONFLICT DO NOTHING;
-    
-    DROP TABLE IF EXISTS tmp_spend_edges;
-    CREATE UNLOGGED TABLE tmp_spend_edges AS
-    SELECT DISTINCT
-           LEAST(a.node_hash, b.node_hash) AS h1,
-           GREATEST(a.node_hash, b.node_hash) AS h2
-    FROM tmp_input_nodes a
-    JOIN tmp_input_nodes b ON a.spent_txid = b.spent_txid AND a.node_hash <> b.node_hash;
-    
-    CREATE INDEX ON tmp_spend_edges(h1);
-    CREATE INDEX ON tmp_spend_edges(h2);
-    ANALYZE tmp_spend_edges;
-    
-    WITH RECURSIVE
-        cc(node, comp) AS (
-            SELECT node_hash, node_hash FROM (SELECT DISTINCT node_hash FROM tmp_input_nodes) n
-            UNION ALL
-            SELECT e.h1, LEAST(cc.comp, e.h2) FROM cc JOIN tmp_spend_edges e ON cc.node = e.h1 WHERE LEAST(cc.comp, e.h2) < cc.comp
-            UNION ALL
-            SELECT e.h2, LEAST(cc.comp, e.h1) FROM cc JOIN tmp_spend_edges e ON cc.node = e.h2 WHERE LEAST(cc.comp, e.h1) < cc.comp
-        ),
-        final_comp AS (
-            SELECT node AS root_hash, MIN(comp) AS cluster
-            FROM cc
-            GROUP BY node
-        )
-    INSERT INTO cs_clusters(root_hash, cluster)
-    SELECT root_hash, cluster
-    FROM final_comp
-    ON CONFLICT (root_hash, cluster) DO NOTHING;
-    
-    DROP TABLE IF EXISTS tmp_spend_edges;
-    DROP TABLE IF EXISTS tmp_input_nodes;
+    with conn.cursor() as cursor:
+        tuneDB_for_psql_processing(cursor, conn)
+        resolved = prevoutsResolved(cursor)  # Until inputs is swapped, even on a resumed trim, it still has its prevout columns
+    trimTable(conn, "outputs", "outputs s", {"descriptor": "CASE WHEN s.descriptor_type = 'pubkey' THEN NULL ELSE s.descriptor END"})
+    if resolved:
+        # The inputs know what they spend. A revealed pubkeyhash output is a pubkey output now.
+        source, spends_pubkey, prepare = "inputs s", "s.prevout_type IN ('pubkey', 'pubkeyhash')", ()
+    else:
+        # Joining outputs in every page range would hash or scan all of outputs once per range. The inputs spending pubkey outputs are found
+        # in one join instead, keyed by their ctid, and each range reads its part of them through the index: an index range scan on
+        # trim_pubkey_spends hash joined to the TID range scan of inputs. It is a logged table so it survives a crash with trim_progress.
+        source = "inputs s LEFT JOIN trim_pubkey_spends p ON p.input_ctid = s.ctid AND p.input_ctid >= {first} AND p.input_ctid < {last}"
+        spends_pubkey = "p.input_ctid IS NOT NULL"
+        prepare = ("DROP TABLE IF EXISTS trim_pubkey_spends;",
+                   "CREATE TABLE trim_pubkey_spends AS SELECT s.ctid AS input_ctid FROM inputs s JOIN outputs o ON o.txid = s.vin_txid AND o.vout_n = s.vin_vout WHERE o.descriptor_type = 'pubkey';",
+                   "CREATE INDEX ON trim_pubkey_spends (input_ctid);",
+                   "ANALYZE trim_pubkey_spends;")
+    unlocking = {column: f"CASE WHEN {spends_pubkey} THEN NULL ELSE s.{column} END" for column in ("witness_data", "vin_asm")}
+    trimTable(conn, "inputs", source, unlocking, dropped = ("prevout_type", "prevout_address"), prepare = prepare)
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS trim_pubkey_spends;")
+        cursor.execute("DROP TABLE trim_progress;")
+    conn.commit()
+    conn.autocommit = True  # VACUUM can't run inside a transaction
+    with conn.cursor() as cursor:
+        # Not FULL: the new tables have no dead rows. This sets the visibility map and statistics.
+        cursor.execute("VACUUM ANALYZE outputs;")
+        cursor.execute("VACUUM ANALYZE inputs;")
+    conn.close()
+    print("Database trimmed successfully.")
+
+def updateClusters(cursor, merges, added):
+    """Applies one set of UnionFindState changes to cs_clusters and returns the number of wallets whose cluster merged into another."""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS cs_cluster_merges (cluster_id INT, new_cluster_id INT) ON COMMIT DROP;")
+    cursor.execute("TRUNCATE cs_cluster_merges;")
+    copyIntsIn(cursor, "cs_cluster_merges", ("cluster_id", "new_cluster_id"), merges)
+    cursor.execute("ANALYZE cs_cluster_merges;")
+    merged = applyUpdate(cursor, "cs_clusters", "cs_cluster_merges", ["cluster_id"], {"cluster_id": "s.new_cluster_id"})
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS cs_clusters_added (wallet_id INT, cluster_id INT) ON COMMIT DROP;")
+    cursor.execute("TRUNCATE cs_clusters_added;")
+    copyIntsIn(cursor, "cs_clusters_added", ("wallet_id", "cluster_id"), added)
+    cursor.execute("""
+        INSERT INTO cs_clusters (wallet_id, cluster_id) SELECT wallet_id, cluster_id FROM cs_clusters_added
+        ON CONFLICT (wallet_id) DO UPDATE SET cluster_id = EXCLUDED.cluster_id;
+    """)
+    return merged
 
+def commonSpendCluster(path = spend_edges_path, incremental = incremental_clustering):
     """
-    print("Starting common spend graph discovery")
-    cursor.execute(sql)
-    print("Finished common spend graphy discovery!")
-    
+    Clusters wallets by the common input ownership heuristic: every wallet spent from in one transaction is one entity.
+    Exports the (spending transaction, wallet_id) edge list with binary COPY (exportSpendEdges), finds the components with utils/cscUnionFind
+    and COPYs the (wallet_id, cluster_id) result into a new cs_clusters. No pairs of inputs are built and the union find is one pass over the edges.
+    The union find runs out of core, reading the edges in chunks with its arrays memory mapped in union_find_dir, so the graph doesn't have to fit in RAM.
+    Its state is kept there too. With incremental, a rerun only exports and applies the transactions after the last one it clustered,
+    and only updates the cs_clusters rows of merged clusters and newly spent wallets. Without interned txids, or after a crash, it clusters everything again.
+    A cluster_id is the smallest wallet_id in the cluster, so it only changes when the cluster merges. Wallets that were never spent from have no row, each one is its own cluster.
+    Keys assignWalletIds moved to another wallet (wallet_remaps) had their earlier spends clustered under the old wallet. An incremental run unions each old wallet with its new one,
+    which is what a full run would find as long as the old wallet has no keys left. Otherwise it clusters everything again.
+    DEPENDENCY: assignWalletIds(). Incremental runs assume earlier wallets keep their wallet_id.
+    """
+    started = perf_counter()
+    state = UnionFindState(union_find_dir)
+    incremental = incremental and not state.empty
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        tuneDB_for_psql_processing(cursor, conn)
+        if incremental:
+            cursor.execute("SELECT to_regclass('cs_clusters') IS NOT NULL;")
+            incremental = cursor.fetchone()[0] and prevoutsResolved(cursor, "tx_id")
+        cursor.execute("SELECT COALESCE(max(wallet_id), 0) FROM wallets;")
+        n_wallets, = cursor.fetchone()
+        cursor.execute("CREATE TABLE IF NOT EXISTS wallet_remaps (old_wallet_id INT NOT NULL, new_wallet_id INT NOT NULL);")
+        cursor.execute("SELECT DISTINCT old_wallet_id, new_wallet_id FROM wallet_remaps;")
+        moved = cursor.fetchall()
+        if incremental and moved:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM key_wallets WHERE wallet_id IN (SELECT old_wallet_id FROM wallet_remaps));")
+            if cursor.fetchone()[0]:
+                print("Some wallets lost only part of their keys to another wallet, clustering everything again.")
+                incremental = False
+    conn.commit()
+    if not incremental:
+        state.reset()
+    step = perf_counter()
+    updates = []
+    if incremental and moved:
+        updates.append(state.remap(moved, union_find_chunk_rows, n_wallets))
+        print(f"Moved the clusters of {len(moved)} remapped wallets in {perf_counter() - step:.1f}s.")
+    n_edges = exportSpendEdges(path, state.last_tx if incremental else None)
+    print(f"Running union find on {n_edges} spend edges{f' after transaction {state.last_tx}' if incremental else ''}...")
+    step = perf_counter()
+    updates.append(state.apply(path, union_find_chunk_rows, n_wallets, log = incremental))
+    print(f"Applied the spend edges in {perf_counter() - step:.1f}s.")
+    step = perf_counter()
+    with conn.cursor() as cursor:
+        if incremental:
+            # In the order they happened: a later merge can move a cluster an earlier one made.
+            for merges, added in updates:
+                merged = updateClusters(cursor, merges, added)
+                print(f"{len(merges)} clusters merged ({merged} wallets moved) and {len(added)} wallets added in {perf_counter() - step:.1f}s.")
+        else:
+            clusters = state.rows(os.path.join(union_find_dir, "clusters.bin"), union_find_chunk_rows)
+            cursor.execute("""
+                DROP TABLE IF EXISTS cs_clusters;
+                CREATE TABLE cs_clusters (
+                    wallet_id INT NOT NULL,
+                    cluster_id INT NOT NULL
+                );
+            """)
+            copyIntsIn(cursor, "cs_clusters", ("wallet_id", "cluster_id"), clusters)
+            print(f"Copied {len(clusters)} wallets into cs_clusters in {perf_counter() - step:.1f}s, indexing...")
+            cursor.execute("""
+                ALTER TABLE cs_clusters ADD PRIMARY KEY (wallet_id);
+                CREATE INDEX cs_clusters_cluster_id_idx ON cs_clusters(cluster_id);
+            """)
+        cursor.execute("ANALYZE cs_clusters;")
+        cursor.execute("DELETE FROM wallet_remaps;")
+    conn.commit()
+    conn.close()
+    state.save()  # Only once cs_clusters has it. A crash before this leaves the state incomplete and the next run starts over.
+    print(f"Finished common spend clustering in {perf_counter() - started:.1f}s!")
+
 
 if __name__ == "__main__":
+    if autotune:
+        applyAutotune()
+    if sys.argv[1:] == ["cluster"]:
+        # Reruns only the clustering, on a database populated before.
+        commonSpendCluster()
+        sys.exit()
     copy_csvs_to_postgre()
     findRevealedPkeys()
-    with Pool(ncores) as pool:
+    with workerPool() as pool:
         print("Starting to parse descriptors...")
-        pool.map(parsePubkeyDescriptors, [chunk_size_pythonwork] * ncores)
-        pool.map(fillNormalizedHashes, [chunk_size_pythonwork] * ncores)
+        pool.starmap(parsePubkeyDescriptors, [(chunk_size_pythonwork, 1, worker_rss_limit)] * ncores)
+        if prune_normalized_hashes:
+            buildKeyFilter()
+        scheduleNormalization()
+        pool.starmap(fillNormalizedHashes, [(worker, ncores) for worker in range(ncores)])
+    finishNormalization()
+    assignWalletIds()
     trimDB()
     commonSpendCluster()
         
@@ -0,0 +1,436 @@
+# Decodes serialized blocks (getblock verbosity 0, or blk*.dat records) into the same fields chunk_columns.flattenBlock pulls out of verbosity 2 JSON.
+# bitcoind spends most of its getblock time building the decoded JSON, and we spend most of ours parsing it back, so doing it here from the raw bytes is a lot cheaper for both.
+# Everything is read through memoryview slices of the block, so scripts and hashes aren't copied until they're turned into strings.
+# The scriptPubKey type, address and descriptor logic mirrors Bitcoin Core's Solver, ExtractDestination and InferDescriptor (v29) so the output matches the RPC byte for byte.
+import hashlib
+from struct import unpack_from
+
+_sha256 = hashlib.sha256
+
+# Bech32/Bech32m constants, BIP-173 and BIP-350.
+_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+_HRP = 'bc'
+_HRP_EXPAND = [ord(x) >> 5 for x in _HRP] + [0] + [ord(x) & 31 for x in _HRP]
+_GEN = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+_BECH32M_CONST = 0x2bc830a3
+_B58_ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+# Descriptor checksum constants. SOURCE: https://github.com/bitcoin/bitcoin/blob/master/doc/descriptors.md
+_DESC_INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
+_DESC_GEN = (0xf5dee51989, 0xa9fdca3312, 0x1bab10e32d, 0x3706b1677a, 0x644d626ffd)
+
+# secp256k1 field prime, used to check that x-only taproot keys are on the curve like Core does before writing rawtr().
+_SECP256K1_P = 2**256 - 2**32 - 977
+
+_OP_0, _OP_PUSHDATA1, _OP_PUSHDATA2, _OP_PUSHDATA4 = 0x00, 0x4c, 0x4d, 0x4e
+_OP_1NEGATE, _OP_1, _OP_16 = 0x4f, 0x51, 0x60
+_OP_RETURN, _OP_DUP, _OP_EQUAL, _OP_EQUALVERIFY = 0x6a, 0x76, 0x87, 0x88
+_OP_HASH160, _OP_CHECKSIG, _OP_CHECKMULTISIG = 0xa9, 0xac, 0xae
+
+_OP_NAMES = {0x50: "OP_RESERVED", 0xff: "OP_INVALIDOPCODE"}
+_OP_NAMES.update(zip(range(0x61, 0xbb), (
+    "OP_NOP OP_VER OP_IF OP_NOTIF OP_VERIF OP_VERNOTIF OP_ELSE OP_ENDIF OP_VERIFY OP_RETURN "
+    "OP_TOALTSTACK OP_FROMALTSTACK OP_2DROP OP_2DUP OP_3DUP OP_2OVER OP_2ROT OP_2SWAP OP_IFDUP OP_DEPTH "
+    "OP_DROP OP_DUP OP_NIP OP_OVER OP_PICK OP_ROLL OP_ROT OP_SWAP OP_TUCK OP_CAT OP_SUBSTR OP_LEFT "
+    "OP_RIGHT OP_SIZE OP_INVERT OP_AND OP_OR OP_XOR OP_EQUAL OP_EQUALVERIFY OP_RESERVED1 OP_RESERVED2 "
+    "OP_1ADD OP_1SUB OP_2MUL OP_2DIV OP_NEGATE OP_ABS OP_NOT OP_0NOTEQUAL OP_ADD OP_SUB OP_MUL OP_DIV "
+    "OP_MOD OP_LSHIFT OP_RSHIFT OP_BOOLAND OP_BOOLOR OP_NUMEQUAL OP_NUMEQUALVERIFY OP_NUMNOTEQUAL "
+    "OP_LESSTHAN OP_GREATERTHAN OP_LESSTHANOREQUAL OP_GREATERTHANOREQUAL OP_MIN OP_MAX OP_WITHIN "
+    "OP_RIPEMD160 OP_SHA1 OP_SHA256 OP_HASH160 OP_HASH256 OP_CODESEPARATOR OP_CHECKSIG OP_CHECKSIGVERIFY "
+    "OP_CHECKMULTISIG OP_CHECKMULTISIGVERIFY OP_NOP1 OP_CHECKLOCKTIMEVERIFY OP_CHECKSEQUENCEVERIFY "
+    "OP_NOP4 OP_NOP5 OP_NOP6 OP_NOP7 OP_NOP8 OP_NOP9 OP_NOP10 OP_CHECKSIGADD"
+).split()))
+_OP_NAMES[0x4f] = "-1"
+_OP_NAMES.update((op, str(op - 0x50)) for op in range(_OP_1, _OP_16 + 1))
+
+_SIGHASH_NAMES = {
+    0x01: "ALL", 0x02: "NONE", 0x03: "SINGLE",
+    0x81: "ALL|ANYONECANPAY", 0x82: "NONE|ANYONECANPAY", 0x83: "SINGLE|ANYONECANPAY",
+}
+
+
+def sha256d(*parts) -> bytes:
+    """Double SHA256 over one or more byte slices, without joining them first."""
+    h = _sha256()
+    for part in parts:
+        h.update(part)
+    return _sha256(h.digest()).digest()
+
+def _readVarint(buf, pos):
+    n = buf[pos]
+    if n < 0xfd:
+        return n, pos + 1
+    if n == 0xfd:
+        return unpack_from("<H", buf, pos + 1)[0], pos + 3
+    if n == 0xfe:
+        return unpack_from("<I", buf, pos + 1)[0], pos + 5
+    return unpack_from("<Q", buf, pos + 1)[0], pos + 9
+
+############################### Addresses and descriptors ###############################
+def _base58checkEncode(data: bytes) -> str:
+    """Encode data with Base58Check (double SHA256 + Base58)."""
+    data = data + sha256d(data)[:4]
+    n = int.from_bytes(data, 'big')
+    res = bytearray()
+    while n > 0:
+        n, r = divmod(n, 58)
+        res.append(_B58_ALPHABET[r])
+    res.reverse()
+    pad = len(data) - len(data.lstrip(b'\x00'))  # Preserve leading 0x00 bytes as '1'
+    return (b'1' * pad + res).decode()
+
+def _bech32Polymod(values):
+    chk = 1
+    for v in values:
+        b = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            if (b >> i) & 1:
+                chk ^= _GEN[i]
+    return chk
+
+def _segwitAddress(version: int, program) -> str:
+    """Bech32 for witness v0 and Bech32m for every later version."""
+    acc = bits = 0
+    data = [version]
+    for v in program:
+        acc = (acc << 8) | v
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    const = 1 if version == 0 else _BECH32M_CONST
+    polymod = _bech32Polymod(_HRP_EXPAND + data + [0] * 6) ^ const
+    data += [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return _HRP + '1' + ''.join(_CHARSET[d] for d in data)
+
+def descriptorChecksum(desc: str) -> str:
+    """Appends Bitcoin Core's 8 character descriptor checksum."""
+    symbols = []
+    groups = []
+    for c in desc:
+        v = _DESC_INPUT_CHARSET.find(c)
+        symbols.append(v & 31)
+        groups.append(v >> 5)
+        if len(groups) == 3:
+            symbols.append(groups[0] * 9 + groups[1] * 3 + groups[2])
+            groups = []
+    if len(groups) == 1:
+        symbols.append(groups[0])
+    elif len(groups) == 2:
+        symbols.append(groups[0] * 3 + groups[1])
+    chk = 1
+    for value in symbols + [0] * 8:
+        top = chk >> 35
+        chk = (chk & 0x7ffffffff) << 5 ^ value
+        for i in range(5):
+            if (top >> i) & 1:
+                chk ^= _DESC_GEN[i]
+    chk ^= 1
+    return desc + '#' + ''.join(_CHARSET[(chk >> (5 * (7 - i))) & 31] for i in range(8))
+
+def _isValidPubkeySize(key) -> bool:
+    """CPubKey::ValidSize. Includes the hybrid 06/07 encodings, which Solver accepts but descriptors don't."""
+    if not key:
+        return False
+    if key[0] in (2, 3):
+        return len(key) == 33
+    if key[0] in (4, 6, 7):
+        return len(key) == 65
+    return False
+
+def _isNonHybridPubkey(key) -> bool:
+    return (key[0] in (2, 3) and len(key) == 33) or (key[0] == 4 and len(key) == 65)
+
+def _isXOnlyOnCurve(key) -> bool:
+    x = int.from_bytes(key, 'big')
+    if x >= _SECP256K1_P:
+        return False
+    y2 = (pow(x, 3, _SECP256K1_P) + 7) % _SECP256K1_P
+    return pow(y2, (_SECP256K1_P - 1) // 2, _SECP256K1_P) in (0, 1)
+
+def _getPushes(script):
+    """
+    Splits a script into (opcode, pushdata) pairs. pushdata is None for non push opcodes.
+    Returns None if a push runs off the end of the script.
+    """
+    ops = []
+    pos = 0
+    end = len(script)
+    while pos < end:
+        op = script[pos]
+        pos += 1
+        if op <= _OP_PUSHDATA4:
+            if op < _OP_PUSHDATA1:
+                size = op
+            elif op == _OP_PUSHDATA1:
+                if pos + 1 > end:
+                    return None
+                size = script[pos]
+                pos += 1
+            elif op == _OP_PUSHDATA2:
+                if pos + 2 > end:
+                    return None
+                size = unpack_from("<H", script, pos)[0]
+                pos += 2
+            else:
+                if pos + 4 > end:
+                    return None
+                size = unpack_from("<I", script, pos)[0]
+                pos += 4
+            if pos + size > end:
+                return None
+            ops.append((op, script[pos:pos + size]))
+            pos += size
+        else:
+            ops.append((op, None))
+    return ops
+
+def _scriptNumber(op, data):
+    """
+    Small integer from OP_1-OP_16 or a minimal one byte push, which is how Core reads multisig key counts (up to 20).
+    """
+    if _OP_1 <= op <= _OP_16:
+        return op - 0x50
+    if op == 1 and data is not None and 16 < data[0] < 0x80:
+        return data[0]
+    return None
+
+def _matchMultisig(script):
+    """Returns (required, [pubkeys]) for a bare multisig script, or None."""
+    if len(script) < 1 or script[-1] != _OP_CHECKMULTISIG:
+        return None
+    ops = _getPushes(script)
+    if ops is None or len(ops) < 3:
+        return None
+    required, n = _scriptNumber(*ops[0]), _scriptNumber(*ops[-2])
+    if required is None or n is None:
+        return None
+    keys = []
+    for op, data in ops[1:-2]:
+        if data is None or not _isValidPubkeySize(data):
+            return None
+        keys.append(data)
+    if n != len(keys) or required < 1 or required > n or n > 20:
+        return None
+    return required, keys
+
+def classifyScript(script):
+    """
+    Classifies a scriptPubKey the way bitcoind's getblock does.
+    Returns (type, address, descriptor), with None for a missing address.
+    """
+    n = len(script)
+    hexscript = script.hex()
+    # P2SH is checked first, same as Solver.
+    if n == 23 and script[0] == _OP_HASH160 and script[1] == 0x14 and script[22] == _OP_EQUAL:
+        address = _base58checkEncode(b'\x05' + bytes(script[2:22]))
+        return "scripthash", address, descriptorChecksum(f"addr({address})")
+    # Witness programs: a version opcode followed by one 2-40 byte push.
+    if 4 <= n <= 42 and (script[0] == _OP_0 or _OP_1 <= script[0] <= _OP_16) and script[1] + 2 == n:
+        version = 0 if script[0] == _OP_0 else script[0] - 0x50
+        program = script[2:]
+        if version == 0 and len(program) == 20:
+            kind = "witness_v0_keyhash"
+        elif version == 0 and len(program) == 32:
+            kind = "witness_v0_scripthash"
+        elif version == 1 and len(program) == 32:
+            address = _segwitAddress(1, program)
+            if _isXOnlyOnCurve(program):
+                return "witness_v1_taproot", address, descriptorChecksum(f"rawtr({program.hex()})")
+            return "witness_v1_taproot", address, descriptorChecksum(f"addr({address})")
+        elif version == 1 and program == b'\x4e\x73':
+            kind = "anchor"
+        elif version != 0:
+            kind = "witness_unknown"
+        else:
+            return "nonstandard", None, descriptorChecksum(f"raw({hexscript})")
+        address = _segwitAddress(version, program)
+        return kind, address, descriptorChecksum(f"addr({address})")
+    if n >= 1 and script[0] == _OP_RETURN:
+        ops = _getPushes(script[1:])
+        if ops is not None and all(op <= _OP_16 for op, _ in ops):
+            return "nulldata", None, descriptorChecksum(f"raw({hexscript})")
+    if (n == 35 or n == 67) and script[0] == n - 2 and script[-1] == _OP_CHECKSIG and _isValidPubkeySize(script[1:-1]):
+        key = script[1:-1]
+        if _isNonHybridPubkey(key):
+            return "pubkey", None, descriptorChecksum(f"pk({key.hex()})")
+        return "pubkey", None, descriptorChecksum(f"raw({hexscript})")
+    if (n == 25 and script[0] == _OP_DUP and script[1] == _OP_HASH160 and script[2] == 0x14
+            and script[23] == _OP_EQUALVERIFY and script[24] == _OP_CHECKSIG):
+        address = _base58checkEncode(b'\x00' + bytes(script[3:23]))
+        return "pubkeyhash", address, descriptorChecksum(f"addr({address})")
+    multisig = _matchMultisig(script)
+    if multisig is not None:
+        required, keys = multisig
+        if all(_isNonHybridPubkey(k) for k in keys):
+            return "multisig", None, descriptorChecksum(f"multi({required},{','.join(k.hex() for k in keys)})")
+        return "multisig", None, descriptorChecksum(f"raw({hexscript})")
+    return "nonstandard", None, descriptorChecksum(f"raw({hexscript})")
+
+############################### scriptSig asm ###############################
+def _isValidSignatureEncoding(sig) -> bool:
+    """BIP66 strict DER check, copied from Core's interpreter."""
+    size = len(sig)
+    if size < 9 or size > 73 or sig[0] != 0x30 or sig[1] != size - 3:
+        return False
+    len_r = sig[3]
+    if 5 + len_r >= size:
+        return False
+    len_s = sig[5 + len_r]
+    if len_r + len_s + 7 != size or sig[2] != 0x02 or len_r == 0 or sig[4] & 0x80:
+        return False
+    if len_r > 1 and sig[4] == 0x00 and not sig[5] & 0x80:
+        return False
+    if sig[len_r + 4] != 0x02 or len_s == 0 or sig[len_r + 6] & 0x80:
+        return False
+    if len_s > 1 and sig[len_r + 6] == 0x00 and not sig[len_r + 7] & 0x80:
+        return False
+    return True
+
+def scriptToAsm(script, attempt_sighash_decode=True) -> str:
+    """
+    Same output as Core's ScriptToAsmStr, which fills scriptSig.asm. Small pushes print as numbers and signatures get their sighash type decoded.
+    """
+    decode = attempt_sighash_decode and not (len(script) > 0 and script[0] == _OP_RETURN) and len(script) <= 10000
+    parts = []
+    pos = 0
+    end = len(script)
+    while pos < end:
+        op = script[pos]
+        pos += 1
+        if op > _OP_PUSHDATA4:
+            parts.append(_OP_NAMES.get(op, "OP_UNKNOWN"))
+            continue
+        if op < _OP_PUSHDATA1:
+            size = op
+        else:
+            width = {_OP_PUSHDATA1: 1, _OP_PUSHDATA2: 2, _OP_PUSHDATA4: 4}[op]
+            if pos + width > end:
+                parts.append("[error]")
+                break
+            size = int.from_bytes(script[pos:pos + width], 'little')
+            pos += width
+        if pos + size > end:
+            parts.append("[error]")
+            break
+        data = script[pos:pos + size]
+        pos += size
+        if size <= 4:
+            # CScriptNum: little endian sign and magnitude.
+            value = int.from_bytes(data, 'little')
+            if size and data[-1] & 0x80:
+                value = -(value & ~(0x80 << (8 * (size - 1))))
+            parts.append(str(value))
+        elif decode and _isValidSignatureEncoding(data) and data[-1] in _SIGHASH_NAMES:
+            parts.append(data[:-1].hex() + "[" + _SIGHASH_NAMES[data[-1]] + "]")
+        else:
+            parts.append(data.hex())
+    return " ".join(parts)
+
+############################### Blocks ###############################
+def parseHeader(raw):
+    """
+    Reads the 80 byte block header. Hashes are returned in the usual reversed hex RPC order.
+    """
+    header = memoryview(raw)[:80]
+    version, = unpack_from("<i", header, 0)
+    time, bits, nonce = unpack_from("<III", header, 68)
+    return {
+        "hash": sha256d(header)[::-1].hex(),
+        "version": version,
+        "previousblockhash": header[4:36].tobytes()[::-1].hex(),
+        "merkleroot": header[36:68].tobytes()[::-1].hex(),
+        "time": time,
+        "bits": bits,
+        "nonce": nonce,
+    }
+
+def parseRawBlock(raw, mediantime, sink):
+    """
+    Walks a serialized block once and hands every transaction, input and output to `sink`:
+        sink.addTransaction(txid, median_blocktime, miner_time, locktime)
+        sink.addInput(txid, vin_txid, vin_vout, vin_asm, witness_data)
+        sink.addOutput(txid, vout_n, value_sats, desc, address, type)
+    Coinbase inputs get None for vin_txid, vin_vout and vin_asm, like the JSON path. Returns the parsed header.
+    mediantime isn't part of the serialized block, so the caller has to supply it (getblockheader or computed from the previous 11 header times).
+    """
+    buf = memoryview(raw)
+    header = parseHeader(buf)
+    miner_time = header["time"]
+    n_tx, pos = _readVarint(buf, 80)
+    for _ in range(n_tx):
+        tx_start = pos
+        locktime_version = buf[pos:pos + 4]
+        pos += 4
+        segwit = buf[pos] == 0 and buf[pos + 1] == 1  # marker + flag
+        if segwit:
+            pos += 2
+        body_start = pos
+
+        n_in, pos = _readVarint(buf, pos)
+        inputs = []
+        for _ in range(n_in):
+            prev_txid = buf[pos:pos + 32]
+            prev_vout, = unpack_from("<I", buf, pos + 32)
+            script_len, pos = _readVarint(buf, pos + 36)
+            inputs.append((prev_txid, prev_vout, buf[pos:pos + script_len]))
+            pos += script_len + 4  # + nSequence
+
+        n_out, pos = _readVarint(buf, pos)
+        outputs = []
+        for _ in range(n_out):
+            value, = unpack_from("<q", buf, pos)
+            script_len, pos = _readVarint(buf, pos + 8)
+            outputs.append((value, buf[pos:pos + script_len]))
+            pos += script_len
+        body_end = pos
+
+        witnesses = None
+        if segwit:
+            witnesses = []
+            for _ in range(n_in):
+                n_items, pos = _readVarint(buf, pos)
+                items = []
+                for _ in range(n_items):
+                    item_len, pos = _readVarint(buf, pos)
+                    items.append(buf[pos:pos + item_len].hex())
+                    pos += item_len
+                witnesses.append(", ".join(items) if items else None)
+        locktime, = unpack_from("<I", buf, pos)
+        # The txid hashes the serialization without the marker, flag and witnesses, which are all contiguous slices of the block.
+        txid = sha256d(locktime_version, buf[body_start:body_end], buf[pos:pos + 4])[::-1].hex()
+        pos += 4
+
+        sink.addTransaction(txid, mediantime, miner_time, locktime)
+        for i, (prev_txid, prev_vout, script_sig) in enumerate(inputs):
+            witness_data = witnesses[i] if witnesses is not None else None
+            if prev_vout == 0xffffffff and not any(prev_txid):
+                sink.addInput(txid, None, None, None, witness_data)
+            else:
+                sink.addInput(txid, prev_txid.tobytes()[::-1].hex(), prev_vout, scriptToAsm(script_sig), witness_data)
+        for n, (value, script) in enumerate(outputs):
+            kind, address, desc = classifyScript(script)
+            sink.addOutput(txid, n, value, desc, address, kind)
+    return header
+
+class BlockRows:
+    """
+    The simplest sink for parseRawBlock: row tuples in the column order of the transactions, inputs and outputs CSVs.
+    """
+    def __init__(self):
+        self.transactions = []
+        self.inputs = []
+        self.outputs = []
+
+    def addTransaction(self, txid, median_blocktime, miner_time, locktime):
+        self.transactions.append((txid, median_blocktime, miner_time, locktime))
+
+    def addInput(self, txid, vin_txid, vin_vout, vin_asm, witness_data):
+        self.inputs.append((txid, vin_txid, vin_vout, vin_asm, witness_data))
+
+    def addOutput(self, txid, vout_n, value_sats, desc, address, kind):
+        # The RPC reports BTC. sats / 1e8 rounds to the same double as parsing the RPC's 8 decimal string.
+        self.outputs.append((txid, vout_n, value_sats / 1e8, desc, address, kind))
@@ -0,0 +1,171 @@
+# Persistent txid -> dense integer id dictionary. Ids are handed out in the order txids are first interned, which is chain order when the extractor does it.
+# Integer ids are what create_tables.sql wants for transactions.txid: 4 bytes instead of 32 (or 64 as hex text) in every row and index that refers to a transaction.
+# It is an open addressing hash table (linear probing) in a memory mapped file, so it persists between runs and only the pages being probed need to be in memory.
+#   table.i32: one slot per power of two. 0 is empty, otherwise the id + 1 of the txid that hashes there.
+#   keys.u64:  the txid of every id as 4 uint64 words, in id order. The table only stores ids and probes compare against this.
+#   meta.json: how many ids are in use.
+# txids are SHA256d output, so their first 8 bytes are already a uniform hash.
+# DEPENDENCY: Interning the same txid twice returns the same id, so replaying chunks after a crash or a reorg is harmless. Ids of reorged transactions are simply left unused.
+import os
+import json
+import numpy as np
+from numba import njit
+
+max_load = 0.6  # Table is doubled past this load. Linear probing slows down quickly above ~0.7.
+_ID_DTYPE = np.int32  # ~1.1 billion mainnet transactions fit comfortably below 2^31.
+
+
+@njit(inline="always", cache=True)
+def _probe(table, keys, words, count, mask):
+    """
+    Returns (slot, id). id is -1 if the txid isn't in the table, and slot is then where it goes.
+    Slots holding an id >= count were written by a run that crashed before saving its count and are treated as empty.
+    """
+    slot = words[0] & mask
+    while True:
+        v = table[slot]
+        if v == 0 or v - 1 >= count:
+            return slot, -1
+        k = keys[v - 1]
+        if k[0] == words[0] and k[1] == words[1] and k[2] == words[2] and k[3] == words[3]:
+            return slot, v - 1
+        slot = (slot + np.uint64(1)) & mask
+
+@njit(cache=True)
+def _internMany(table, keys, txids, valid, count, out):
+    mask = np.uint64(table.size - 1)
+    for i in range(txids.shape[0]):
+        if not valid[i]:
+            out[i] = -1
+            continue
+        slot, found = _probe(table, keys, txids[i], count, mask)
+        if found == -1:
+            keys[count] = txids[i]
+            table[slot] = count + 1
+            out[i] = count
+            count += 1
+        else:
+            out[i] = found
+    return count
+
+@njit(cache=True)
+def _lookupMany(table, keys, txids, valid, count, out):
+    mask = np.uint64(table.size - 1)
+    for i in range(txids.shape[0]):
+        if valid[i]:
+            out[i] = _probe(table, keys, txids[i], count, mask)[1]
+        else:
+            out[i] = -1
+
+@njit(cache=True)
+def _rehash(table, keys, count):
+    mask = np.uint64(table.size - 1)
+    for i in range(count):
+        slot = keys[i][0] & mask
+        while table[slot] != 0:
+            slot = (slot + np.uint64(1)) & mask
+        table[slot] = i + 1
+
+
+def txidWords(hex_txids):
+    """Hex txids (None allowed) to the (n, 4) uint64 array the interner takes, plus a validity mask. One bytes.fromhex call for the whole list."""
+    valid = np.fromiter((t is not None for t in hex_txids), dtype=bool, count=len(hex_txids))
+    data = bytes.fromhex("".join(t if t is not None else "00" * 32 for t in hex_txids))
+    return np.frombuffer(data, dtype=np.uint64).reshape(-1, 4), valid
+
+class TxidInterner:
+    def __init__(self, path, initial_slots=1 << 20, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, "meta.json")
+        self._table_path = os.path.join(path, "table.i32")
+        self._keys_path = os.path.join(path, "keys.u64")
+        self.count = 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.count = json.load(f)["count"]
+        if not os.path.exists(self._table_path):
+            self._allocate(self._table_path, initial_slots * 4)
+            self._allocate(self._keys_path, int(initial_slots * max_load) * 32)
+        self._open()
+
+    @staticmethod
+    def _allocate(path, size):
+        with open(path, "ab") as f:
+            f.truncate(size)  # sparse, zero filled
+
+    def _open(self):
+        mode = "r" if self.readonly else "r+"
+        # Sizes come from the files, so a crash between growing a file and saving meta.json can't leave them inconsistent.
+        self.table = np.memmap(self._table_path, dtype=_ID_DTYPE, mode=mode)
+        self.keys = np.memmap(self._keys_path, dtype=np.uint64, mode=mode).reshape(-1, 4)
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, n):
+        """Grows the key file and the table so `n` more ids fit under max_load."""
+        needed = self.count + n
+        if needed > self.keys.shape[0]:
+            capacity = max(needed, 2 * self.keys.shape[0])
+            self.keys.flush()
+            del self.keys
+            self._allocate(self._keys_path, capacity * 32)
+            self.keys = np.memmap(self._keys_path, dtype=np.uint64, mode="r+").reshape(-1, 4)
+        slots = self.table.size
+        while needed > slots * max_load:
+            slots *= 2
+        if slots != self.table.size:
+            tmp_path = self._table_path + ".tmp"
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._allocate(tmp_path, slots * 4)
+            table = np.memmap(tmp_path, dtype=_ID_DTYPE, mode="r+")
+            _rehash(table, self.keys, self.count)
+            table.flush()
+            del table
+            self.table.flush()
+            del self.table
+            os.replace(tmp_path, self._table_path)
+            self.table = np.memmap(self._table_path, dtype=_ID_DTYPE, mode="r+")
+
+    def intern(self, txids, valid=None):
+        """
+        Ids for an (n, 4) uint64 array of txids, assigning the next free ids, in order, to ones not seen before. Invalid rows get -1.
+        """
+        if self.readonly:
+            raise ValueError("TxidInterner was opened read only.")
+        if valid is None:
+            valid = np.ones(len(txids), dtype=bool)
+        self._reserve(int(valid.sum()))
+        out = np.empty(len(txids), dtype=np.int64)
+        self.count = _internMany(self.table, self.keys, txids, valid, self.count, out)
+        return out
+
+    def lookup(self, txids, valid=None):
+        """Ids for an (n, 4) uint64 array of txids. Unknown and invalid rows get -1. Nothing is added."""
+        if valid is None:
+            valid = np.ones(len(txids), dtype=bool)
+        out = np.empty(len(txids), dtype=np.int64)
+        _lookupMany(self.table, self.keys, txids, valid, self.count, out)
+        return out
+
+    def txids(self, ids):
+        """Hex txids of an array of ids."""
+        return [bytes(k).hex() for k in self.keys[np.asarray(ids)]]
+
+    def flush(self):
+        """Writes the table to disk and then saves the count, which is what makes the new ids permanent."""
+        if self.readonly:
+            return
+        self.keys.flush()
+        self.table.flush()
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"count": self.count}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def close(self):
+        self.flush()
+        del self.table, self.keys
@@ -0,0 +1,119 @@
+# Persistent UTXO map for extract_bitcoin_data_beta.py. Lets every input row carry the value, type and address of the output it spends.
+# With that on the inputs, findRevealedPkeys and commonSpendCluster scan inputs instead of joining billions of inputs to outputs.
+# Raw blocks (getblock 0 and blk*.dat) don't say what an input spends, so unspent outputs are kept in LMDB keyed by outpoint, applied a chunk at a time in chain order.
+# Outputs created and spent inside the same chunk never touch the disk. JSON mode gets the same columns from getblock verbosity 3 and doesn't need this.
+# Every applied chunk leaves an undo record, so a resume after a crash or a reorg can roll the map back to where the manifest says extraction stopped.
+import os
+import pickle
+from struct import pack, unpack_from
+try:
+    import lmdb
+except ImportError:  # Only needed to resolve prevouts of raw blocks.
+    lmdb = None
+
+# Output types seen in Bitcoin Core's scriptPubKey "type", stored as one byte.
+OUTPUT_TYPES = [
+    "nonstandard", "pubkey", "pubkeyhash", "scripthash", "multisig", "nulldata",
+    "witness_v0_keyhash", "witness_v0_scripthash", "witness_v1_taproot", "witness_unknown", "anchor",
+]
+_TYPE_CODES = {kind: code for code, kind in enumerate(OUTPUT_TYPES)}
+_HEIGHT_KEY = b"height"
+
+
+def _encodeCoin(value_sats, kind, address):
+    return pack("<qB", value_sats, _TYPE_CODES[kind]) + (address or "").encode()
+
+def _decodeCoin(data):
+    value_sats, code = unpack_from("<qB", data)
+    return value_sats, OUTPUT_TYPES[code], bytes(data[9:]).decode() or None
+
+class UtxoMap:
+    """
+    LMDB environment with three databases:
+        utxo: outpoint key -> value_sats, type and address of every unspent output
+        undo: chunk end height -> (previous height, outpoints the chunk created, coins it spent)
+        meta: the height the map has been applied through
+    """
+    def __init__(self, path, keep_undo=10, map_size=1 << 40):
+        if lmdb is None:
+            raise ImportError("lmdb is required to resolve prevouts of raw blocks (pip install lmdb).")
+        os.makedirs(path, exist_ok=True)
+        # map_size only reserves address space, the file grows as it fills. writemap and no metasync trade crash durability of the last commit for speed, undo records cover that.
+        self.env = lmdb.open(path, map_size=map_size, max_dbs=3, writemap=True, metasync=False)
+        self._utxo = self.env.open_db(b"utxo")
+        self._undo = self.env.open_db(b"undo")
+        self._meta = self.env.open_db(b"meta")
+        self.keep_undo = keep_undo
+
+    def height(self):
+        """Height the map has been applied through, -1 when empty."""
+        with self.env.begin(db=self._meta) as txn:
+            data = txn.get(_HEIGHT_KEY)
+        return -1 if data is None else unpack_from(">q", data)[0]
+
+    def applyChunk(self, chunk_start, chunk_end, columns):
+        """
+        Resolves the prevout of every input in `columns` (a ChunkColumns or ArrowChunk), then adds the chunk's unspent outputs and removes what it spent, in one transaction.
+        Chunks have to be applied in chain order. Returns the number of inputs whose prevout couldn't be found (spending outputs from before the map's first chunk).
+        """
+        previous = self.height()
+        if previous != -1 and chunk_start != previous + 1:
+            raise ValueError(f"UTXO map is at height {previous}, can't apply blocks {chunk_start} to {chunk_end}.")
+        out_keys, out_rows, in_keys = columns.outpoints()
+        # nulldata outputs are provably unspendable, so they never need to be looked up.
+        created = {key: row for key, row in zip(out_keys, out_rows) if row[1] != "nulldata"}
+        prevouts = []
+        spent = []
+        missing = 0
+        with self.env.begin(write=True) as txn:
+            for key in in_keys:
+                if key is None:
+                    prevouts.append(None)
+                    continue
+                coin = created.pop(key, None)
+                if coin is None:
+                    data = txn.pop(key, db=self._utxo)
+                    if data is None:
+                        missing += 1
+                    else:
+                        spent.append((key, data))
+                        coin = _decodeCoin(data)
+                prevouts.append(coin)
+            txn.cursor(db=self._utxo).putmulti((key, _encodeCoin(*row)) for key, row in created.items())
+            undo = (previous, list(created), spent)
+            txn.put(pack(">q", chunk_end), pickle.dumps(undo, protocol=pickle.HIGHEST_PROTOCOL), db=self._undo)
+            txn.put(_HEIGHT_KEY, pack(">q", chunk_end), db=self._meta)
+            # Only the newest keep_undo chunks can be rolled back.
+            cursor = txn.cursor(db=self._undo)
+            n_undo = txn.stat(self._undo)["entries"]
+            cursor.first()
+            while n_undo > self.keep_undo:
+                cursor.delete()
+                n_undo -= 1
+        columns.setPrevouts(prevouts)
+        return missing
+
+    def rollback(self, height):
+        """
+        Undoes applied chunks until the map is at `height` (the last height extraction kept). Raises if that needs more undo records than are kept.
+        """
+        while self.height() > height:
+            with self.env.begin(write=True) as txn:
+                current = unpack_from(">q", txn.get(_HEIGHT_KEY, db=self._meta))[0]
+                data = txn.pop(pack(">q", current), db=self._undo)
+                if data is None:
+                    raise RuntimeError(f"UTXO map is at height {current} and has no undo record to go back to {height}. Delete {self.env.path()} and extract from the start.")
+                previous, created, spent = pickle.loads(data)
+                for key in created:
+                    txn.delete(key, db=self._utxo)
+                txn.cursor(db=self._utxo).putmulti(spent)
+                if previous == -1:
+                    txn.delete(_HEIGHT_KEY, db=self._meta)
+                else:
+                    txn.put(_HEIGHT_KEY, pack(">q", previous), db=self._meta)
+            print(f"Rolled the UTXO map back from height {current} to {previous}.")
+        if self.height() < height:
+            raise RuntimeError(f"UTXO map is at height {self.height()} but extraction resumes after {height}. Delete {self.env.path()} and extract from the start.")
+
+    def close(self):
+        self.env.close()
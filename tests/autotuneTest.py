@@ -0,0 +1,85 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from autotune import tuneSettings, systemResources, pgSize, ChunkSizer
+
+GB = 1 << 30
+LAPTOP = {"total_ram": 16 * GB, "available_ram": 10 * GB, "cores": 4, "free_disk": 200 * GB}
+SERVER = {"total_ram": 256 * GB, "available_ram": 240 * GB, "cores": 64, "free_disk": None}
+
+
+def megabytes(setting):
+    return int(setting[:-2])
+
+
+class testTuneSettings(unittest.TestCase):
+
+    def testScalesWithTheMachine(self):
+        laptop, server = tuneSettings(LAPTOP), tuneSettings(SERVER)
+        self.assertEqual(laptop["ncores"], 4)
+        self.assertEqual(server["ncores"], 64)
+        self.assertGreaterEqual(server["chunk_size_pythonwork"], laptop["chunk_size_pythonwork"])
+        for stage in ("python", "psql"):
+            for setting in ("work_mem", "maintenance_work_mem"):
+                self.assertGreater(megabytes(server[stage][setting]), megabytes(laptop[stage][setting]))
+        self.assertIsNone(server["rewrite_budget"])
+        self.assertEqual(laptop["rewrite_budget"], 50 * GB)
+
+    def testStaysInsideTheBudget(self):
+        for resources in (LAPTOP, SERVER):
+            settings = tuneSettings(resources)
+            workers = settings["ncores"] * (settings["worker_rss_limit"] + megabytes(settings["python"]["maintenance_work_mem"]) * (1 << 20))
+            self.assertLessEqual(workers, resources["available_ram"])
+            self.assertLessEqual(megabytes(settings["psql"]["maintenance_work_mem"]) * (1 << 20), resources["available_ram"])
+
+    def testFewWorkersOnSmallMachines(self):
+        settings = tuneSettings({"total_ram": 4 * GB, "available_ram": 2 * GB, "cores": 16, "free_disk": None})
+        self.assertEqual(settings["ncores"], 1)
+
+    def testDetection(self):
+        resources = systemResources(os.path.dirname(os.path.abspath(__file__)))
+        self.assertGreater(resources["available_ram"], 0)
+        self.assertGreaterEqual(resources["cores"], 1)
+        self.assertGreater(resources["free_disk"], 0)
+
+    def testPgSize(self):
+        self.assertEqual(pgSize(3 * GB), "3072MB")
+        self.assertEqual(pgSize(10), "1MB")
+
+
+class testChunkSizer(unittest.TestCase):
+
+    def testGrowsWhileThroughputImproves(self):
+        sizer = ChunkSizer(1000, maximum=100000, rss=lambda: 0)
+        sizer.record(1000, 1.0)
+        self.assertEqual(sizer.size, 1500)
+        sizer.record(1500, 1.0)  # 1500 rows/s, better
+        self.assertEqual(sizer.size, 2250)
+        sizer.record(2250, 3.0)  # 750 rows/s, worse: turns around
+        self.assertEqual(sizer.size, 1500)
+
+    def testHoldsWhenFlat(self):
+        sizer = ChunkSizer(1000, rss=lambda: 0)
+        sizer.record(1000, 1.0)
+        sizer.record(1500, 1.5)
+        self.assertEqual(sizer.size, 1500)
+
+    def testShrinksPastTheRssLimit(self):
+        rss = [0]
+        sizer = ChunkSizer(8000, minimum=1000, rss_limit=100, rss=lambda: rss[0])
+        rss[0] = 500
+        sizer.record(8000, 1.0)
+        self.assertEqual(sizer.size, 4000)
+        for _ in range(5):
+            sizer.record(sizer.size, 1.0)
+        self.assertEqual(sizer.size, 1000)
+
+    def testIgnoresPartialChunksAndUnknownRss(self):
+        sizer = ChunkSizer(1000, rss_limit=100, rss=lambda: None)
+        sizer.record(10, 0.001)
+        self.assertEqual(sizer.size, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from struct import pack
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from blk_file_reader import BlkFileReader, MAINNET_MAGIC, blockWork
+from raw_block_parser import sha256d, parseRawBlock, BlockRows
+
+# These tests write small synthetic chains to blk*.dat files, the same way bitcoind lays them out, and read them back.
+
+def makeBlock(prev_hash, time, tag, bits=0x207fffff):
+    """A block holding only a coinbase. `tag` goes in the coinbase script so sibling blocks get different hashes. `bits` isn't checked against the hash."""
+    coinbase = (
+        pack("<I", 1) + b"\x01" + bytes(32) + b"\xff\xff\xff\xff" + bytes([len(tag)]) + tag + b"\xff\xff\xff\xff"
+        + b"\x01" + pack("<q", 5000000000) + b"\x01\x51" + pack("<I", 0)
+    )
+    header = pack("<I", 1) + prev_hash + sha256d(coinbase) + pack("<III", time, bits, 0)
+    return header + b"\x01" + coinbase, sha256d(header)
+
+def writeBlkFile(path, blocks, xor_key):
+    data = bytearray()
+    for block in blocks:
+        data += MAINNET_MAGIC + pack("<I", len(block)) + block
+    data += bytes(64)  # bitcoind preallocates files with zeros
+    with open(path, "wb") as f:
+        f.write(bytes(b ^ xor_key[i % 8] for i, b in enumerate(data)))
+
+
+class testBlkFileReader(unittest.TestCase):
+
+    def setUp(self):
+        self.blocks_dir = tempfile.mkdtemp()
+        # Main chain of 14 blocks plus a stale sibling at height 3.
+        self.chain = []
+        prev = bytes(32)
+        for height in range(14):
+            block, block_hash = makeBlock(prev, 1000 + 600 * height - (300 if height % 3 == 0 else 0), b"%d" % height)
+            self.chain.append((block, block_hash))
+            prev = block_hash
+        self.stale, _ = makeBlock(self.chain[2][1], 99999, b"stale")
+
+    def tearDown(self):
+        shutil.rmtree(self.blocks_dir)
+
+    def _write(self, xor_key):
+        blocks = [b for b, _ in self.chain]
+        # Out of order across and within files, like a headers first sync.
+        writeBlkFile(os.path.join(self.blocks_dir, "blk00000.dat"), [blocks[0], blocks[2], blocks[1], self.stale] + blocks[3:7], xor_key)
+        writeBlkFile(os.path.join(self.blocks_dir, "blk00001.dat"), blocks[10:] + blocks[7:10], xor_key)
+        if any(xor_key):
+            with open(os.path.join(self.blocks_dir, "xor.dat"), "wb") as f:
+                f.write(xor_key)
+
+    def _checkChain(self):
+        reader = BlkFileReader(self.blocks_dir)
+        try:
+            self.assertEqual(len(reader), 14)
+            for height, (block, block_hash) in enumerate(self.chain):
+                self.assertEqual(reader.blockHash(height), block_hash[::-1].hex())
+                self.assertEqual(bytes(reader.readBlock(height)), block)
+            heights = [h for h, _ in reader.iterBlocks(5, 100)]
+            self.assertEqual(heights, list(range(5, 14)))
+            times = [1000 + 600 * h - (300 if h % 3 == 0 else 0) for h in range(14)]
+            self.assertEqual(reader.medianTime(13), sorted(times[3:14])[5])
+            self.assertEqual(reader.medianTime(1), max(times[0:2]))
+            rows = BlockRows()
+            parseRawBlock(reader.readBlock(4), reader.medianTime(4), rows)
+            self.assertEqual(len(rows.transactions), 1)
+        finally:
+            reader.close()
+
+    def testPlainFiles(self):
+        self._write(bytes(8))
+        self._checkChain()
+
+    def testObfuscatedFiles(self):
+        self._write(bytes.fromhex("a1b2c3d4e5f60718"))
+        self._checkChain()
+
+    def testMostWorkWinsOverHeight(self):
+        # Two harder blocks after height 9 outweigh the main chain's four easier ones.
+        heavy, heavy_hash = makeBlock(self.chain[9][1], 99999, b"heavy10", bits=0x1d00ffff)
+        heavier, heavier_hash = makeBlock(heavy_hash, 99999, b"heavy11", bits=0x1d00ffff)
+        writeBlkFile(os.path.join(self.blocks_dir, "blk00000.dat"), [b for b, _ in self.chain] + [heavy, heavier], bytes(8))
+        reader = BlkFileReader(self.blocks_dir)
+        try:
+            self.assertEqual(len(reader), 12)
+            self.assertEqual(reader.blockHash(9), self.chain[9][1][::-1].hex())
+            self.assertEqual(reader.blockHash(11), heavier_hash[::-1].hex())
+        finally:
+            reader.close()
+
+    def testBlockWork(self):
+        self.assertEqual(blockWork(0x1d00ffff), 0x100010001)  # Genesis difficulty, as Bitcoin Core reports its chainwork
+        self.assertEqual(blockWork(0x207fffff), 2)
+        self.assertEqual(blockWork(0x1d80ffff), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import shutil
+import tempfile
+import copy
+import unittest
+import pandas as pd
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from chunk_columns import ChunkColumns, ArrowChunk, flattenBlock, writeArrowChunk, readArrowChunk, tablesToSharedMemory, tablesFromSharedMemory
+from raw_block_parser import parseRawBlock
+from rawBlockParserTest import GENESIS, GENESIS_PUBKEY
+
+# getblock <genesis hash> 2, trimmed to the fields the flattener reads.
+GENESIS_JSON = {
+    "hash": "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f",
+    "time": 1231006505,
+    "mediantime": 1231006505,
+    "tx": [{
+        "txid": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+        "locktime": 0,
+        "vin": [{"coinbase": "04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73", "sequence": 4294967295}],
+        "vout": [{
+            "value": 50.00000000,
+            "n": 0,
+            "scriptPubKey": {"desc": f"pk({GENESIS_PUBKEY})#vlz6ztea", "type": "pubkey"},
+        }],
+    }],
+}
+
+SPEND_JSON = {
+    "time": 1231469665,
+    "mediantime": 1231469000,
+    "tx": [{
+        "txid": "f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9831e9e16",
+        "locktime": 0,
+        "vin": [{
+            "txid": "0437cd7f8525ceed2324359c2d0ba26006d92d856a9c20fa0241106ee5a597c9",
+            "vout": 0,
+            "scriptSig": {"asm": "304402204e45e16932b8af514961a1d3a1a25fdf3f4f7732e9d624c6c61548ab5fb8cd410220181522ec8eca07de4860a4acdd12909d831cc56cbbac4622082221a8768d1d09[ALL]"},
+            "txinwitness": ["00", "ab"],
+        }],
+        "vout": [
+            {"value": 10.0, "n": 0, "scriptPubKey": {"desc": "pk(04ae1a)#x", "type": "pubkey"}},
+            {"value": 0.00012345, "n": 1, "scriptPubKey": {"desc": "addr(1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa)#y", "address": "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa", "type": "pubkeyhash"}},
+        ],
+    }],
+}
+
+
+class testChunkColumns(unittest.TestCase):
+
+    def testJsonMatchesRaw(self):
+        from_json = ChunkColumns()
+        flattenBlock(GENESIS_JSON, from_json)
+        from_raw = ChunkColumns()
+        parseRawBlock(GENESIS, 1231006505, from_raw)
+        for json_df, raw_df in zip(from_json.frames(), from_raw.frames()):
+            pd.testing.assert_frame_equal(json_df, raw_df)
+
+    def testChunkFrames(self):
+        columns = ChunkColumns()
+        flattenBlock(GENESIS_JSON, columns)
+        flattenBlock(SPEND_JSON, columns)
+        tx_df, vin_df, vout_df = columns.frames()
+        self.assertEqual(len(tx_df), 2)
+        self.assertEqual(list(tx_df["median_blocktime"]), [1231006505, 1231469000])
+        self.assertTrue(pd.isna(vin_df["vin_vout"][0]))
+        self.assertEqual(vin_df["vin_vout"][1], 0)
+        self.assertEqual(vin_df["witness_data"][1], "00, ab")
+        self.assertEqual(list(vout_df["vout_value"]), [50.0, 10.0, 0.00012345])
+        self.assertEqual(list(vout_df["vout_n"]), [0, 0, 1])
+        self.assertEqual(vin_df.to_csv(index=False).splitlines()[1], "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b,,,,,,,,,,")
+        self.assertTrue(pd.isna(vin_df["prevout_value"][1]))
+
+    def testVerbosity3Prevouts(self):
+        block = copy.deepcopy(SPEND_JSON)
+        block["tx"][0]["vin"][0]["prevout"] = {
+            "generated": True, "height": 9, "value": 50.0,
+            "scriptPubKey": {"desc": "pk(0411db93e1)#z", "type": "pubkey"},
+        }
+        columns = ChunkColumns()
+        flattenBlock(block, columns)
+        _, vin_df, _ = columns.frames()
+        self.assertEqual(list(vin_df.iloc[0][["prevout_value", "prevout_type", "prevout_address"]]), [50.0, "pubkey", "0411db93e1"])
+
+
+    def testArrowRoundTrip(self):
+        columns = ChunkColumns()
+        flattenBlock(GENESIS_JSON, columns)
+        flattenBlock(SPEND_JSON, columns)
+        tables = columns.arrowTables(0, 1)
+        directory = tempfile.mkdtemp()
+        try:
+            for output_format in ("parquet", "arrow"):
+                paths = [os.path.join(directory, f"{name}_chunk_1.{output_format}") for name in ("transactions", "inputs", "outputs")]
+                writeArrowChunk(tables, paths, output_format)
+                inputs, height_range = readArrowChunk(paths[1])
+                outputs, _ = readArrowChunk(paths[2])
+                self.assertEqual(height_range, (0, 1))
+                self.assertEqual(inputs.column("vin_txid").to_pylist(), [None, bytes.fromhex(SPEND_JSON["tx"][0]["vin"][0]["txid"])])
+                self.assertEqual(inputs.column("vin_vout").to_pylist(), [None, 0])
+                self.assertEqual(outputs.column("vout_value").to_pylist(), [5000000000, 1000000000, 12345])
+                self.assertEqual(outputs.column("vout_scriptPubKey_type").to_pylist(), ["pubkey", "pubkey", "pubkeyhash"])
+        finally:
+            shutil.rmtree(directory)
+
+    def testSharedMemoryPieces(self):
+        # Decode farm workers hand back one piece per task. The assembled chunk must match decoding everything in one process.
+        whole = ChunkColumns()
+        chunk = ArrowChunk()
+        for height, block in enumerate((GENESIS_JSON, SPEND_JSON)):
+            flattenBlock(block, whole)
+            piece = ChunkColumns()
+            flattenBlock(block, piece)
+            name, sizes = tablesToSharedMemory(piece.arrowTables(height, height))
+            chunk.append(tablesFromSharedMemory(name, sizes))
+        self.assertEqual(len(chunk), 2)
+        for farmed_df, whole_df in zip(chunk.frames(), whole.frames()):
+            pd.testing.assert_frame_equal(farmed_df, whole_df)
+        for farmed, table in zip(chunk.arrowTables(0, 1), whole.arrowTables(0, 1)):
+            self.assertTrue(farmed.combine_chunks().equals(table))
+            self.assertEqual(farmed.schema.metadata, table.schema.metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
+import os
+import sys
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import numpy.testing as npt  
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from cscUnionFind import cscUnionFind, cscUnionFindParallel, cscUnionFindOutOfCore, UnionFindState
 
 class testcscUnionFind(unittest.TestCase):
 
+    unionFind = staticmethod(cscUnionFind)
+
     def testSingleGroup(self):
         data = np.array([
             [1, 2],
@@ -15,7 +23,7 @@ class testcscUnionFind(unittest.TestCase):
             [3, 0],
             [4, 0]
         ], dtype=np.int32)
-        result = cscUnionFind(data)
+        result = self.unionFind(data)
         npt.assert_array_equal(result, expected)
 
     def testMultipleGroups(self):
@@ -35,7 +43,7 @@ class testcscUnionFind(unittest.TestCase):
             [8, 2],
             [9, 2]
         ], dtype=np.int32)
-        result = cscUnionFind(data)
+        result = self.unionFind(data)
         npt.assert_array_equal(result, expected)
 
     def testDisconnectedGroups(self):
@@ -51,7 +59,7 @@ class testcscUnionFind(unittest.TestCase):
             [4, 2],
             [5, 3]
         ], dtype=np.int32)
-        result = cscUnionFind(data)
+        result = self.unionFind(data)
         npt.assert_array_equal(result, expected)
 
     def testChainConnection(self):
@@ -71,7 +79,7 @@ class testcscUnionFind(unittest.TestCase):
             [5, 1],
             [10, 0]
         ], dtype=np.int32)
-        result = cscUnionFind(data)
+        result = self.unionFind(data)
         npt.assert_array_equal(result, expected)
 
     def testRepeatedWallets(self):
@@ -87,8 +95,197 @@ class testcscUnionFind(unittest.TestCase):
             [3, 0],
             [4, 0]
         ], dtype=np.int32)
-        result = cscUnionFind(data)
+        result = self.unionFind(data)
         npt.assert_array_equal(result, expected)
+    def testSparseIds(self):
+        rng = np.random.default_rng(7)
+        edges = randomEdges(rng, 5000, 2000, 4000)
+        spread = edges.astype(np.int64) * 1000003 - 7  # Negative tx ids, wallet ids past 2^31
+        result = self.unionFind(spread)
+        dense = self.unionFind(edges)
+        self.assertEqual(result.dtype, np.int64)
+        npt.assert_array_equal(result[:, 0], dense[:, 0].astype(np.int64) * 1000003 - 7)
+        npt.assert_array_equal(result[:, 1], dense[:, 1])
+
+    def testHugeIdDoesntAllocate(self):
+        data = np.array([[2 ** 40, 5], [2 ** 40, 2 ** 35], [7, 5], [7, 3]], dtype=np.int64)
+        expected = np.array([[3, 0], [5, 0], [2 ** 35, 0]], dtype=np.int64)
+        npt.assert_array_equal(self.unionFind(data), expected)
+
+    def testSparseIdsThatFitInt32(self):
+        data = np.array([[1, 2 ** 30], [1, 7], [2, 2 ** 29]], dtype=np.int32)
+        expected = np.array([[7, 0], [2 ** 29, 1], [2 ** 30, 0]], dtype=np.int32)
+        result = self.unionFind(data)
+        self.assertEqual(result.dtype, np.int32)
+        npt.assert_array_equal(result, expected)
+
+
+class testcscUnionFindParallel(testcscUnionFind):
+
+    unionFind = staticmethod(cscUnionFindParallel)
+
+    def testMatchesSerial(self):
+        rng = np.random.default_rng(6)
+        for n_edges, n_txs, n_wallets in ((20000, 8000, 15000), (50000, 500, 2000), (5000, 5000, 100000)):
+            with self.subTest(n_edges=n_edges):
+                edges = rng.permutation(randomEdges(rng, n_edges, n_txs, n_wallets))
+                npt.assert_array_equal(cscUnionFindParallel(edges), cscUnionFind(edges))
+
+    def testEmpty(self):
+        self.assertEqual(len(cscUnionFindParallel(np.empty((0, 2), dtype=np.int32))), 0)
+
+
+def randomEdges(rng, n_edges, n_txs, n_wallets):
+    """A random spend edge list sorted by transaction, like exportSpendEdges writes."""
+    edges = np.column_stack((rng.integers(0, n_txs, n_edges), rng.integers(1, n_wallets + 1, n_edges))).astype(np.int32)
+    return edges[np.argsort(edges[:, 0], kind="stable")]
+
+
+class testcscUnionFindOutOfCore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "edges.i32")
+        self.work_dir = os.path.join(self.dir, "union_find")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def outOfCore(self, edges, **kwargs):
+        edges.tofile(self.path)
+        return np.array(cscUnionFindOutOfCore(self.path, self.work_dir, **kwargs))
+
+    def testSortedMatchesInMemory(self):
+        edges = randomEdges(np.random.default_rng(1), 20000, 8000, 15000)
+        for chunk_rows in (7, 1000, 1 << 24):
+            with self.subTest(chunk_rows=chunk_rows):
+                npt.assert_array_equal(self.outOfCore(edges, chunk_rows=chunk_rows), cscUnionFind(edges))
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "tx_first.bin")))
+
+    def testUnsortedMatchesInMemory(self):
+        rng = np.random.default_rng(2)
+        edges = rng.permutation(randomEdges(rng, 20000, 8000, 15000))
+        npt.assert_array_equal(self.outOfCore(edges, chunk_rows=999), cscUnionFind(edges))
+
+    def testChunkDirectory(self):
+        edges = randomEdges(np.random.default_rng(3), 5000, 2000, 4000)
+        os.makedirs(os.path.join(self.dir, "chunks"))
+        for i, part in enumerate(np.array_split(edges, 4)):
+            part.tofile(os.path.join(self.dir, "chunks", f"{i:04d}.i32"))
+        result = cscUnionFindOutOfCore(os.path.join(self.dir, "chunks"), self.work_dir, chunk_rows=300)
+        npt.assert_array_equal(result, cscUnionFind(edges))
+
+    def testExistingCases(self):
+        data = np.array([[1, 2], [1, 3], [2, 3], [2, 4], [3, 5], [5, 3], [5, 10]], dtype=np.int32)
+        npt.assert_array_equal(self.outOfCore(data, chunk_rows=2, n_wallets=10), cscUnionFind(data))
+
+    def testEmpty(self):
+        self.assertEqual(self.outOfCore(np.empty((0, 2), dtype=np.int32)).shape, (0, 2))
+
+
+class testUnionFindState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.dir, "state")
+        rng = np.random.default_rng(4)
+        self.edges = randomEdges(rng, 20000, 8000, 15000)
+        self.day1, self.day2 = self.edges[self.edges[:, 0] < 6000], self.edges[self.edges[:, 0] >= 6000]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, edges, name):
+        path = os.path.join(self.dir, name)
+        edges.tofile(path)
+        return path
+
+    def fullRows(self, edges, name):
+        state = UnionFindState(os.path.join(self.dir, name))
+        state.apply(self.write(edges, name + ".i32"), log=False)
+        return np.array(state.rows(os.path.join(self.dir, name + ".bin")))
+
+    def testRootsNameTheSameClustersAsCscUnionFind(self):
+        rows = self.fullRows(self.edges, "full")
+        dense = cscUnionFind(self.edges)
+        npt.assert_array_equal(rows[:, 0], dense[:, 0])
+        self.assertTrue((rows[:, 1] <= rows[:, 0]).all())
+        npt.assert_array_equal(np.unique(rows[:, 1], return_inverse=True)[1], dense[:, 1])
+
+    def testIncrementalMatchesFull(self):
+        state = UnionFindState(self.state_dir)
+        self.assertIsNone(state.apply(self.write(self.day1, "day1.i32"), n_wallets=int(self.day1[:, 1].max()), log=False))
+        clusters = {wallet: root for wallet, root in state.rows(os.path.join(self.dir, "rows.bin")).tolist()}
+        state.save()
+        del state
+
+        state = UnionFindState(self.state_dir)
+        self.assertEqual(state.last_tx, int(self.day1[:, 0].max()))
+        merges, added = state.apply(self.write(self.day2, "day2.i32"))
+        state.save()
+        self.assertEqual(state.last_tx, int(self.edges[:, 0].max()))
+        merged = dict(merges.tolist())
+        clusters = {wallet: merged.get(root, root) for wallet, root in clusters.items()}
+        clusters.update(added.tolist())
+        self.assertEqual(sorted(clusters.items()), [tuple(row) for row in self.fullRows(self.edges, "full").tolist()])
+
+    def testReappliedEdgesChangeNothing(self):
+        state = UnionFindState(self.state_dir)
+        path = self.write(self.edges, "edges.i32")
+        state.apply(path, log=False)
+        merges, added = state.apply(path)
+        self.assertEqual((len(merges), len(added)), (0, 0))
+
+    def testUnsortedBatch(self):
+        state = UnionFindState(self.state_dir)
+        state.apply(self.write(self.day1, "day1.i32"), log=False)
+        before = {wallet: root for wallet, root in state.rows(os.path.join(self.dir, "rows.bin")).tolist()}
+        merges, added = state.apply(self.write(np.random.default_rng(5).permutation(self.day2), "day2.i32"))
+        merged = dict(merges.tolist())
+        clusters = {wallet: merged.get(root, root) for wallet, root in before.items()}
+        clusters.update(added.tolist())
+        self.assertEqual(sorted(clusters.items()), [tuple(row) for row in self.fullRows(self.edges, "full").tolist()])
+
+    def testRemappedWallets(self):
+        # Between the runs normalization moves the keys of some day 1 wallets to other wallets, old ones and new ones.
+        rng = np.random.default_rng(6)
+        old = rng.choice(np.unique(self.day1[:, 1]), 300, replace=False)
+        new = np.where(rng.random(300) < 0.5, rng.integers(1, 15000, 300), 15001 + np.arange(300))
+        relabel = np.arange(15301 + 1)
+        relabel[old] = new
+        moved_edges = np.column_stack([self.edges[:, 0], relabel[self.edges[:, 1]]]).astype(np.int32)
+
+        state = UnionFindState(self.state_dir)
+        state.apply(self.write(self.day1, "day1.i32"), log=False)
+        clusters = {wallet: root for wallet, root in state.rows(os.path.join(self.dir, "rows.bin")).tolist()}
+        last_tx = state.last_tx
+        for changes in (state.remap(np.column_stack([old, new])), state.apply(self.write(moved_edges[self.edges[:, 0] >= 6000], "day2.i32"))):
+            merged = dict(changes[0].tolist())
+            clusters = {wallet: merged.get(root, root) for wallet, root in clusters.items()}
+            clusters.update(changes[1].tolist())
+        self.assertEqual(state.last_tx, max(last_tx, int(self.edges[:, 0].max())))
+        self.assertEqual(sorted(clusters.items()), [tuple(row) for row in state.rows(os.path.join(self.dir, "rows.bin")).tolist()])
+
+        # The wallets that still have keys are clustered like a full run over the moved edges. The old wallets only add themselves to their new wallet's cluster.
+        full = self.fullRows(moved_edges, "full")
+        live = {wallet: clusters[wallet] for wallet in full[:, 0].tolist()}
+        def groups(labels):
+            members = {}
+            for wallet, label in sorted(labels.items()):
+                members.setdefault(label, []).append(wallet)
+            return sorted(members.values())
+        self.assertEqual(groups(live), groups(dict(full.tolist())))
+
+    def testUnsavedStateOpensEmpty(self):
+        state = UnionFindState(self.state_dir)
+        state.apply(self.write(self.day1, "day1.i32"), log=False)
+        state.save()
+        state.apply(self.write(self.day2, "day2.i32"))  # Crashes before save()
+        del state
+        state = UnionFindState(self.state_dir)
+        self.assertTrue(state.empty)
+        self.assertEqual(state.last_tx, -1)
+
 
 if __name__ == '__main__':
     unittest.main()
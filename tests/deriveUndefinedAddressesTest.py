@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from deriveUndefinedAddresses import deriveAddressBatch, deriveKeyBatch, canonicalKeys, p2pkhAddress, p2wpkhAddress, compressPubkey
+
+# The generator point, the public key of private key 1.
+G_UNCOMPRESSED = "0479be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8"
+G_COMPRESSED = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+# A key whose y coordinate is odd.
+ODD_UNCOMPRESSED = "04fff97bd5755eeea420453a14355235d382f6472f8568a18b2f057a1460297556ae12777aacfbb620f3be96017f45c560de80f0f6518fe4a03c870c36b075f297"
+
+
+class testDeriveAddressBatch(unittest.TestCase):
+
+    def testKnownAddresses(self):
+        derived = deriveAddressBatch([G_COMPRESSED, G_UNCOMPRESSED])
+        for i in range(2):
+            self.assertEqual(derived["uncompressed"][i], G_UNCOMPRESSED)
+            self.assertEqual(derived["compressed"][i], G_COMPRESSED)
+            self.assertEqual(derived["p2pkh_uncompressed"][i], "1EHNa6Q4Jz2uvNExL497mE43ikXhwF6kZm")
+            self.assertEqual(derived["p2pkh_compressed"][i], "1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH")
+            self.assertEqual(derived["p2wpkh"][i], "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4")
+
+    def testMatchesSingleKeyFunctions(self):
+        derived = deriveAddressBatch([ODD_UNCOMPRESSED])
+        uncompressed = bytes.fromhex(ODD_UNCOMPRESSED)
+        compressed = compressPubkey(uncompressed)
+        self.assertEqual(derived["compressed"][0][:2], "03")
+        self.assertEqual(derived["compressed"][0], compressed.hex())
+        self.assertEqual(derived["p2pkh_uncompressed"][0], p2pkhAddress(uncompressed))
+        self.assertEqual(derived["p2pkh_compressed"][0], p2pkhAddress(compressed))
+        self.assertEqual(derived["p2wpkh"][0], p2wpkhAddress(compressed))
+
+    def testInvalidKeys(self):
+        derived = deriveAddressBatch(["not hex", None, "02" + "00" * 32, "05" + "11" * 64, G_COMPRESSED])
+        self.assertEqual(list(derived["valid"]), [False, False, False, False, True])
+        self.assertEqual(derived["p2wpkh"][0], "")
+
+    def testEmptyBatch(self):
+        self.assertEqual(deriveKeyBatch([])["p2wpkh"], [])
+
+
+class testCanonicalKeys(unittest.TestCase):
+
+    def testKnownKeys(self):
+        values = [
+            G_UNCOMPRESSED,
+            G_COMPRESSED,
+            "1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH",
+            "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4",
+            "3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy",
+        ]
+        self.assertEqual([key.hex() for key in canonicalKeys(values)], [
+            "0091b24bf9f5288532960ac687abb035127b1d28a5",
+            "00751e76e8199196d454941c45d1b3a323f1433bd6",
+            "00751e76e8199196d454941c45d1b3a323f1433bd6",
+            "02751e76e8199196d454941c45d1b3a323f1433bd6",
+            "01b472a266d0bd89c13706a4132ccfb16f7c3b9fcb",
+        ])
+
+    def testNoKey(self):
+        self.assertEqual(canonicalKeys([None, "", "multi(1,02aa,02bb)"]), [None, None, None])
+
+    def testMatchesDerivedAddresses(self):
+        # The canonical keys of deriveAddressBatch's addresses are deriveKeyBatch's keys.
+        addresses = deriveAddressBatch([ODD_UNCOMPRESSED])
+        keys = deriveKeyBatch([ODD_UNCOMPRESSED])
+        self.assertEqual(canonicalKeys([addresses["p2pkh_uncompressed"][0]]), [keys["uncompressed"][0]])
+        self.assertEqual(canonicalKeys([addresses["p2pkh_compressed"][0]]), [keys["compressed"][0]])
+        self.assertEqual(canonicalKeys([addresses["p2wpkh"][0]]), [keys["p2wpkh"][0]])
+        self.assertEqual(deriveKeyBatch(["not hex"])["uncompressed"], [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
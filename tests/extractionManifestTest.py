@@ -0,0 +1,83 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from extraction_manifest import ExtractionManifest, atomicPath, publishFiles, droppedChunks
+
+
+class testExtractionManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hashes = {h: "h%d" % h for h in range(12)}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _writeChunk(self, manifest, chunk, start, end):
+        path = os.path.join(self.dir, f"transactions_chunk_{chunk}.csv")
+        with open(atomicPath(path), "w") as f:
+            f.write(f"{start},{end}\n")
+        files = publishFiles([path])
+        manifest.record(chunk, start, end, self.hashes[start], self.hashes[end], "csv", files)
+        return path
+
+    def _fill(self):
+        manifest = ExtractionManifest(self.dir)
+        paths = [self._writeChunk(manifest, n + 1, 3 * n, 3 * n + 2) for n in range(4)]
+        return manifest, paths
+
+    def testResume(self):
+        self._fill()
+        with open(os.path.join(self.dir, "inputs_chunk_5.csv.tmp"), "w") as f:
+            f.write("half written")
+        manifest = ExtractionManifest(self.dir)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "inputs_chunk_5.csv.tmp")))
+        self.assertEqual(manifest.validate(self.hashes.get), 12)
+        self.assertEqual(manifest.nextChunk(), 5)
+
+    def testReorg(self):
+        _, paths = self._fill()
+        for h in range(7, 12):  # Everything from the fork point on gets new hashes.
+            self.hashes[h] = "reorged%d" % h
+        manifest = ExtractionManifest(self.dir)
+        self.assertEqual(manifest.validate(self.hashes.get), 6)
+        self.assertEqual(manifest.nextChunk(), 5)  # 3 and 4 may already be loaded, so they are never used again.
+        self.assertEqual(droppedChunks(self.dir), {3, 4})
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]) or os.path.exists(paths[3]))
+        # The trimmed manifest is saved.
+        self.assertEqual([c["chunk"] for c in ExtractionManifest(self.dir).chunks], [1, 2])
+
+    def testCorruptAndConsumedFiles(self):
+        _, paths = self._fill()
+        os.remove(paths[2])  # Consumed by the loader, still counts as done.
+        with open(paths[3], "a") as f:
+            f.write("garbage")
+        manifest = ExtractionManifest(self.dir)
+        self.assertEqual(manifest.validate(self.hashes.get), 9)
+        self.assertEqual(manifest.dropped, [4])
+
+    def testGap(self):
+        manifest = ExtractionManifest(self.dir)
+        self._writeChunk(manifest, 1, 0, 2)
+        self._writeChunk(manifest, 3, 6, 8)  # Chunk 2 never committed.
+        self.assertEqual(manifest.validate(self.hashes.get), 3)
+        self.assertEqual(manifest.nextChunk(), 4)
+        self.assertEqual(manifest.dropped, [2, 3])
+
+    def testReservedChunks(self):
+        manifest, _ = self._fill()
+        self.assertEqual(manifest.nextChunk(), 5)
+        self.assertEqual(manifest.nextChunk(), 6)  # Crashed before either was recorded.
+        manifest = ExtractionManifest(self.dir)
+        self.assertEqual(manifest.validate(self.hashes.get), 12)
+        self.assertEqual(manifest.dropped, [5, 6])
+        self.assertEqual(manifest.nextChunk(), 7)
+        self.assertEqual(droppedChunks(self.dir), {5, 6})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from key_filter import KeyFilter
+
+
+def randomKeys(rng, n, tag=0):
+    return [bytes([tag]) + rng.bytes(20) for _ in range(n)]
+
+
+class testKeyFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "key_filter")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testNoFalseNegatives(self):
+        rng = np.random.default_rng(1)
+        keys = randomKeys(rng, 20000) + [b"\x04" + rng.bytes(32) for _ in range(100)]
+        key_filter = KeyFilter(self.path, len(keys))
+        key_filter.add(keys)
+        self.assertTrue(key_filter.contains(keys).all())
+
+    def testFalsePositiveRate(self):
+        rng = np.random.default_rng(2)
+        key_filter = KeyFilter(self.path, 20000)
+        key_filter.add(randomKeys(rng, 20000))
+        self.assertLess(key_filter.contains(randomKeys(rng, 20000)).mean(), 0.02)
+
+    def testTagIsPartOfTheKey(self):
+        key = b"\x00" + bytes(range(20))
+        key_filter = KeyFilter(self.path, 1)
+        key_filter.add([key])
+        self.assertEqual(list(key_filter.contains([key, b"\x02" + key[1:], None])), [True, False, False])
+
+    def testSaveAndReopen(self):
+        rng = np.random.default_rng(3)
+        keys = randomKeys(rng, 1000)
+        key_filter = KeyFilter(self.path, len(keys))
+        key_filter.add(keys)
+        key_filter.save()
+        del key_filter
+        reopened = KeyFilter(self.path)
+        self.assertTrue(reopened.contains(keys).all())
+        self.assertEqual(reopened.n_keys, len(keys))  # buildKeyFilter compares it with outputs
+        with self.assertRaises(ValueError):
+            reopened.add(keys)
+
+    def testMissing(self):
+        with self.assertRaises(FileNotFoundError):
+            KeyFilter(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
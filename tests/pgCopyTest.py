@@ -0,0 +1,219 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from struct import unpack_from
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import pg_copy
+from pg_copy import binaryCopyChunks, bulkUpdate, bulkInsert, copyIntsOut, copyIntsIn, chunkCopyFields, arrowCopyFields, copyStagingFields
+from chunk_columns import ChunkColumns, flattenBlock, writeArrowChunk, readArrowChunk
+from chunkColumnsTest import GENESIS_JSON, SPEND_JSON
+
+_DECODE = {"int8": ">q", "int4": ">i", "float4": ">f"}
+
+
+def decodeBinaryCopy(payload, kinds):
+    """Reads a binary COPY stream back into row tuples, the way the server would."""
+    assert payload[:11] == b"PGCOPY\n\xff\r\n\x00"
+    pos = 19
+    rows = []
+    while True:
+        n_fields, = unpack_from(">h", payload, pos)
+        pos += 2
+        if n_fields == -1:
+            break
+        assert n_fields == len(kinds)
+        row = []
+        for kind in kinds:
+            length, = unpack_from(">i", payload, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            data = payload[pos:pos + length]
+            pos += length
+            if kind == "text":
+                row.append(data.decode())
+            elif kind == "bytea":
+                row.append(bytes(data))
+            else:
+                row.append(unpack_from(_DECODE[kind], data)[0])
+        rows.append(tuple(row))
+    assert pos == len(payload)
+    return rows
+
+
+class RecordingCursor:
+    """Stands in for a psycopg2 cursor: keeps the statements and reads COPY streams to the end."""
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql, f):
+        self.statements.append(sql)
+        self.copied.append(f.read())
+
+
+class ReplayCursor:
+    """Stands in for a psycopg2 cursor running COPY ... TO STDOUT: writes `payload` to the file in small pieces, like libpq hands over rows."""
+    def __init__(self, payload):
+        self.payload = payload
+
+    def copy_expert(self, sql, f):
+        for start in range(0, len(self.payload), 7):
+            f.write(self.payload[start:start + 7])
+
+
+class testBinaryCopy(unittest.TestCase):
+
+    def testRoundTrip(self):
+        vout = np.array([-1, 0, 7, 2 ** 31 - 1], dtype=np.int64)
+        fields = [
+            ("text", ["a" * 64, None, "é", ""]),
+            ("int4", (vout, vout < 0)),
+            ("int8", (np.array([0, -5, 2 ** 40, 1], dtype=np.int64), None)),
+            ("float4", (np.array([50.0, 0.5, 0.0, 1.25]), None)),
+            ("bytea", [b"\x00" + b"\xab" * 20, None, b"", b"\xff"]),
+        ]
+        expected = [
+            ("a" * 64, None, 0, 50.0, b"\x00" + b"\xab" * 20),
+            (None, 0, -5, 0.5, None),
+            ("é", 7, 2 ** 40, 0.0, b""),
+            ("", 2 ** 31 - 1, 1, 1.25, b"\xff"),
+        ]
+        kinds = [kind for kind, _ in fields]
+        for rows_per_slice in (1, 3, 16384):
+            with self.subTest(rows_per_slice=rows_per_slice):
+                pg_copy.rows_per_slice = rows_per_slice
+                payload = b"".join(binaryCopyChunks(fields, len(expected)))
+                self.assertEqual(decodeBinaryCopy(payload, kinds), expected)
+
+    def testEmpty(self):
+        payload = b"".join(binaryCopyChunks([("text", [])], 0))
+        self.assertEqual(decodeBinaryCopy(payload, ["text"]), [])
+
+    def testBulkUpdate(self):
+        cursor = RecordingCursor()
+        rows = [("aa", 0, "pk1"), ("bb", 3, None)]
+        bulkUpdate(cursor, "outputs", [("txid", "TEXT"), ("vout_n", "INT"), ("address", "TEXT")], rows, ["txid", "vout_n"])
+        self.assertEqual(decodeBinaryCopy(cursor.copied[0], ["text", "int4", "text"]), rows)
+        self.assertIn("COPY outputs_bulk_update (txid, vout_n, address) FROM STDIN", cursor.statements[2])
+        self.assertEqual(cursor.statements[-1], "UPDATE outputs t SET address = s.address FROM outputs_bulk_update s WHERE t.txid = s.txid AND t.vout_n = s.vout_n;")
+
+    def testBulkInsert(self):
+        cursor = RecordingCursor()
+        rows = [("1A1z", "04ab"), ("04ab", "04ab")]
+        bulkInsert(cursor, "normalized_hashes", [("hash", "TEXT"), ("root_hash", "TEXT")], rows)
+        self.assertEqual(decodeBinaryCopy(cursor.copied[0], ["text", "text"]), rows)
+        self.assertEqual(cursor.statements[-1], "INSERT INTO normalized_hashes (hash, root_hash) SELECT hash, root_hash FROM normalized_hashes_bulk_insert ON CONFLICT DO NOTHING;")
+
+
+class testCopyIntsOut(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "edges.i32")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRoundTrip(self):
+        tx = np.arange(1000, dtype=np.int64)
+        wallet = (tx * 7919) % 2 ** 31 - 5
+        payload = b"".join(binaryCopyChunks([("int4", (tx, None)), ("int4", (wallet, None))], len(tx)))
+        for block in (20, 1 << 24):
+            with self.subTest(block=block):
+                pg_copy.copy_out_block = block
+                self.assertEqual(copyIntsOut(ReplayCursor(payload), "SELECT ...", 2, self.path), len(tx))
+                edges = np.fromfile(self.path, dtype=np.int32).reshape(-1, 2)
+                np.testing.assert_array_equal(edges, np.column_stack((tx, wallet)))
+
+    def testEmpty(self):
+        payload = b"".join(binaryCopyChunks([("int4", (np.zeros(0, dtype=np.int64), None))], 0))
+        self.assertEqual(copyIntsOut(ReplayCursor(payload), "SELECT ...", 1, self.path), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def testRejectsNulls(self):
+        values = np.array([1, 2, 3], dtype=np.int64)
+        payload = b"".join(binaryCopyChunks([("int4", (values, values == 2)), ("int4", (values, None))], 3))
+        with self.assertRaises(ValueError):
+            copyIntsOut(ReplayCursor(payload), "SELECT ...", 2, self.path)
+
+
+class testCopyIntsIn(unittest.TestCase):
+
+    def setUp(self):
+        self.block = pg_copy.copy_out_block
+
+    def tearDown(self):
+        pg_copy.copy_out_block = self.block
+
+    def testRoundTrip(self):
+        clusters = np.column_stack((np.arange(1, 1001), np.arange(1000) // 3)).astype(np.int32)
+        for block in (20, 1 << 24):
+            with self.subTest(block=block):
+                pg_copy.copy_out_block = block
+                cursor = RecordingCursor()
+                copyIntsIn(cursor, "cs_clusters", ("wallet_id", "cluster_id"), clusters)
+                self.assertIn("COPY cs_clusters (wallet_id, cluster_id) FROM STDIN", cursor.statements[0])
+                self.assertEqual(decodeBinaryCopy(cursor.copied[0], ["int4", "int4"]), [tuple(row) for row in clusters.tolist()])
+
+    def testEmpty(self):
+        cursor = RecordingCursor()
+        copyIntsIn(cursor, "cs_clusters", ("wallet_id", "cluster_id"), np.empty((0, 2), dtype=np.int32))
+        self.assertEqual(decodeBinaryCopy(cursor.copied[0], ["int4", "int4"]), [])
+
+    def testRejectsOverflow(self):
+        with self.assertRaises(ValueError):
+            copyIntsIn(RecordingCursor(), "cs_clusters", ("wallet_id", "cluster_id"), np.array([[1, 2 ** 31]], dtype=np.int64))
+
+
+class testArrowChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.columns = ChunkColumns()
+        flattenBlock(GENESIS_JSON, self.columns)
+        flattenBlock(SPEND_JSON, self.columns)
+        self.columns.setPrevouts([None, (5000000000, "pubkey", "0411db93e1")])
+        self.columns.fillAddressKeys(lambda addresses: [None if a is None else b"\x00" + a.encode()[:20] for a in addresses])
+        self.columns.tx_id = np.array([0, 1], dtype=np.int64)
+        self.columns.in_tx_id = np.array([0, 1], dtype=np.int64)
+        self.columns.in_vin_tx_id = np.array([-1, -1], dtype=np.int64)
+        self.columns.out_tx_id = np.array([0, 1, 1], dtype=np.int64)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLoadsLikeThePostgresFormat(self):
+        # A chunk written as parquet or arrow and loaded by populate_database's copyChunk must COPY exactly what output_format = "postgres" streams.
+        expected = {table: b"".join(binaryCopyChunks(fields, n_rows)) for table, (fields, n_rows) in chunkCopyFields(self.columns).items()}
+        for output_format in ("parquet", "arrow"):
+            paths = [os.path.join(self.dir, f"{table}_chunk_1.{output_format}") for table in ("transactions", "inputs", "outputs")]
+            writeArrowChunk(self.columns.arrowTables(0, 1), paths, output_format)
+            for table, path in zip(("transactions", "inputs", "outputs"), paths):
+                with self.subTest(output_format=output_format, table=table):
+                    cursor = RecordingCursor()
+                    chunk, _ = readArrowChunk(path)
+                    copyStagingFields(cursor, table, *arrowCopyFields(table, chunk))
+                    self.assertEqual(cursor.copied[0], expected[table])
+                    self.assertIn(f"COPY {table}_staging (", cursor.statements[0])
+
+    def testDecodedValues(self):
+        writeArrowChunk(self.columns.arrowTables(0, 1), [os.path.join(self.dir, f"{t}.arrow") for t in ("transactions", "inputs", "outputs")], "arrow")
+        cursor = RecordingCursor()
+        copyStagingFields(cursor, "outputs", *arrowCopyFields("outputs", readArrowChunk(os.path.join(self.dir, "outputs.arrow"))[0]))
+        rows = decodeBinaryCopy(cursor.copied[0], ["text", "int4", "float4", "text", "text", "text", "int4", "bytea"])
+        self.assertEqual(rows[0][0], GENESIS_JSON["tx"][0]["txid"])
+        self.assertEqual([row[2] for row in rows], [50.0, 10.0, np.float32(0.00012345)])
+        self.assertEqual([row[5] for row in rows], ["pubkey", "pubkey", "pubkeyhash"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+from struct import pack
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from raw_block_parser import parseRawBlock, parseHeader, classifyScript, scriptToAsm, descriptorChecksum, sha256d, BlockRows
+
+GENESIS = bytes.fromhex(
+    "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a"
+    "29ab5f49ffff001d1dac2b7c0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054"
+    "696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff"
+    "0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d57"
+    "8a4c702b6bf11d5fac00000000"
+)
+DER_SIG = "3044" + "0220" + "11" * 32 + "0220" + "22" * 32
+GENESIS_PUBKEY = "04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f"
+
+
+def segwitBlock():
+    """A one transaction block whose only tx spends a made up outpoint with a witness."""
+    prev = bytes(range(32))
+    sig = bytes.fromhex(DER_SIG + "01")
+    pubkey = bytes.fromhex("0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798")
+    non_witness_body = (
+        b"\x01" + prev + pack("<I", 3) + b"\x00" + pack("<I", 0xfffffffd)
+        + b"\x01" + pack("<q", 12345) + b"\x16" + bytes.fromhex("0014751e76e8199196d454941c45d1b3a323f1433bd6")
+    )
+    witness = b"\x02" + bytes([len(sig)]) + sig + bytes([len(pubkey)]) + pubkey
+    tx = pack("<I", 2) + b"\x00\x01" + non_witness_body + witness + pack("<I", 0)
+    txid = sha256d(pack("<I", 2) + non_witness_body + pack("<I", 0))[::-1].hex()
+    header = pack("<I", 0x20000000) + bytes(32) + bytes(32) + pack("<III", 1700000000, 0x1d00ffff, 0)
+    return header + b"\x01" + tx, txid, sig.hex() + ", " + pubkey.hex()
+
+
+class testParseRawBlock(unittest.TestCase):
+
+    def testGenesisHeader(self):
+        header = parseHeader(GENESIS)
+        self.assertEqual(header["hash"], "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")
+        self.assertEqual(header["time"], 1231006505)
+
+    def testGenesisRows(self):
+        rows = BlockRows()
+        parseRawBlock(GENESIS, 1231006505, rows)
+        txid = "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b"
+        self.assertEqual(rows.transactions, [(txid, 1231006505, 1231006505, 0)])
+        self.assertEqual(rows.inputs, [(txid, None, None, None, None)])
+        self.assertEqual(len(rows.outputs), 1)
+        out_txid, n, value, desc, address, kind = rows.outputs[0]
+        self.assertEqual((out_txid, n, value, address, kind), (txid, 0, 50.0, None, "pubkey"))
+        self.assertTrue(desc.startswith(f"pk({GENESIS_PUBKEY})#"))
+
+    def testSegwitTxidAndWitness(self):
+        raw, txid, witness = segwitBlock()
+        rows = BlockRows()
+        parseRawBlock(raw, 1699999000, rows)
+        self.assertEqual(rows.transactions[0][0], txid)
+        self.assertEqual(rows.inputs, [(txid, bytes(range(32))[::-1].hex(), 3, "", witness)])
+        self.assertEqual(rows.outputs[0][1:], (0, 0.00012345, descriptorChecksum("addr(bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4)"),
+                                               "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4", "witness_v0_keyhash"))
+
+
+class testClassifyScript(unittest.TestCase):
+
+    def testTypes(self):
+        cases = {
+            "76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac": ("pubkeyhash", "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"),
+            "0014751e76e8199196d454941c45d1b3a323f1433bd6": ("witness_v0_keyhash", "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4"),
+            "512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798": ("witness_v1_taproot", "bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0"),
+            "51024e73": ("anchor", "bc1pfeessrawgf"),
+            "6a0b68656c6c6f20776f726c64": ("nulldata", None),
+            "ac": ("nonstandard", None),
+        }
+        for script, (kind, address) in cases.items():
+            with self.subTest(script=script):
+                result = classifyScript(memoryview(bytes.fromhex(script)))
+                self.assertEqual(result[:2], (kind, address))
+
+    def testDescriptors(self):
+        self.assertEqual(descriptorChecksum("raw(deadbeef)"), "raw(deadbeef)#89f8spxm")
+        taproot = classifyScript(bytes.fromhex("512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"))
+        self.assertTrue(taproot[2].startswith("rawtr(79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798)#"))
+        key = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+        multisig = classifyScript(bytes.fromhex("5121" + key + "51ae"))
+        self.assertEqual(multisig[0], "multisig")
+        self.assertTrue(multisig[2].startswith(f"multi(1,{key})#"))
+
+
+class testScriptToAsm(unittest.TestCase):
+
+    def testSighashDecode(self):
+        sig = DER_SIG
+        key = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+        script = bytes.fromhex("47" + sig + "81" + "21" + key)
+        self.assertEqual(scriptToAsm(script), f"{sig}[ALL|ANYONECANPAY] {key}")
+
+    def testNumbersAndOps(self):
+        self.assertEqual(scriptToAsm(bytes.fromhex("00510281804f76")), "0 1 -129 -1 OP_DUP")
+        self.assertEqual(scriptToAsm(bytes.fromhex("4c05ab")), "[error]")
+
+
+if __name__ == '__main__':
+    unittest.main()
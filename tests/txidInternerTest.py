@@ -0,0 +1,87 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from txid_interner import TxidInterner, txidWords
+from chunk_columns import ChunkColumns, ArrowChunk
+
+TX_A, TX_B, TX_C = "aa" * 32, "bb" * 32, "cc" * 32
+
+
+def randomTxids(rng, n):
+    return rng.integers(0, 1 << 63, size=(n, 4), dtype=np.int64).view(np.uint64)
+
+def spendChunk():
+    columns = ChunkColumns()
+    columns.addTransaction(TX_B, 1, 1, 0)
+    columns.addInput(TX_B, TX_A, 0, "sig", None)
+    columns.addInput(TX_B, TX_C, 0, "sig", None)  # C is from before the interner's first chunk
+    columns.addOutput(TX_B, 0, 1000, "addr(x)#y", "x", "pubkeyhash")
+    return columns
+
+
+class testTxidInterner(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testDenseIdsAndGrowth(self):
+        rng = np.random.default_rng(1)
+        txids = randomTxids(rng, 5000)
+        interner = TxidInterner(self.dir, initial_slots=64)
+        ids = interner.intern(txids[:3000])
+        self.assertEqual(list(ids), list(range(3000)))
+        # Already known txids keep their ids, new ones carry on in order.
+        ids = interner.intern(txids[2000:])
+        self.assertEqual(list(ids), list(range(2000, 5000)))
+        self.assertEqual(len(interner), 5000)
+        interner.close()
+
+        interner = TxidInterner(self.dir, readonly=True)
+        shuffled = rng.permutation(5000)
+        self.assertEqual(list(interner.lookup(txids[shuffled])), list(shuffled))
+        self.assertEqual(list(interner.lookup(randomTxids(rng, 10))), [-1] * 10)
+        self.assertEqual(interner.txids([4999]), [bytes(txids[4999]).hex()])
+
+    def testUnsavedIdsAreReused(self):
+        interner = TxidInterner(self.dir)
+        words, valid = txidWords([TX_A, None, TX_B])
+        self.assertEqual(list(interner.intern(words, valid)), [0, -1, 1])
+        interner.flush()
+        interner.intern(*txidWords([TX_C]))  # Crash before the next flush
+        interner.table.flush()
+        interner.keys.flush()
+        interner = TxidInterner(self.dir)
+        self.assertEqual(list(interner.lookup(*txidWords([TX_A, TX_B, TX_C]))), [0, 1, -1])
+        self.assertEqual(list(interner.intern(*txidWords([TX_B, "dd" * 32]))), [1, 2])
+        self.assertEqual(list(interner.lookup(*txidWords([TX_C]))), [-1])
+
+    def testChunkColumns(self):
+        interner = TxidInterner(self.dir)
+        interner.intern(*txidWords([TX_A]))
+        columns = spendChunk()
+        columns.internTxids(interner)
+        tx_df, vin_df, vout_df = columns.frames()
+        self.assertEqual(list(tx_df["tx_id"]), [1])
+        self.assertEqual(list(vin_df["tx_id"]), [1, 1])
+        self.assertEqual(vin_df["vin_tx_id"][0], 0)
+        self.assertTrue(vin_df["vin_tx_id"].isna()[1])
+        self.assertEqual(list(vout_df["tx_id"]), [1])
+
+        chunk = ArrowChunk()
+        chunk.append(spendChunk().arrowTables(1, 1))
+        chunk.internTxids(interner)  # Same txids, same ids.
+        transactions, inputs, outputs = chunk.arrowTables(1, 1)
+        self.assertEqual(transactions["tx_id"].to_pylist(), [1])
+        self.assertEqual(inputs["vin_tx_id"].to_pylist(), [0, None])
+        self.assertEqual(list(chunk.toColumns().in_vin_tx_id), [0, -1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from chunk_columns import ChunkColumns, ArrowChunk
+from utxo_map import UtxoMap, lmdb
+
+PUBKEY = "04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f"
+TX_A, TX_B, TX_C = "aa" * 32, "bb" * 32, "cc" * 32
+
+
+def firstChunk():
+    """A coinbase paying to a public key, an address and an OP_RETURN."""
+    columns = ChunkColumns()
+    columns.addTransaction(TX_A, 0, 0, 0)
+    columns.addInput(TX_A, None, None, None, None)
+    columns.addOutput(TX_A, 0, 5000000000, f"pk({PUBKEY})#x", None, "pubkey")
+    columns.addOutput(TX_A, 1, 1000, "addr(1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa)#y", "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa", "pubkeyhash")
+    columns.addOutput(TX_A, 2, 0, "raw(6a)#z", None, "nulldata")
+    return columns
+
+def secondChunk():
+    """B spends both of A's spendable outputs, C spends B's output inside the same chunk."""
+    columns = ChunkColumns()
+    columns.addTransaction(TX_B, 1, 1, 0)
+    columns.addInput(TX_B, TX_A, 0, "sig", None)
+    columns.addInput(TX_B, TX_A, 1, "sig key", None)
+    columns.addOutput(TX_B, 0, 4000000000, "addr(bc1q)#w", "bc1q", "witness_v0_keyhash")
+    columns.addTransaction(TX_C, 1, 1, 0)
+    columns.addInput(TX_C, TX_B, 0, "", "sig, key")
+    columns.addOutput(TX_C, 0, 3000000000, "addr(3J98)#v", "3J98", "scripthash")
+    return columns
+
+EXPECTED = [(5000000000, "pubkey", PUBKEY), (1000, "pubkeyhash", "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"), (4000000000, "witness_v0_keyhash", "bc1q")]
+
+
+def prevouts(columns):
+    return [
+        None if value == -1 else (value, kind, address)
+        for value, kind, address in zip(columns.in_prevout_value_sats, columns.in_prevout_type, columns.in_prevout_address)
+    ]
+
+
+@unittest.skipIf(lmdb is None, "lmdb not installed")
+class testUtxoMap(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.utxo_map = UtxoMap(self.dir, keep_undo=2, map_size=1 << 24)
+
+    def tearDown(self):
+        self.utxo_map.close()
+        shutil.rmtree(self.dir)
+
+    def testResolve(self):
+        first = firstChunk()
+        self.assertEqual(self.utxo_map.applyChunk(0, 0, first), 0)
+        self.assertEqual(prevouts(first), [None])
+        second = secondChunk()
+        self.assertEqual(self.utxo_map.applyChunk(1, 1, second), 0)
+        self.assertEqual(prevouts(second), EXPECTED)
+        self.assertEqual(self.utxo_map.height(), 1)
+        with self.assertRaises(ValueError):
+            self.utxo_map.applyChunk(5, 5, ChunkColumns())
+
+    def testRollback(self):
+        self.utxo_map.applyChunk(0, 0, firstChunk())
+        self.utxo_map.applyChunk(1, 1, secondChunk())
+        self.utxo_map.rollback(0)
+        self.assertEqual(self.utxo_map.height(), 0)
+        again = secondChunk()
+        self.utxo_map.applyChunk(1, 1, again)
+        self.assertEqual(prevouts(again), EXPECTED)
+        # keep_undo=2, so chunk 1 can no longer be undone.
+        self.utxo_map.applyChunk(2, 2, ChunkColumns())
+        self.utxo_map.applyChunk(3, 3, ChunkColumns())
+        with self.assertRaises(RuntimeError):
+            self.utxo_map.rollback(0)
+
+    def testArrowChunk(self):
+        self.utxo_map.applyChunk(0, 0, firstChunk())
+        chunk = ArrowChunk()
+        chunk.append(secondChunk().arrowTables(1, 1))
+        self.assertEqual(self.utxo_map.applyChunk(1, 1, chunk), 0)
+        self.assertEqual(prevouts(chunk.toColumns()), EXPECTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,18 @@
 # This code was heavily inspired by several of the techniques mentioned on this page: https://en.wikipedia.org/wiki/Disjoint-set_data_structure
 # The path halving technique is thanks to "Worst Case Analysis of Set Union Algorithms" by Robert E. Tarjan and Jan van Leeuwen
 # DEPENDENCY: This code heavily relies on the assumption that the IDs are somewhat contiguous. This allows for array based indexing - which offers a big speedup in finding parents.
+# cscUnionFind and cscUnionFindParallel check that first. Sparse, negative or 64 bit ids are renumbered densely (np.unique) and mapped back in the result.
+# cscUnionFindOutOfCore does the same from edge files on disk, with parent in a memory mapped file, for graphs bigger than RAM.
+# UnionFindState keeps that parent array between runs, so following the chain tip only costs the new blocks' edges.
+# cscUnionFindParallel spreads the edges over every core. Numba has no compare and swap on the CPU, so its threads hook roots without locks and
+# a hook another thread overwrote is simply redone in the next round. Every link points to a smaller wallet, so races can't make cycles.
+import json
+import os
 import numpy as np
-from numba import njit, int32, uint8
+from numba import njit, prange, int32, uint8
 
+sparse_ratio = 4  # Ids are renumbered when the largest is more than this many times the number of edges (and past dense_minimum)
+dense_minimum = 1 << 20  # Arrays this long are cheap, so ids below it are always indexed directly
 
 @njit(inline="always", fastmath=True, nogil=True, cache=True)
 def find(parent, x):                       
@@ -33,8 +42,8 @@ def mapExisting(parent, present):
     Therefore, it would waste memory to store and search every wallet id even if it didnt happen. 
     """
     m = np.sum(present)
-    roots   = np.empty(m, dtype=int32)
-    wallets = np.empty(m, dtype=int32)
+    roots   = np.empty(m, dtype=parent.dtype)
+    wallets = np.empty(m, dtype=parent.dtype)
 
     j = 0
     for i in range(present.size):
@@ -68,9 +77,11 @@ def _process_dense(tx_ids, wallet_idx):
     n_wallets = wallet_idx.max() + 1
     n_txs     = tx_ids.max() + 1
 
-    parent  = np.arange(n_wallets, dtype=int32)
+    parent  = np.empty(n_wallets, dtype=wallet_idx.dtype)  # int32, or int64 for more than 2^31 wallets
+    for i in range(n_wallets):
+        parent[i] = i
     present = np.zeros(n_wallets,  dtype=uint8)
-    tx_first = np.full(n_txs, -1, dtype=int32)      
+    tx_first = np.full(n_txs, -1, dtype=wallet_idx.dtype)      
 
     for k in range(tx_ids.size):
         t = tx_ids[k]
@@ -89,6 +100,73 @@ def _process_dense(tx_ids, wallet_idx):
     return parent, present
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _process_parallel(tx_ids, wallet_idx):
+    """
+    _process_dense over all cores. Any wallet of a transaction can stand in for its first one, so tx_first is filled racily in one pass
+    and read only after. Then every thread links the roots of its edges' two wallets, the bigger under the smaller, until a round links nothing.
+    Concurrent links of one root overwrite each other, but one of them always sticks, so every round with work left merges something.
+    """
+    n_wallets = wallet_idx.max() + 1
+    n_txs     = tx_ids.max() + 1
+
+    parent  = np.empty(n_wallets, dtype=wallet_idx.dtype)  # int32, or int64 for more than 2^31 wallets
+    for i in range(n_wallets):
+        parent[i] = i
+    present = np.zeros(n_wallets,  dtype=uint8)
+    tx_first = np.full(n_txs, -1, dtype=wallet_idx.dtype)
+
+    for k in prange(tx_ids.size):
+        present[wallet_idx[k]] = 1
+        tx_first[tx_ids[k]] = wallet_idx[k]
+
+    linked = 1
+    while linked:
+        linked = 0
+        for k in prange(tx_ids.size):
+            xr = find(parent, tx_first[tx_ids[k]])
+            yr = find(parent, wallet_idx[k])
+            if xr != yr:
+                if xr < yr:
+                    parent[yr] = xr
+                else:
+                    parent[xr] = yr
+                linked += 1
+        for i in prange(n_wallets):
+            parent[i] = find(parent, i)
+
+    return parent, present
+
+
+def _indexIds(ids, first):
+    """
+    Array indexes for a column of ids, and the original id of every index if they had to be renumbered (None if not).
+    Ids from `first` on that are dense enough and fit in int32 are used as they are, minus first. Anything else is renumbered in sorted order,
+    so the smallest wallet of a cluster is still the smallest index and the result is the same as with dense ids.
+    """
+    ids = np.asarray(ids)
+    low, high = int(ids.min()), int(ids.max())
+    if low >= first and high < min(2 ** 31, first + max(sparse_ratio * ids.size, dense_minimum)):
+        index = ids.astype(np.int32, copy=False)
+        return (index - first if first else index), None
+    originals, index = np.unique(ids, return_inverse = True)
+    return index.reshape(-1).astype(np.int32 if originals.size < 2 ** 31 else np.int64), originals
+
+def _prepare(data):
+    """(tx indexes, wallet indexes, original wallet ids or None) of an edge array."""
+    tx_ids, _ = _indexIds(data[:, 0], 0)
+    wallet_idx, wallet_ids = _indexIds(data[:, 1], 1)
+    return tx_ids, wallet_idx, wallet_ids
+
+def _clusterRows(parent, present, wallet_ids = None):
+    roots, wallets       = mapExisting(parent, present)
+    unique_roots, group_assignments = np.unique(roots, return_inverse = True)
+    if wallet_ids is None:
+        return np.column_stack((wallets, group_assignments)).astype(np.int32)
+    wallets = wallet_ids[wallets - 1]
+    dtype = np.int32 if wallets[0] >= -2 ** 31 and wallets[-1] < 2 ** 31 else np.int64  # Sorted
+    return np.column_stack((wallets, group_assignments)).astype(dtype)
+
 def cscUnionFind(data: np.ndarray):
     """
     This method resulted in a <50% speedup to trad. graph libraries on this task. Mostly due to the indexing logic.
@@ -96,10 +174,348 @@ def cscUnionFind(data: np.ndarray):
     if data.size == 0:
         return []
 
-    tx_ids     = data[:, 0].astype(np.int32, copy=False)
-    wallet_idx = data[:, 1].astype(np.int32, copy=False) - 1
-
+    tx_ids, wallet_idx, wallet_ids = _prepare(data)
     parent, present      = _process_dense(tx_ids, wallet_idx)
-    roots, wallets       = mapExisting(parent, present)
-    unique_roots, group_assignments = np.unique(roots, return_inverse = True)
-    return np.column_stack((wallets, group_assignments)).astype(np.int32)
+    return _clusterRows(parent, present, wallet_ids)
+
+def cscUnionFindParallel(data: np.ndarray):
+    """
+    cscUnionFind on every core (NUMBA_NUM_THREADS). Same rows, since with links always to the smaller wallet the root of a cluster is its smallest wallet however the links were made.
+    """
+    if data.size == 0:
+        return []
+
+    tx_ids, wallet_idx, wallet_ids = _prepare(data)
+    parent, present      = _process_parallel(tx_ids, wallet_idx)
+    return _clusterRows(parent, present, wallet_ids)
+
+
+
+@njit(nogil=True, cache=True)
+def _applyChunk(parent, present, edges, tx_first, tx_base, prev_tx, prev_first, absorbed, added):
+    """
+    Unions a chunk of (tx, wallet) edges. Edges of transactions below tx_base are skipped.
+    With an empty tx_first the edges must be sorted by transaction, and only the previous transaction and its first wallet are needed, carried between chunks.
+    Otherwise tx_first[tx - tx_base] remembers every transaction's first wallet like _process_dense does.
+    Roots linked under another root go to `absorbed` and wallets seen for the first time to `added`, both sized for the chunk.
+    Returns the index of the first edge out of order (-1 if none), the carried transaction and wallet, and how many were absorbed and added.
+    """
+    in_order = tx_first.size == 0
+    n_absorbed = 0
+    n_added = 0
+    for k in range(edges.shape[0]):
+        t = edges[k, 0]
+        w = edges[k, 1] - 1
+        if t < tx_base:
+            continue
+        if in_order and t < prev_tx:
+            return k, prev_tx, prev_first, n_absorbed, n_added
+        if present[w] == 0:
+            present[w] = 1
+            added[n_added] = w
+            n_added += 1
+        if in_order:
+            if t != prev_tx:
+                prev_tx = t
+                prev_first = w
+                continue
+            f = prev_first
+        else:
+            f = tx_first[t - tx_base]
+            if f == -1:
+                tx_first[t - tx_base] = w
+                continue
+        xr = find(parent, f)
+        yr = find(parent, w)
+        if xr != yr:
+            if xr < yr:
+                parent[yr] = xr
+                absorbed[n_absorbed] = yr
+            else:
+                parent[xr] = yr
+                absorbed[n_absorbed] = xr
+            n_absorbed += 1
+    return -1, prev_tx, prev_first, n_absorbed, n_added
+
+@njit(nogil=True, cache=True)
+def _labelClusters(parent, present, out):
+    """
+    Writes (wallet, cluster) rows of the present wallets to `out`, numbering clusters by their smallest wallet like cscUnionFind.
+    Unions link to the smaller root, so a wallet's parent is never bigger than it and was labeled first. Overwrites parent with the labels.
+    """
+    j = 0
+    n_clusters = 0
+    for i in range(parent.size):
+        if present[i]:
+            p = parent[i]
+            if p == i:
+                label = n_clusters
+                n_clusters += 1
+            else:
+                label = parent[p]
+            parent[i] = label
+            out[j, 0] = i + 1
+            out[j, 1] = label
+            j += 1
+
+@njit(nogil=True, cache=True)
+def _rootRows(parent, present, out):
+    """
+    Writes (wallet, root wallet) rows of the present wallets to `out`. Compresses parent fully on the way: a wallet's parent is never bigger than it, so it already points at its root.
+    """
+    j = 0
+    for i in range(parent.size):
+        if present[i]:
+            parent[i] = parent[parent[i]]
+            out[j, 0] = i + 1
+            out[j, 1] = parent[i] + 1
+            j += 1
+
+@njit(nogil=True, cache=True)
+def _rootsOf(parent, wallets, out):
+    for k in range(wallets.size):
+        out[k] = find(parent, wallets[k]) + 1
+
+
+def _edgeFiles(path):
+    """An edge file, or the .i32 chunk files of a directory in name order."""
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".i32")]
+    return [path]
+
+def _edgeChunks(path, chunk_rows):
+    """Consecutive (rows, 2) int32 blocks of the edge files, read through memory maps so only the current block needs to be in RAM."""
+    for file in _edgeFiles(path):
+        if os.path.getsize(file) == 0:
+            continue
+        edges = np.memmap(file, dtype=np.int32, mode="r").reshape(-1, 2)
+        for start in range(0, edges.shape[0], chunk_rows):
+            yield np.asarray(edges[start:start + chunk_rows])
+        del edges
+
+def _idDtype(n):
+    return np.int32 if n < 2 ** 31 else np.int64
+
+def _filledMemmap(path, n, dtype, fill, chunk_rows):
+    """A memory mapped array of n, filled with arange (fill=None) or a constant a chunk at a time."""
+    array = np.memmap(path, dtype=dtype, mode="w+", shape=(max(n, 1),))
+    for start in range(0, n, chunk_rows):
+        stop = min(n, start + chunk_rows)
+        array[start:stop] = np.arange(start, stop) if fill is None else fill
+    return array
+
+def _applyEdges(edges_path, parent, present, tx_base, chunk_rows, dtype, work_dir=None, log=False):
+    """
+    Unions the edges of transactions from tx_base on, assuming they are sorted by transaction and redoing the pass with a tx_first table
+    (memory mapped in work_dir if given) if they turn out not to be. The unions made before that stay valid.
+    Returns the last transaction seen and, with log, the absorbed roots and the added wallets as arrays.
+    """
+    absorbed = np.empty(chunk_rows, dtype=dtype)
+    added = np.empty(chunk_rows, dtype=dtype)
+    absorbed_parts, added_parts = [], []
+    no_tx_first = np.empty(0, dtype=dtype)
+    prev_tx, prev_first, last_tx = -1, -1, tx_base - 1
+    in_order = True
+    for chunk in _edgeChunks(edges_path, chunk_rows):
+        unsorted_at, prev_tx, prev_first, n_absorbed, n_added = _applyChunk(parent, present, chunk, no_tx_first, tx_base, prev_tx, prev_first, absorbed, added)
+        if log:
+            absorbed_parts.append(absorbed[:n_absorbed].copy())
+            added_parts.append(added[:n_added].copy())
+        if unsorted_at != -1:
+            in_order = False
+            break
+    if in_order:
+        last_tx = max(last_tx, prev_tx)
+    else:
+        last_tx = max(last_tx, max(int(chunk[:, 0].max()) for chunk in _edgeChunks(edges_path, chunk_rows)))
+        n_txs = last_tx - tx_base + 1
+        if work_dir is None:
+            tx_first = np.full(n_txs, -1, dtype=dtype)
+        else:
+            tx_first = _filledMemmap(os.path.join(work_dir, "tx_first.bin"), n_txs, dtype, -1, chunk_rows)
+        for chunk in _edgeChunks(edges_path, chunk_rows):
+            _, _, _, n_absorbed, n_added = _applyChunk(parent, present, chunk, tx_first, tx_base, -1, -1, absorbed, added)
+            if log:
+                absorbed_parts.append(absorbed[:n_absorbed].copy())
+                added_parts.append(added[:n_added].copy())
+        del tx_first
+        if work_dir is not None:
+            os.remove(os.path.join(work_dir, "tx_first.bin"))
+    if not log:
+        return last_tx, None, None
+    return last_tx, np.concatenate(absorbed_parts or [absorbed[:0]]), np.concatenate(added_parts or [added[:0]])
+
+def cscUnionFindOutOfCore(edges_path, work_dir, chunk_rows=1 << 24, n_wallets=None):
+    """
+    cscUnionFind for edge lists bigger than RAM. Reads (tx, wallet) int32 pairs from a file, or a directory of .i32 chunk files, chunk_rows at a time.
+    parent and the result are memory mapped files in work_dir (int32, or int64 past 2^31 wallets), so only the pages in use have to be resident.
+    Edges sorted by transaction need no tx_first table, only the previous transaction's first wallet. Out of order edges are found on the way
+    and the pass is redone with tx_first in work_dir too. The unions made so far stay valid.
+    Returns the same (wallet, cluster) rows as cscUnionFind, as a read only memmap. n_wallets (the largest wallet id) saves a pass over the edges.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    if n_wallets is None:
+        n_wallets = max((int(chunk[:, 1].max()) for chunk in _edgeChunks(edges_path, chunk_rows)), default=0)
+    dtype = _idDtype(n_wallets)
+    parent = _filledMemmap(os.path.join(work_dir, "parent.bin"), n_wallets, dtype, None, chunk_rows)
+    present = _filledMemmap(os.path.join(work_dir, "present.u8"), n_wallets, np.uint8, 0, chunk_rows)
+
+    _applyEdges(edges_path, parent, present, 0, chunk_rows, dtype, work_dir)
+    n_present = sum(int(np.count_nonzero(present[start:start + chunk_rows])) for start in range(0, n_wallets, chunk_rows))
+    out_path = os.path.join(work_dir, "clusters.bin")
+    out = np.memmap(out_path, dtype=dtype, mode="w+", shape=(max(n_present, 1), 2))
+    _labelClusters(parent, present, out)
+    out.flush()
+    del out, parent, present
+    if n_present == 0:
+        return np.empty((0, 2), dtype=dtype)
+    return np.memmap(out_path, dtype=dtype, mode="r").reshape(-1, 2)[:n_present]
+
+
+class UnionFindState:
+    """
+    A union find that persists between runs. It is a directory, like txid_interner:
+      parent.bin: the forest, int32 (int64 past 2^31 wallets). Wallet w is index w - 1.
+      present.u8: 1 for every wallet seen in an edge.
+      meta.json:  n_wallets, the last transaction (tx id) applied and whether the files match it.
+    A cluster is named by its root, its smallest wallet, which only changes when it merges into a cluster with a smaller wallet.
+    apply() marks the state incomplete until save(). A state left incomplete by a crash can't tell what it already applied and opens empty.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._meta_path = os.path.join(path, "meta.json")
+        self._parent_path = os.path.join(path, "parent.bin")
+        self._present_path = os.path.join(path, "present.u8")
+        os.makedirs(path, exist_ok=True)
+        meta = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+        if meta is None or not meta["complete"]:
+            self.reset()
+        else:
+            self.n_wallets, self.last_tx = meta["n_wallets"], meta["last_tx"]
+            self.dtype = _idDtype(self.n_wallets)
+            self._open()
+
+    @property
+    def empty(self):
+        return self.n_wallets == 0
+
+    def reset(self):
+        """Forgets every edge."""
+        self.n_wallets, self.last_tx, self.dtype = 0, -1, np.int32
+        for path in (self._parent_path, self._present_path):
+            open(path, "wb").close()
+        self.parent = self.present = None
+
+    def _open(self):
+        if self.n_wallets == 0:
+            self.parent = self.present = None
+        else:
+            self.parent = np.memmap(self._parent_path, dtype=self.dtype, mode="r+", shape=(self.n_wallets,))
+            self.present = np.memmap(self._present_path, dtype=np.uint8, mode="r+", shape=(self.n_wallets,))
+
+    def _writeMeta(self, complete):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"n_wallets": self.n_wallets, "last_tx": self.last_tx, "complete": complete}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _grow(self, n_wallets, chunk_rows):
+        """Makes room for wallets up to n_wallets. New wallets are their own roots and not present."""
+        if n_wallets <= self.n_wallets:
+            return
+        old = self.n_wallets
+        dtype = _idDtype(n_wallets)
+        self.parent = self.present = None
+        if dtype != self.dtype and old:
+            widened = np.memmap(self._parent_path + ".tmp", dtype=dtype, mode="w+", shape=(old,))
+            narrow = np.memmap(self._parent_path, dtype=self.dtype, mode="r", shape=(old,))
+            for start in range(0, old, chunk_rows):
+                widened[start:start + chunk_rows] = narrow[start:start + chunk_rows]
+            widened.flush()
+            del widened, narrow
+            os.replace(self._parent_path + ".tmp", self._parent_path)
+        self.dtype = dtype
+        os.truncate(self._parent_path, n_wallets * np.dtype(dtype).itemsize)
+        os.truncate(self._present_path, n_wallets)  # Zeros, not present
+        self.n_wallets = n_wallets
+        self._open()
+        for start in range(old, n_wallets, chunk_rows):
+            stop = min(n_wallets, start + chunk_rows)
+            self.parent[start:stop] = np.arange(start, stop)
+
+    def apply(self, edges_path, chunk_rows=1 << 24, n_wallets=None, log=True):
+        """
+        Unions the (tx, wallet) edges at edges_path (a file or a directory of .i32 chunk files, see cscUnionFindOutOfCore) of transactions after last_tx.
+        Edges of transactions already applied are skipped, so a transaction must come whole in one call. n_wallets (the largest wallet id) saves a pass over the edges.
+        With log, returns what changed as two (n, 2) arrays:
+          merges: (old root, new root) of every cluster from before that merged into another one.
+          added:  (wallet, root) of every wallet seen for the first time.
+        Without log, like on a first run where everything is new, returns None. Read the whole state with rows().
+        """
+        if n_wallets is None:
+            n_wallets = max((int(chunk[:, 1].max()) for chunk in _edgeChunks(edges_path, chunk_rows)), default=0)
+        self._writeMeta(complete=False)
+        self._grow(n_wallets, chunk_rows)
+        if self.n_wallets == 0:
+            return (np.empty((0, 2), dtype=self.dtype),) * 2 if log else None
+        self.last_tx, absorbed, added = _applyEdges(edges_path, self.parent, self.present, self.last_tx + 1, chunk_rows, self.dtype, self.path, log)
+        if not log:
+            return None
+        absorbed = np.setdiff1d(absorbed, added)  # New wallets' clusters weren't known to the caller
+        changes = []
+        for wallets in (absorbed, added):
+            rows = np.empty((wallets.size, 2), dtype=self.dtype)
+            rows[:, 0] = wallets + 1
+            _rootsOf(self.parent, wallets, rows[:, 1])
+            changes.append(rows)
+        return tuple(changes)
+
+    def remap(self, moved, chunk_rows=1 << 24, n_wallets=None, log=True):
+        """
+        Carries the clusters of wallets whose keys moved to another wallet (normalization found their root) over to it, by unioning every (old, new) pair of `moved`.
+        Old wallets never seen in an edge have nothing to carry and are skipped. last_tx doesn't move. Returns what apply() does.
+        """
+        moved = np.asarray(moved, dtype=np.int64).reshape(-1, 2)
+        if self.n_wallets:
+            seen = moved[:, 0] <= self.n_wallets
+            seen[seen] = self.present[moved[seen, 0] - 1] != 0
+            moved = moved[seen]
+        else:
+            moved = moved[:0]
+        if len(moved) == 0:
+            return (np.empty((0, 2), dtype=self.dtype),) * 2 if log else None
+        # Every pair is a transaction of its own after last_tx, spending from both wallets.
+        edges = np.empty((2 * len(moved), 2), dtype=np.int32)
+        edges[:, 0] = self.last_tx + 1 + np.repeat(np.arange(len(moved)), 2)
+        edges[:, 1] = moved.ravel()
+        path = os.path.join(self.path, "remap.i32")
+        edges.tofile(path)
+        last_tx = self.last_tx
+        try:
+            return self.apply(path, chunk_rows, max(n_wallets or 0, self.n_wallets, int(moved.max())), log)
+        finally:
+            self.last_tx = last_tx
+            os.remove(path)
+
+    def rows(self, out_path, chunk_rows=1 << 24):
+        """(wallet, root) of every present wallet in wallet order, written to a memory mapped file at out_path and returned read only."""
+        if self.n_wallets == 0:
+            return np.empty((0, 2), dtype=self.dtype)
+        n_present = sum(int(np.count_nonzero(self.present[start:start + chunk_rows])) for start in range(0, self.n_wallets, chunk_rows))
+        if n_present == 0:
+            return np.empty((0, 2), dtype=self.dtype)
+        out = np.memmap(out_path, dtype=self.dtype, mode="w+", shape=(n_present, 2))
+        _rootRows(self.parent, self.present, out)
+        out.flush()
+        del out
+        return np.memmap(out_path, dtype=self.dtype, mode="r").reshape(-1, 2)
+
+    def save(self):
+        """Flushes the arrays and then marks the state complete."""
+        if self.parent is not None:
+            self.parent.flush()
+            self.present.flush()
+        self._writeMeta(complete=True)
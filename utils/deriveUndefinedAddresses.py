@@ -1,8 +1,13 @@
 # TODO: In the future, this function should be able to input and derive the addresses of descriptors as well. This would allow for the codebase to be significantly simpler.
 import hashlib
 import coincurve
+import numpy as np
+from numba import njit
 from base58 import b58decode_check
-from bip32utils import BIP32Key
+try:
+    from bip32utils import BIP32Key
+except ImportError:  # Only needed for xpubs, which never appear in outputs.
+    BIP32Key = None
 # SOURCE: https://developer.bitcoin.org/devguide/transactions.html
 # 2.7x faster than bitcoinlib.
 # Constants used for Bech32 encoding (fixed by BIP-173). 
@@ -152,3 +157,307 @@ def deriveUndefinedAddresses(pubkey, assumeMultisigOwned=True, nChildKeys=2):
         return _deriveFromXpub(k, nChildKeys)
     else:
         return _derive(pubkey)
+
+
+# Batch version of the above for fillNormalizedHashes, which derives hundreds of millions of keys.
+# Keys are parsed into one fixed width (n, 65) buffer. Compressing is a NumPy expression and base58/bech32 encoding are numba loops over fixed width rows, so the only per key Python work left is hashlib and decompressing compressed keys (an elliptic curve operation).
+_CHARSET_BYTES = np.frombuffer(_CHARSET.encode(), dtype=np.uint8)
+_B58_BYTES = np.frombuffer(_B58_ALPHABET, dtype=np.uint8)
+_HRP_EXPAND_ARRAY = np.array(_HRP_EXPAND, dtype=np.int64)
+_GEN_ARRAY = np.array(_GEN, dtype=np.int64)
+_HEX_BYTES = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_P2PKH_WIDTH = 34  # Longest base58check encoding of a version byte, HASH160 and checksum
+_P2WPKH_WIDTH = 42  # bc1q + 32 data characters + 6 checksum characters
+
+@njit(cache=True)
+def _base58Rows(payloads, alphabet, out):
+    """Base58 encodes every row of `payloads` into `out`, left aligned, zero padded."""
+    digits = np.empty(2 * payloads.shape[1], dtype=np.int64)
+    for r in range(payloads.shape[0]):
+        n_digits = 0
+        for j in range(payloads.shape[1]):
+            carry = np.int64(payloads[r, j])
+            for k in range(n_digits):
+                carry += digits[k] << 8
+                digits[k] = carry % 58
+                carry //= 58
+            while carry:
+                digits[n_digits] = carry % 58
+                n_digits += 1
+                carry //= 58
+        zeros = 0
+        while zeros < payloads.shape[1] and payloads[r, zeros] == 0:
+            zeros += 1
+        for k in range(zeros):
+            out[r, k] = alphabet[0]
+        for k in range(n_digits):
+            out[r, zeros + k] = alphabet[digits[n_digits - 1 - k]]
+
+@njit(cache=True)
+def _bech32Rows(programs, hrp_expand, gen, charset, out):
+    """Encodes every row of `programs` (20 byte witness v0 programs) as a bech32 address into `out`."""
+    data = np.empty(33, dtype=np.int64)
+    for r in range(programs.shape[0]):
+        data[0] = 0  # witness version
+        acc = 0
+        bits = 0
+        j = 1
+        for b in programs[r]:
+            acc = ((acc << 8) | b) & 0xfff
+            bits += 8
+            while bits >= 5:
+                bits -= 5
+                data[j] = (acc >> bits) & 31
+                j += 1
+        chk = 1
+        for i in range(hrp_expand.size + data.size + 6):
+            if i < hrp_expand.size:
+                v = hrp_expand[i]
+            elif i < hrp_expand.size + data.size:
+                v = data[i - hrp_expand.size]
+            else:
+                v = 0
+            top = chk >> 25
+            chk = ((chk & 0x1ffffff) << 5) ^ v
+            for g in range(5):
+                if (top >> g) & 1:
+                    chk ^= gen[g]
+        chk ^= 1
+        out[r, 0] = 98   # b
+        out[r, 1] = 99   # c
+        out[r, 2] = 49   # 1
+        for k in range(33):
+            out[r, 3 + k] = charset[data[k]]
+        for i in range(6):
+            out[r, 36 + i] = charset[(chk >> (5 * (5 - i))) & 31]
+
+def _hashRows(rows, hash_function):
+    """Applies hash_function (bytes -> bytes) to every row of a fixed width uint8 array, returning an (n, digest size) array."""
+    width = rows.shape[1]
+    view = memoryview(rows.tobytes())
+    digests = b"".join([hash_function(view[i:i + width]) for i in range(0, len(view), width)])
+    return np.frombuffer(digests, dtype=np.uint8).reshape(rows.shape[0], len(hash_function(b"")))
+
+def _hash160Digest(data):
+    r = _ripemd160()
+    r.update(_sha256(data).digest())
+    return r.digest()
+
+def _checksumDigest(data):
+    return _sha256(_sha256(data).digest()).digest()[:4]
+
+def _strings(chars):
+    """(n, width) uint8 characters, zero padded, to an array of str."""
+    width = chars.shape[1]
+    return np.ascontiguousarray(chars).view(f"S{width}").ravel().astype(f"U{width}")
+
+def _hexStrings(rows):
+    chars = np.empty((rows.shape[0], 2 * rows.shape[1]), dtype=np.uint8)
+    chars[:, 0::2] = _HEX_BYTES[rows >> 4]
+    chars[:, 1::2] = _HEX_BYTES[rows & 15]
+    return _strings(chars)
+
+def _p2pkhFromHash160(hashes):
+    payloads = np.zeros((hashes.shape[0], 25), dtype=np.uint8)
+    payloads[:, 1:21] = hashes
+    payloads[:, 21:] = _hashRows(payloads[:, :21], _checksumDigest)
+    chars = np.zeros((hashes.shape[0], _P2PKH_WIDTH), dtype=np.uint8)
+    _base58Rows(payloads, _B58_BYTES, chars)
+    return _strings(chars)
+
+def _p2wpkhFromHash160(hashes):
+    chars = np.zeros((hashes.shape[0], _P2WPKH_WIDTH), dtype=np.uint8)
+    _bech32Rows(hashes, _HRP_EXPAND_ARRAY, _GEN_ARRAY, _CHARSET_BYTES, chars)
+    return _strings(chars)
+
+def p2pkhAddresses(pubkeys):
+    """P2PKH addresses of an (n, key size) uint8 array of public keys."""
+    return _p2pkhFromHash160(_hashRows(pubkeys, _hash160Digest))
+
+def p2wpkhAddresses(pubkeys):
+    """P2WPKH addresses of an (n, 33) uint8 array of compressed public keys."""
+    return _p2wpkhFromHash160(_hashRows(pubkeys, _hash160Digest))
+
+def _parsePubkeys(pubkeys):
+    """Hex public keys to (n, 65) uncompressed and (n, 33) compressed uint8 arrays, plus a validity mask. Invalid rows are zeros."""
+    n = len(pubkeys)
+    uncompressed = np.zeros((n, 65), dtype=np.uint8)
+    valid = np.zeros(n, dtype=bool)
+    for i, pubkey in enumerate(pubkeys):
+        try:
+            raw = bytes.fromhex(pubkey)
+            if len(raw) == 33 and raw[0] in (2, 3):
+                raw = decompressPubkey(raw)
+            elif len(raw) != 65 or raw[0] != 4:
+                continue
+        except (TypeError, ValueError):
+            continue
+        uncompressed[i] = np.frombuffer(raw, dtype=np.uint8)
+        valid[i] = True
+    compressed = np.empty((n, 33), dtype=np.uint8)
+    compressed[:, 0] = 2 + (uncompressed[:, 64] & 1)
+    compressed[:, 1:] = uncompressed[:, 1:33]
+    return uncompressed, compressed, valid
+
+def deriveAddressBatch(pubkeys):
+    """
+    Columnar deriveUndefinedAddresses for a list of hex public keys (no xpubs or multisig lists).
+    Returns a dict of equally long arrays: uncompressed, compressed, p2pkh_uncompressed, p2pkh_compressed, p2wpkh and valid.
+    Keys that don't parse, or compressed keys that aren't on the curve, have valid False and empty strings everywhere else.
+    """
+    uncompressed, compressed, valid = _parsePubkeys(pubkeys)
+    compressed_hash160 = _hashRows(compressed, _hash160Digest)
+    derived = {
+        "uncompressed": _hexStrings(uncompressed),
+        "compressed": _hexStrings(compressed),
+        "p2pkh_uncompressed": p2pkhAddresses(uncompressed),
+        "p2pkh_compressed": _p2pkhFromHash160(compressed_hash160),
+        "p2wpkh": _p2wpkhFromHash160(compressed_hash160),
+    }
+    for column in derived.values():
+        column[~valid] = ""
+    derived["valid"] = valid
+    return derived
+
+
+# Canonical keys: every address and public key reduced to a type tag byte and the 20 or 32 byte hash its script commits to, stored as BYTEA.
+# They are 21 or 33 bytes instead of 34 to 130 characters of text, so normalized_hashes, outputs.address_key and their indexes are several times smaller and joins compare short byte strings.
+# A public key's canonical key is its P2PKH key (tag 0 + HASH160), so a pay to pubkey output and a P2PKH output of the same key already match without findRevealedPkeys.
+# Base58 checksums and bech32 checksums are not verified. Every address here came from Bitcoin Core, which already did.
+KEY_TAGS = {"pubkeyhash": 0, "scripthash": 1, "witness_v0_keyhash": 2, "witness_v0_scripthash": 3, "witness_v1_taproot": 4}
+_B58_INDEX = np.full(256, -1, dtype=np.int64)
+_B58_INDEX[_B58_BYTES] = np.arange(58)
+_BECH32_INDEX = np.full(256, -1, dtype=np.int64)
+_BECH32_INDEX[_CHARSET_BYTES] = np.arange(32)
+
+@njit(cache=True)
+def _base58DecodeRows(chars, lengths, index, out, valid):
+    """Decodes base58 rows of `chars` into fixed width big endian rows of `out`. Rows that don't fit or have invalid characters get valid False."""
+    width = out.shape[1]
+    acc = np.empty(width, dtype=np.int64)
+    for r in range(chars.shape[0]):
+        acc[:] = 0
+        valid[r] = True
+        for j in range(lengths[r]):
+            carry = index[chars[r, j]]
+            if carry < 0:
+                valid[r] = False
+                break
+            for k in range(width - 1, -1, -1):
+                carry += 58 * acc[k]
+                acc[k] = carry & 0xff
+                carry >>= 8
+            if carry:
+                valid[r] = False
+                break
+        for k in range(width):
+            out[r, k] = acc[k]
+
+@njit(cache=True)
+def _bech32DecodeRows(chars, index, out, valid):
+    """Decodes the 5 bit data characters of `chars` (witness program only, no version or checksum) into 8 bit rows of `out`."""
+    for r in range(chars.shape[0]):
+        acc = 0
+        bits = 0
+        j = 0
+        valid[r] = True
+        for c in chars[r]:
+            v = index[c]
+            if v < 0:
+                valid[r] = False
+                break
+            acc = ((acc << 5) | v) & 0xfff
+            bits += 5
+            if bits >= 8:
+                bits -= 8
+                if j < out.shape[1]:
+                    out[r, j] = (acc >> bits) & 0xff
+                j += 1
+
+def _charRows(strings, width):
+    """ASCII strings to a zero padded (n, width) uint8 array and their lengths."""
+    data = np.array(strings, dtype=f"S{width}")
+    return data.view(np.uint8).reshape(len(strings), width), np.char.str_len(data)
+
+def _keyRows(tag, payloads):
+    """Tag byte + each row of payloads, as a list of bytes."""
+    rows = np.empty((payloads.shape[0], payloads.shape[1] + 1), dtype=np.uint8)
+    rows[:, 0] = tag
+    rows[:, 1:] = payloads
+    width = rows.shape[1]
+    data = rows.tobytes()
+    return [data[i:i + width] for i in range(0, len(data), width)]
+
+def canonicalKeys(values):
+    """
+    Canonical keys of a list of addresses and/or hex public keys (the values outputs.address holds). None for None and for anything without one (multisig, nonstandard, unknown witness versions).
+    """
+    keys = [None] * len(values)
+    groups = {"base58": [], "witness_v0_keyhash": [], "witness_v0_scripthash": [], "witness_v1_taproot": [], "pubkey": []}
+    for i, value in enumerate(values):
+        if not value:
+            continue
+        first = value[0]
+        if first == "1" or first == "3":
+            groups["base58"].append(i)
+        elif value.startswith("bc1q"):
+            if len(value) == 42:
+                groups["witness_v0_keyhash"].append(i)
+            elif len(value) == 62:
+                groups["witness_v0_scripthash"].append(i)
+        elif value.startswith("bc1p") and len(value) == 62:
+            groups["witness_v1_taproot"].append(i)
+        elif (len(value) == 66 and value[:2] in ("02", "03")) or (len(value) == 130 and value[:2] == "04"):
+            groups["pubkey"].append(i)
+
+    rows = groups["base58"]
+    if rows:
+        strings = [values[i] for i in rows]
+        chars, lengths = _charRows(strings, 35)
+        decoded = np.empty((len(rows), 25), dtype=np.uint8)
+        valid = np.empty(len(rows), dtype=bool)
+        _base58DecodeRows(chars, lengths, _B58_INDEX, decoded, valid)
+        valid &= (decoded[:, 0] == 0) | (decoded[:, 0] == 5)  # P2PKH and P2SH version bytes
+        tags = np.where(decoded[:, 0] == 0, KEY_TAGS["pubkeyhash"], KEY_TAGS["scripthash"])
+        for tag in np.unique(tags[valid]):
+            picked = np.flatnonzero(valid & (tags == tag))
+            for i, key in zip(picked, _keyRows(tag, decoded[picked, 1:21])):
+                keys[rows[i]] = key
+
+    for kind, size in (("witness_v0_keyhash", 20), ("witness_v0_scripthash", 32), ("witness_v1_taproot", 32)):
+        rows = groups[kind]
+        if rows:
+            n_chars = (size * 8 + 4) // 5
+            chars, _ = _charRows([values[i][4:4 + n_chars] for i in rows], n_chars)
+            decoded = np.empty((len(rows), size), dtype=np.uint8)
+            valid = np.empty(len(rows), dtype=bool)
+            _bech32DecodeRows(chars, _BECH32_INDEX, decoded, valid)
+            picked = np.flatnonzero(valid)
+            for i, key in zip(picked, _keyRows(KEY_TAGS[kind], decoded[picked])):
+                keys[rows[i]] = key
+
+    pubkey_tag = bytes([KEY_TAGS["pubkeyhash"]])
+    for i in groups["pubkey"]:
+        try:
+            keys[i] = pubkey_tag + _hash160Digest(bytes.fromhex(values[i]))
+        except ValueError:
+            pass
+    return keys
+
+def deriveKeyBatch(pubkeys):
+    """
+    deriveAddressBatch in canonical keys. The five derived forms collapse to three: uncompressed (also its P2PKH), compressed (also its P2PKH) and p2wpkh.
+    Returns a dict of lists of bytes (None where invalid) and the valid mask.
+    """
+    uncompressed, compressed, valid = _parsePubkeys(pubkeys)
+    compressed_hash160 = _hashRows(compressed, _hash160Digest)
+    derived = {
+        "uncompressed": _keyRows(KEY_TAGS["pubkeyhash"], _hashRows(uncompressed, _hash160Digest)),
+        "compressed": _keyRows(KEY_TAGS["pubkeyhash"], compressed_hash160),
+        "p2wpkh": _keyRows(KEY_TAGS["witness_v0_keyhash"], compressed_hash160),
+    }
+    for column in derived.values():
+        for i in np.flatnonzero(~valid):
+            column[i] = None
+    derived["valid"] = valid
+    return derived